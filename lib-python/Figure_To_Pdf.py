@@ -16,26 +16,34 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import collections
+import errno
 import logging
 import json
 import unicodedata
 import numpy
 import shutil
+import struct
 import tempfile
+import threading
+import time
 
 from datetime import datetime
 import os
 from os import path
 import zipfile
-from math import atan2, atan, sin, cos, sqrt, radians
+from math import atan, ceil, sin, cos, floor, radians
 
-from omero.model import ImageAnnotationLinkI, ImageI
+from omero.model import DatasetI, DatasetImageLinkI, ImageAnnotationLinkI
+from omero.model import ImageI
 import omero.scripts as scripts
 from omero.gateway import BlitzGateway
-from omero.rtypes import rstring, robject
+from omero.rtypes import rint, rstring, robject, unwrap
+from omero.sys import ParametersI
 
 
 from cStringIO import StringIO
+from Queue import Queue
 try:
     from PIL import Image, ImageDraw, ImageFont
 except ImportError:
@@ -58,6 +66,7 @@ try:
     from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
     from reportlab.platypus import Paragraph
     from reportlab.lib.enums import TA_LEFT, TA_CENTER, TA_RIGHT
+    from reportlab.lib.utils import ImageReader
     reportlab_installed = True
 except ImportError:
     reportlab_installed = False
@@ -66,12 +75,34 @@ except ImportError:
 ## don't created info page
 reportlab_installed = False
 
+# Only needed to write tiled, pyramidal TIFFs
+try:
+    import tifffile
+    tifffile_installed = True
+except ImportError:
+    tifffile_installed = False
+
 DEFAULT_OFFSET = 0
 
+# Tile size, and size of the smallest level, of pyramidal TIFFs
+TIFF_TILE_SIZE = 256
+
+# Compression of pyramidal TIFFs, by name of the compression in tifffile
+TIFF_COMPRESSIONS = {
+    'deflate': 'zlib',
+    'lzw': 'lzw',
+    'jpeg': 'jpeg',
+}
+
 ORIGINAL_DIR = "1_originals"
 RESAMPLED_DIR = "2_pre_resampled"
 FINAL_DIR = "3_final"
 
+# Longest side, in pixels, of the info page thumbnails, and maximum
+# size of the thumbnails cache.
+THUMBNAIL_SIZE = 96
+THUMBNAIL_CACHE_BYTES = 64 * 1024 * 1024
+
 README_TXT = """These folders contain images used in the creation
 of the figure. Each folder contains one image per figure panel,
 with images numbered according to the order they were added to
@@ -92,69 +123,931 @@ processing steps:
 """
 
 
-def scale_to_export_dpi(pixels):
+# A label with its position on the page, ready to be drawn by
+# draw_text().  Computed from the figure JSON by layout_labels().
+PlacedLabel = collections.namedtuple(
+    'PlacedLabel', ['text', 'x', 'y', 'fontsize', 'rgb', 'align'])
+
+
+# Resolution of TIFF exports, and of quick previews
+EXPORT_DPI = 300
+PREVIEW_DPI = 72
+
+
+def scale_to_export_dpi(pixels, dpi=EXPORT_DPI):
     """
     Original figure coordinates assume 72 dpi figure, but we want to
-    export at 300 dpi, so everything needs scaling accordingly
+    export at dpi (300 by default), so everything needs scaling
+    accordingly
     """
-    return pixels * 300/72
+    return pixels * dpi/72
+
+
+# Extensions of files that are already compressed.  These are stored
+# in the zip as they are since deflating them again gains nothing.
+ZIP_STORED_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.pdf', '.zip')
 
+# PIL format to use when saving an image, by file extension.
+IMAGE_FORMATS = {
+    '.tif': 'TIFF',
+    '.tiff': 'TIFF',
+    '.jpg': 'JPEG',
+    '.jpeg': 'JPEG',
+    '.png': 'PNG',
+}
 
-def compress(target, base):
+
+class FigureZip(object):
     """
-    Creates a ZIP recursively from a given base directory.
+    Zip file where figure files are added as soon as they are created.
 
-    @param target:      Name of the zip file we want to write E.g.
-                        "folder.zip"
-    @param base:        Name of folder that we want to zip up E.g. "folder"
+    Each file is written to a temporary file first, which is then
+    copied into the zip in small chunks and removed.  So only one file
+    at a time is on disk, and neither the file nor its compressed data
+    are ever whole in memory.  Each entry is either deflated or stored
+    depending on its file type.
     """
-    zip_file = zipfile.ZipFile(target, 'w')
-    try:
-        for root, dirs, files in os.walk(base):
-            archive_root = os.path.relpath(root, base)
-            for f in files:
-                fullpath = os.path.join(root, f)
-                archive_name = os.path.join(archive_root, f)
-                zip_file.write(fullpath, archive_name)
-    finally:
-        zip_file.close()
+
+    def __init__(self, target, temp_dir):
+        self.target = target
+        self.temp_dir = temp_dir
+        self.zip_file = zipfile.ZipFile(target, 'w', allowZip64=True)
+        # Pages may be written from a PageWriter thread
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_compress_type(archive_name):
+        ext = os.path.splitext(archive_name)[1].lower()
+        if ext in ZIP_STORED_EXTENSIONS:
+            return zipfile.ZIP_STORED
+        return zipfile.ZIP_DEFLATED
+
+    def get_temp_file_name(self, archive_name):
+        """
+        Returns the name of a new temporary file where to write the
+        file to add as archive_name, with write_file().
+        """
+        ext = os.path.splitext(archive_name)[1]
+        fd, fpath = tempfile.mkstemp(suffix=ext, dir=self.temp_dir)
+        os.close(fd)
+        os.chmod(fpath, 0o644)
+        return fpath
+
+    def write_file(self, fpath, archive_name):
+        """ Moves the file at fpath into the zip, named archive_name """
+        try:
+            with self.lock:
+                self.zip_file.write(fpath, archive_name,
+                                    self.get_compress_type(archive_name))
+        finally:
+            os.remove(fpath)
+
+    def write_str(self, data, archive_name):
+        """ Adds data, a short string, as a file named archive_name """
+        info = zipfile.ZipInfo(archive_name,
+                               date_time=time.localtime(time.time())[:6])
+        info.compress_type = self.get_compress_type(archive_name)
+        info.external_attr = 0o644 << 16
+        with self.lock:
+            self.zip_file.writestr(info, data)
+
+    def write_image(self, pil_img, archive_name):
+        """ Adds PIL image to the zip, format from archive_name extension """
+        ext = os.path.splitext(archive_name)[1].lower()
+        fpath = self.get_temp_file_name(archive_name)
+        try:
+            pil_img.save(fpath, IMAGE_FORMATS.get(ext, 'TIFF'))
+        except:
+            os.remove(fpath)
+            raise
+        self.write_file(fpath, archive_name)
+
+    def close(self):
+        with self.lock:
+            self.zip_file.close()
+
+    def discard(self):
+        """ Closes and removes the zip, e.g., if the export failed """
+        self.close()
+        os.remove(self.target)
+
+
+class PageWriter(object):
+    """
+    Encodes and writes finished pages in background threads, so that
+    rendering of the next page (or figure) overlaps with compression
+    and I/O of the previous one.
+
+    The queue is bounded so that rendering can't get more than
+    max_pending pages ahead of writing, otherwise finished pages would
+    pile up in memory.  The same writer can be shared by several
+    exporters, e.g. to overlap figures in batch scripts.  Each job
+    has an owner, usually the exporter, so that each exporter can wait
+    for its own pages and only gets its own errors.
+    """
+
+    def __init__(self, max_pending=1, workers=1):
+        self.queue = Queue(max_pending)
+        # Pending jobs and errors by owner, and bytes of memory held by
+        # the pending jobs.  Guarded by the condition, which is
+        # notified each time a job is done.
+        self.condition = threading.Condition()
+        self.pending = collections.Counter()
+        self.pending_bytes = 0
+        self.errors = {}
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                self.queue.task_done()
+                return
+            owner, nbytes, func, args = job
+            try:
+                func(*args)
+            except Exception as e:
+                logger.exception("Failed to write page")
+                with self.condition:
+                    self.errors.setdefault(owner, []).append(e)
+            finally:
+                # Drop the job, and the page in it, before saying it's done
+                del job, args
+                with self.condition:
+                    self.pending[owner] -= 1
+                    if self.pending[owner] == 0:
+                        del self.pending[owner]
+                    self.pending_bytes -= nbytes
+                    self.condition.notify_all()
+                self.queue.task_done()
+
+    def submit(self, owner, nbytes, func, *args):
+        """
+        Calls func(*args) in the background, blocks if queue is full.
+        nbytes is the memory held until the job is done, e.g., the
+        page to write, see wait_pending_bytes().
+        """
+        with self.condition:
+            self.pending[owner] += 1
+            self.pending_bytes += nbytes
+        self.queue.put((owner, nbytes, func, args))
+
+    def wait_pending_bytes(self, max_bytes):
+        """ Waits until pending jobs hold at most max_bytes of memory """
+        with self.condition:
+            while self.pending_bytes > max(0, max_bytes):
+                self.condition.wait()
+
+    def join(self, owner=None):
+        """
+        Waits for the jobs of owner, or for all jobs if None, raising
+        error if any of them failed.
+        """
+        with self.condition:
+            while (self.pending[owner] if owner is not None
+                   else self.pending):
+                self.condition.wait()
+            if owner is not None:
+                errors = self.errors.pop(owner, [])
+            else:
+                errors = sum(self.errors.values(), [])
+                self.errors = {}
+        if errors:
+            raise RuntimeError("failed to write %d page(s): %s"
+                               % (len(errors), errors[0]))
+
+    def close(self):
+        """ Waits for all submitted jobs and stops the threads """
+        try:
+            self.join()
+        finally:
+            for thread in self.threads:
+                self.queue.put(None)
+            for thread in self.threads:
+                thread.join()
+
+
+class StripTiffWriter(object):
+    """
+    Writes an uncompressed RGB TIFF one strip of rows at a time, so
+    that the whole image is never in memory.  Since the strips are not
+    compressed, their size, and so the whole header, is known before
+    the first strip is written.
+    """
+
+    # TIFF field types
+    SHORT = 3
+    LONG = 4
+    RATIONAL = 5
+
+    def __init__(self, fpath, width, height, rows_per_strip, dpi=None):
+        self.width = width
+        self.height = height
+        self.rows_per_strip = rows_per_strip
+        self.rows_written = 0
+
+        n_strips = (height + rows_per_strip - 1) // rows_per_strip
+        byte_counts = [min(rows_per_strip, height - (i * rows_per_strip))
+                       * width * 3 for i in range(n_strips)]
+        if 1024 + sum(byte_counts) + (8 * n_strips) >= 2**32:
+            raise ValueError("page of %dx%d is too large for a TIFF file"
+                             % (width, height))
+
+        # (tag, type, values), sorted below since TIFF requires the
+        # tags in increasing order.  Strip offsets are filled in once
+        # the size of the header is known.
+        strip_offsets = [0] * n_strips
+        entries = [
+            (256, self.LONG, [width]),           # ImageWidth
+            (257, self.LONG, [height]),          # ImageLength
+            (258, self.SHORT, [8, 8, 8]),        # BitsPerSample
+            (259, self.SHORT, [1]),              # Compression (none)
+            (262, self.SHORT, [2]),              # Photometric (RGB)
+            (273, self.LONG, strip_offsets),     # StripOffsets
+            (277, self.SHORT, [3]),              # SamplesPerPixel
+            (278, self.LONG, [rows_per_strip]),  # RowsPerStrip
+            (279, self.LONG, byte_counts),       # StripByteCounts
+            (284, self.SHORT, [1]),              # PlanarConfiguration
+        ]
+        if dpi is not None:
+            entries.extend([
+                (282, self.RATIONAL, [(int(dpi), 1)]),  # XResolution
+                (283, self.RATIONAL, [(int(dpi), 1)]),  # YResolution
+                (296, self.SHORT, [2]),          # ResolutionUnit (inch)
+            ])
+        entries.sort(key=lambda entry: entry[0])
+
+        # Header, IFD, values that don't fit in the IFD, and strips
+        ifd_size = 2 + (12 * len(entries)) + 4
+        offset = 8 + ifd_size
+        for tag, field_type, values in entries:
+            packed_size = len(self.pack_values(field_type, values))
+            if packed_size > 4:
+                offset += packed_size
+        for i, n_bytes in enumerate(byte_counts):
+            strip_offsets[i] = offset
+            offset += n_bytes
+
+        ifd = [struct.pack('<H', len(entries))]
+        extra = []
+        extra_offset = 8 + ifd_size
+        for tag, field_type, values in entries:
+            packed = self.pack_values(field_type, values)
+            if len(packed) <= 4:
+                value = packed.ljust(4, b'\0')
+            else:
+                value = struct.pack('<I', extra_offset)
+                extra.append(packed)
+                extra_offset += len(packed)
+            ifd.append(struct.pack('<HHI', tag, field_type, len(values))
+                       + value)
+        ifd.append(struct.pack('<I', 0))  # no more IFDs
+
+        self._fh = open(fpath, 'wb')
+        self._fh.write(b'II*\0' + struct.pack('<I', 8))
+        self._fh.write(b''.join(ifd))
+        self._fh.write(b''.join(extra))
+
+    @classmethod
+    def pack_values(cls, field_type, values):
+        if field_type == cls.SHORT:
+            return struct.pack('<%dH' % len(values), *values)
+        elif field_type == cls.LONG:
+            return struct.pack('<%dI' % len(values), *values)
+        else:
+            return b''.join([struct.pack('<II', n, d) for n, d in values])
+
+    def write_strip(self, pil_img):
+        """ Writes the next strip, a PIL image with rows_per_strip rows """
+        rows = min(self.rows_per_strip, self.height - self.rows_written)
+        if pil_img.size != (self.width, rows):
+            raise ValueError("strip of size %s but expected %s"
+                             % (pil_img.size, (self.width, rows)))
+        self._fh.write(pil_img.convert('RGB').tobytes())
+        self.rows_written += rows
+
+    def close(self):
+        self._fh.close()
+        if self.rows_written != self.height:
+            raise RuntimeError("TIFF closed after %d of %d rows"
+                               % (self.rows_written, self.height))
+
+
+def write_pyramid_tiff(target, strips, width, height, compression, dpi,
+                       tile_size=TIFF_TILE_SIZE):
+    """
+    Writes a tiled, compressed TIFF, with reduced resolution levels
+    down to one tile in SubIFDs, so that viewers only read the tiles
+    they show.  The image is given as an iterable of strips, RGB PIL
+    images of width, with a multiple of tile_size rows except for the
+    last.  target is a file name or file object.
+    """
+    n_levels = 0
+    while max(width, height) > (tile_size << n_levels):
+        n_levels += 1
+
+    # The reduced levels are made from the half size level, which is
+    # filled as the full resolution strips are written.
+    half = None
+    if n_levels > 0:
+        half = Image.new('RGB', ((width + 1) // 2, (height + 1) // 2))
+
+    def tiles():
+        y = 0
+        for strip in strips:
+            strip = strip.convert('RGB')
+            rows = strip.size[1]
+            if half is not None:
+                half.paste(strip.resize(((width + 1) // 2, (rows + 1) // 2),
+                                        Image.ANTIALIAS), (0, y // 2))
+            pixels = numpy.asarray(strip)
+            for ty in range(0, rows, tile_size):
+                for tx in range(0, width, tile_size):
+                    tile = pixels[ty:ty+tile_size, tx:tx+tile_size]
+                    if tile.shape[:2] != (tile_size, tile_size):
+                        padded = numpy.zeros((tile_size, tile_size, 3),
+                                             numpy.uint8)
+                        padded[:tile.shape[0], :tile.shape[1]] = tile
+                        tile = padded
+                    yield tile
+            y += rows
+
+    # Offsets in classic TIFF are 32 bit.  The compressed size is not
+    # known before so use BigTIFF if the pyramid would not fit as is.
+    bigtiff = (width * height * 3 * 4) // 3 > 2**32 - 2**25
+    options = dict(tile=(tile_size, tile_size), photometric='rgb',
+                   compression=TIFF_COMPRESSIONS[compression],
+                   resolution=(dpi, dpi), resolutionunit='INCH')
+    with tifffile.TiffWriter(target, bigtiff=bigtiff) as tif:
+        tif.write(tiles(), shape=(height, width, 3), dtype=numpy.uint8,
+                  subifds=n_levels, **options)
+        level = half
+        for i in range(n_levels):
+            tif.write(numpy.asarray(level), subfiletype=1, **options)
+            if i + 1 < n_levels:
+                level = level.resize(((level.size[0] + 1) // 2,
+                                      (level.size[1] + 1) // 2),
+                                     Image.ANTIALIAS)
+
+
+class ThumbnailCache(object):
+    """
+    Thumbnails for the info page, kept on disk between exports.
+
+    Thumbnails are fetched from OMERO, for all images of a figure at
+    once, only when not in the cache.  Files are named by image id and
+    rendering settings version, so a thumbnail is fetched again after
+    its rendering settings change.  The least recently used files are
+    removed when the cache grows over max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=THUMBNAIL_CACHE_BYTES,
+                 size=THUMBNAIL_SIZE):
+        if directory is None:
+            cache_home = os.environ.get('XDG_CACHE_HOME',
+                                        os.path.expanduser('~/.cache'))
+            directory = os.path.join(cache_home, 'omero-figure',
+                                     'thumbnails')
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = size
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def get_fpath(self, image_id, version):
+        return os.path.join(self.directory, "%d_%d_%d.jpg"
+                            % (image_id, version, self.size))
+
+    def get_versions(self, conn, image_ids):
+        """
+        Returns dict of image id to (pixels id, version) where the
+        version is the last update of any rendering settings of the
+        image.  Images without rendering settings are version 0.
+        """
+        params = ParametersI()
+        params.addIds(list(image_ids))
+        query = ("select p.image.id, p.id, max(r.details.updateEvent.id)"
+                 " from Pixels p left outer join p.settings r"
+                 " where p.image.id in (:ids)"
+                 " group by p.image.id, p.id")
+        versions = {}
+        for row in conn.getQueryService().projection(query, params,
+                                                     conn.SERVICE_OPTS):
+            image_id, pixels_id, version = unwrap(row)
+            versions[image_id] = (pixels_id, version or 0)
+        return versions
+
+    def get_thumbnails(self, conn, image_ids):
+        """ Returns dict of image id to JPEG data of its thumbnail """
+        versions = self.get_versions(conn, image_ids)
+        thumbs = {}
+        missing = {}
+        for image_id, (pixels_id, version) in versions.items():
+            fpath = self.get_fpath(image_id, version)
+            try:
+                with open(fpath, 'rb') as fh:
+                    thumbs[image_id] = fh.read()
+                os.utime(fpath, None)   # mark as recently used
+            except (IOError, OSError):
+                missing[pixels_id] = (image_id, fpath)
+
+        if missing:
+            store = conn.createThumbnailStore()
+            try:
+                data = store.getThumbnailByLongestSideSet(
+                    rint(self.size), list(missing.keys()), conn.SERVICE_OPTS)
+            finally:
+                store.close()
+            for pixels_id, thumb_data in data.items():
+                if not thumb_data:
+                    continue
+                image_id, fpath = missing[pixels_id]
+                thumbs[image_id] = thumb_data
+                self.put(fpath, thumb_data)
+            self.evict()
+        return thumbs
+
+    def put(self, fpath, thumb_data):
+        # Write to a temporary file so that other exports never read
+        # a partial thumbnail.
+        fd, temp_fpath = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'wb') as fh:
+            fh.write(thumb_data)
+        os.rename(temp_fpath, fpath)
+
+    def evict(self):
+        """ Removes least recently used thumbnails to fit max_bytes """
+        entries = []
+        total = 0
+        for fname in os.listdir(self.directory):
+            fpath = os.path.join(self.directory, fname)
+            try:
+                stat = os.stat(fpath)
+            except OSError:
+                continue    # removed by another export
+            entries.append((stat.st_mtime, stat.st_size, fpath))
+            total += stat.st_size
+        entries.sort()
+        for mtime, size, fpath in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(fpath)
+            except OSError:
+                pass
+            total -= size
+
+
+def parse_rgb(color):
+    """ Convert from E.g. 'ff0000' or '#ff0000' to (255, 0, 0) """
+    color = color.lstrip('#')
+    return (int(color[0:2], 16), int(color[2:4], 16), int(color[4:6], 16))
+
+
+def get_crop_region(panel_json):
+    """
+    Gets the width and height in points/pixels for a panel in the
+    figure. This is at the 'original' figure / PDF coordinates
+    (E.g. before scaling for TIFF export)
+    """
+    zoom = float(panel_json['zoom'])
+    frame_w = panel_json['width']
+    frame_h = panel_json['height']
+    dx = panel_json['dx']
+    dy = panel_json['dy']
+    orig_w = panel_json['orig_width']
+    orig_h = panel_json['orig_height']
+
+    # need tile_x, tile_y, tile_w, tile_h
+
+    tile_w = orig_w / (zoom/100)
+    tile_h = orig_h / (zoom/100)
+
+    orig_ratio = float(orig_w) / orig_h
+    wh = float(frame_w) / frame_h
+
+    if abs(orig_ratio - wh) > 0.01:
+        # if viewport is wider than orig...
+        if (orig_ratio < wh):
+            tile_h = tile_w / wh
+        else:
+            tile_w = tile_h * wh
+
+    cropx = ((orig_w - tile_w)/2) - dx
+    cropy = ((orig_h - tile_h)/2) - dy
+
+    return {'x': cropx, 'y': cropy, 'width': tile_w, 'height': tile_h}
+
+
+def rotate_points(xs, ys, crop, rotation):
+    """
+    Rotate image coordinates by rotation degrees around the centre
+    of the crop region.  xs and ys may be numbers or numpy arrays.
+    """
+    cx = crop['x'] + (crop['width']/2)
+    cy = crop['y'] + (crop['height']/2)
+    dx = cx - xs
+    dy = cy - ys
+    angle = radians(rotation)
+    return (cx - (dx * cos(angle) - dy * sin(angle)),
+            cy - (dy * cos(angle) + dx * sin(angle)))
+
+
+class Label(object):
+    """ Panel label.  For time labels, text is None and time is set """
+
+    __slots__ = ('text', 'time', 'position', 'size', 'color')
+
+    def __init__(self, label_json):
+        self.text = label_json.get('text')
+        self.time = label_json.get('time')
+        self.position = label_json['position']
+        self.size = int(label_json['size'])   # make sure 'size' is number
+        self.color = label_json['color'].lower()
+
+
+class Scalebar(object):
+    """ Panel scalebar """
+
+    __slots__ = ('show', 'length', 'position', 'rgb', 'show_label',
+                 'font_size')
+
+    def __init__(self, scalebar_json):
+        self.show = bool(scalebar_json.get('show'))
+        self.length = scalebar_json.get('length')
+        self.position = scalebar_json.get('position') or 'bottomright'
+        self.rgb = None
+        if self.show:
+            self.rgb = parse_rgb(scalebar_json['color'])
+        self.show_label = bool(scalebar_json.get('show_label'))
+        self.font_size = 10
+        try:
+            self.font_size = int(scalebar_json.get('font_size'))
+        except Exception:
+            pass
+
+
+class Shape(object):
+    """
+    Panel shape (ROI), in image coordinates.  Polygon and polyline
+    points are a numpy array with one row of x, y per point.
+    """
+
+    __slots__ = ('type', 'x', 'y', 'width', 'height', 'x1', 'y1', 'x2',
+                 'y2', 'radius_x', 'radius_y', 'rotation', 'rgb',
+                 'stroke_width', 'points')
+
+    def __init__(self, shape_json):
+        get = shape_json.get
+        self.type = shape_json['type']
+        self.x = get('x')
+        self.y = get('y')
+        self.width = get('width')
+        self.height = get('height')
+        self.x1 = get('x1')
+        self.y1 = get('y1')
+        self.x2 = get('x2')
+        self.y2 = get('y2')
+        self.radius_x = get('radiusX')
+        self.radius_y = get('radiusY')
+        self.rotation = get('rotation', 0)
+        self.rgb = parse_rgb(shape_json['strokeColor'])
+        self.stroke_width = get('strokeWidth', 2)
+        self.points = None
+        if 'points' in shape_json:
+            # Older polygons/polylines may be 'x,y,'
+            self.points = numpy.array(
+                [[float(v) for v in point.split(",")[:2]]
+                 for point in shape_json['points'].split()])
+
+
+class Panel(object):
+    """
+    Figure panel, parsed from the figure JSON.
+
+    The crop region on the original image, and the scale from image
+    pixels to page points, are computed once here instead of by each
+    exporter.  The panel position (x, y, width, height) is in figure
+    coordinates, see page_box() for the position on a page.
+    """
+
+    __slots__ = ('image_id', 'name', 'x', 'y', 'width', 'height', 'dx',
+                 'dy', 'rotation', 'the_z', 'the_t', 'delta_t', 'channels',
+                 'z_projection', 'pixel_size_x', 'pixel_size_x_symbol',
+                 'min_export_dpi', 'max_export_dpi', 'labels', 'shapes',
+                 'scalebar', 'crop', 'scale')
+
+    def __init__(self, panel_json):
+        get = panel_json.get
+        self.image_id = panel_json['imageId']
+        self.name = get('name')
+        self.x = panel_json['x']
+        self.y = panel_json['y']
+        self.width = panel_json['width']
+        self.height = panel_json['height']
+        self.dx = panel_json['dx']
+        self.dy = panel_json['dy']
+        self.rotation = get('rotation', 0)
+        self.the_z = panel_json['theZ']
+        self.the_t = panel_json['theT']
+        self.delta_t = get('deltaT')
+
+        # Active channels as (1-based index, window, color, reverse)
+        self.channels = []
+        for i, c in enumerate(panel_json['channels']):
+            if c['active']:
+                self.channels.append((i+1,
+                                      [c['window']['start'],
+                                       c['window']['end']],
+                                      c['color'],
+                                      c.get('reverseIntensity', False)))
+
+        # (start, end) of the Z projection, or None
+        self.z_projection = None
+        if get('z_projection') and 'z_start' in panel_json \
+                and 'z_end' in panel_json:
+            self.z_projection = (panel_json['z_start'], panel_json['z_end'])
+
+        self.pixel_size_x = get('pixel_size_x')
+        self.pixel_size_x_symbol = get('pixel_size_x_symbol', u"\u00B5m")
+        self.min_export_dpi = get('min_export_dpi')
+        self.max_export_dpi = get('max_export_dpi', 1000)
+
+        self.labels = [Label(l) for l in get('labels', [])]
+        self.shapes = [Shape(s) for s in get('shapes', [])]
+        self.scalebar = None
+        if 'scalebar' in panel_json:
+            self.scalebar = Scalebar(panel_json['scalebar'])
+
+        self.crop = get_crop_region(panel_json)
+        self.scale = float(self.width) / self.crop['width']
+
+    def page_box(self, page):
+        """ Returns x, y, width, height of the panel on a page """
+        return (self.x - page['x'], self.y - page['y'],
+                self.width, self.height)
+
+
+def parse_panels(figure_json):
+    """ Returns list of Panel, raises ValueError if a panel is invalid """
+    panels = []
+    for i, panel_json in enumerate(figure_json['panels']):
+        try:
+            panels.append(Panel(panel_json))
+        except (KeyError, TypeError, ValueError, ZeroDivisionError) as e:
+            raise ValueError("invalid panel %d in figure: %s: %s"
+                             % (i, e.__class__.__name__, e))
+    return panels
+
+
+def bucket_panels(panels, page_count, page_col_count, page_width,
+                  page_height, paper_spacing):
+    """
+    Returns a list, one per page, with the indices of the panels on
+    that page.  Pages are in a grid, so each panel is only tested
+    against the pages under its bounding box.
+    """
+    stride_x = page_width + paper_spacing
+    stride_y = page_height + paper_spacing
+    row_count = (page_count + page_col_count - 1) // page_col_count
+    page_panels = [[] for p in range(page_count)]
+    for i, panel in enumerate(panels):
+        x2 = panel.x + panel.width
+        y2 = panel.y + panel.height
+        col0 = max(0, int(floor(panel.x / stride_x)))
+        col1 = min(page_col_count - 1, int(floor(x2 / stride_x)))
+        row0 = max(0, int(floor(panel.y / stride_y)))
+        row1 = min(row_count - 1, int(floor(y2 / stride_y)))
+        for row in range(row0, row1 + 1):
+            for col in range(col0, col1 + 1):
+                p = row * page_col_count + col
+                if p >= page_count:
+                    continue
+                px = col * stride_x
+                py = row * stride_y
+                # overlap, not just touching, like on the figure editor
+                if (panel.x < px + page_width and px < x2
+                        and panel.y < py + page_height and py < y2):
+                    page_panels[p].append(i)
+    return page_panels
+
+
+def render_key(panel):
+    """ Panels with the same key show the same rendered image plane """
+    channels = tuple((idx, tuple(window), color, reverse)
+                     for idx, window, color, reverse in panel.channels)
+    return (panel.image_id, panel.the_z, panel.the_t, channels,
+            panel.z_projection)
+
+
+def image_bytes(pil_img):
+    width, height = pil_img.size
+    return width * height * len(pil_img.getbands())
+
+
+# Image rendered by OMERO for a panel, before crop and rotation, with
+# what is needed from the image so that panels that share the render
+# don't need to get the image again.  The origin is (x0, y0, scale)
+# so that pixel coordinates on pil_img are (image coords - x0) * scale.
+PlaneRender = collections.namedtuple(
+    'PlaneRender', ['name', 'can_annotate', 'size_x', 'size_y', 'is_big',
+                    'origin', 'pil_img'])
+
+
+def transform_panel_image(pil_img, origin, crop, rotation, size,
+                          background):
+    """
+    Returns the crop region, rotated by rotation degrees around its
+    centre, resampled to size.  Crop, rotation and scaling are a
+    single affine transform, so the image is only resampled once.
+    Areas outside pil_img are filled with the background color.
+    See PlaneRender for origin.
+    """
+    x0, y0, scale = origin
+    crop_w = crop['width'] * scale
+    crop_h = crop['height'] * scale
+    cx = (crop['x'] - x0) * scale + (crop_w / 2)
+    cy = (crop['y'] - y0) * scale + (crop_h / 2)
+    width, height = size
+    # source pixels per output pixel
+    sx = crop_w / width
+    sy = crop_h / height
+
+    cos_r = cos(radians(rotation))
+    sin_r = sin(radians(rotation))
+    # Bounding box of the rotated crop region on pil_img
+    half_w = (abs(cos_r) * crop_w + abs(sin_r) * crop_h) / 2
+    half_h = (abs(sin_r) * crop_w + abs(cos_r) * crop_h) / 2
+    img_w, img_h = pil_img.size
+    left = max(0, int(floor(cx - half_w)) - 2)
+    top = max(0, int(floor(cy - half_h)) - 2)
+    right = min(img_w, int(ceil(cx + half_w)) + 2)
+    bottom = min(img_h, int(ceil(cy + half_h)) + 2)
+    if right <= left or bottom <= top:
+        return Image.new(pil_img.mode, size, background)
+
+    # convert to RGBA so we can control background after transform...
+    # See http://stackoverflow.com/questions/5252170/
+    # This is also a copy, so a shared render is left as it is.
+    mode = pil_img.mode
+    region = pil_img.crop((left, top, right, bottom)).convert('RGBA')
+
+    # Bicubic in transform() does not filter, so when shrinking a lot
+    # first reduce by about a whole factor, with antialias, to avoid
+    # aliasing.  The reduced size is rounded up, so that no pixels of
+    # the region are cut, and the factors are the exact ones.
+    reduce_by = int(min(sx, sy))
+    if reduce_by >= 2:
+        reduced_w = int(ceil(float(right - left) / reduce_by))
+        reduced_h = int(ceil(float(bottom - top) / reduce_by))
+        region = region.resize((reduced_w, reduced_h), Image.ANTIALIAS)
+        fx = float(right - left) / reduced_w
+        fy = float(bottom - top) / reduced_h
+    else:
+        fx = fy = 1.0
+    cx = (cx - left) / fx
+    cy = (cy - top) / fy
+    sx = sx / fx
+    sy = sy / fy
+
+    # Map each output pixel to the source: centre the output, scale
+    # to source pixels, rotate, and move to the crop centre.
+    coeffs = (cos_r * sx, sin_r * sy,
+              cx - (cos_r * sx * width + sin_r * sy * height) / 2,
+              -sin_r * sx, cos_r * sy,
+              cy - (-sin_r * sx * width + cos_r * sy * height) / 2)
+    region = region.transform(size, Image.AFFINE, coeffs, Image.BICUBIC)
+
+    # ...paste image with transparent blank areas onto the background
+    out = Image.new('RGBA', size, background)
+    out.paste(region, (0, 0), region)
+    # and convert back to original mode
+    return out.convert(mode)
+
+
+class RenderPlan(object):
+    """
+    Which panels to draw on each page, and the renders shared by them.
+
+    Panels of the same image, plane, channels and projection at
+    different zoom, crop or rotation are all cut from one render of
+    the whole plane, at full resolution.  A render is kept while there
+    are panels left that use it, as long as the kept renders fit in
+    max_bytes (None for no limit).  Otherwise the least recently used
+    are dropped and rendered again when needed.
+    """
+
+    def __init__(self, panels, page_panels, max_bytes=None,
+                 get_target_size=None):
+        self.page_panels = page_panels
+        self.max_bytes = max_bytes
+        self.cached_bytes = 0
+        # Number of panels yet to be drawn, by render key
+        self._uses = collections.Counter()
+        # Largest scale, from image pixels, of the panels of a render
+        # on the figure.  None if a panel keeps the render resolution.
+        self._scales = {}
+        for panel_idxs in page_panels:
+            for i in panel_idxs:
+                key = render_key(panels[i])
+                self._uses[key] += 1
+                scale = None
+                if get_target_size is not None:
+                    size = get_target_size(panels[i])
+                    if size is not None:
+                        crop = panels[i].crop
+                        scale = max(size[0] / float(crop['width']),
+                                    size[1] / float(crop['height']))
+                if scale is None or self._scales.get(key, 0) is None:
+                    self._scales[key] = None
+                else:
+                    self._scales[key] = max(self._scales.get(key, 0), scale)
+        # Kept renders, least recently used first
+        self._renders = collections.OrderedDict()
+
+    def render_scale(self, key):
+        """ Scale the render needs, from image pixels, or None if all """
+        return self._scales.get(key)
+
+    def take(self, key):
+        """ Returns the kept render for a panel about to be drawn """
+        self._uses[key] -= 1
+        plane = self._renders.pop(key, None)
+        if plane is None:
+            return None
+        if self._uses[key] > 0:
+            self._renders[key] = plane
+        else:
+            self.cached_bytes -= image_bytes(plane.pil_img)
+        return plane
+
+    def keep(self, key, plane):
+        """ Keeps a new render if there are more panels that use it """
+        if self._uses[key] <= 0 or key in self._renders:
+            return
+        nbytes = image_bytes(plane.pil_img)
+        if self.max_bytes is not None:
+            if nbytes > self.max_bytes:
+                return
+            self.evict(self.cached_bytes + nbytes - self.max_bytes)
+        self._renders[key] = plane
+        self.cached_bytes += nbytes
+
+    def evict(self, nbytes):
+        """ Drops renders, least recently used first, to free nbytes """
+        while nbytes > 0 and self._renders:
+            key, plane = self._renders.popitem(last=False)
+            freed = image_bytes(plane.pil_img)
+            self.cached_bytes -= freed
+            nbytes -= freed
 
 
 class ShapeToPdfExport(object):
 
-    def __init__(self, canvas, panel, page, crop, page_height):
+    def __init__(self, canvas, panel, page, page_height):
 
         self.canvas = canvas
         self.panel = panel
         self.page = page
         # The crop region on the original image coordinates...
-        self.crop = crop
+        self.crop = panel.crop
         self.page_height = page_height
         # Get a mapping from original coordinates to the actual size of panel
-        self.scale = float(panel['width']) / crop['width']
-
-        if "shapes" in panel:
-            for shape in panel["shapes"]:
-                if shape['type'] == "Arrow":
-                    self.draw_arrow(shape)
-                elif shape['type'] == "Line":
-                    self.draw_line(shape)
-                elif shape['type'] == "Rectangle":
-                    self.draw_rectangle(shape)
-                elif shape['type'] == "Ellipse":
-                    self.draw_ellipse(shape)
-                elif shape['type'] == "Polygon":
-                    self.draw_polygon(shape)
-                elif shape['type'] == "Polyline":
-                    self.draw_polyline(shape)
+        self.scale = panel.scale
+
+        for shape in panel.shapes:
+            if shape.type == "Arrow":
+                self.draw_arrow(shape)
+            elif shape.type == "Line":
+                self.draw_line(shape)
+            elif shape.type == "Rectangle":
+                self.draw_rectangle(shape)
+            elif shape.type == "Ellipse":
+                self.draw_ellipse(shape)
+            elif shape.type == "Polygon":
+                self.draw_polygon(shape)
+            elif shape.type == "Polyline":
+                self.draw_polyline(shape)
 
     @staticmethod
     def get_rgb(color):
         # Convert from E.g. '#ff0000' to (255, 0, 0)
-        red = int(color[1:3], 16)
-        green = int(color[3:5], 16)
-        blue = int(color[5:7], 16)
-        return (red, green, blue)
+        return parse_rgb(color)
+
+    def set_stroke_color(self, rgb):
+        r = float(rgb[0])/255
+        g = float(rgb[1])/255
+        b = float(rgb[2])/255
+        self.canvas.setStrokeColorRGB(r, g, b)
+        return r, g, b
 
     def panel_to_page_coords(self, shape_x, shape_y):
         """
@@ -164,75 +1057,49 @@ class ShapeToPdfExport(object):
         and scaling appropriately.
         Also includes 'inPanel' key - True if point within
         the cropped panel region
+        shape_x and shape_y may also be numpy arrays of points.
         """
-        rotation = self.panel['rotation']
+        rotation = self.panel.rotation
         if rotation != 0:
-            # img coords: centre of rotation
-            cx = self.crop['x'] + (self.crop['width']/2)
-            cy = self.crop['y'] + (self.crop['height']/2)
-            dx = cx - shape_x
-            dy = cy - shape_y
-            # distance of point from centre of rotation
-            h = sqrt(dx * dx + dy * dy)
-            # and the angle
-            angle1 = atan2(dx, dy)
-
-            # Add the rotation to the angle and calculate new
-            # opposite and adjacent lengths from centre of rotation
-            angle2 = angle1 - radians(rotation)
-            newo = sin(angle2) * h
-            newa = cos(angle2) * h
-            # to give correct x and y within cropped panel
-            shape_x = cx - newo
-            shape_y = cy - newa
+            shape_x, shape_y = rotate_points(shape_x, shape_y, self.crop,
+                                             rotation)
 
         # convert to coords within crop region
         shape_x = shape_x - self.crop['x']
         shape_y = shape_y - self.crop['y']
         # check if points are within panel
-        in_panel = True
-        if shape_x < 0 or shape_x > self.crop['width']:
-            in_panel = False
-        if shape_y < 0 or shape_y > self.crop['height']:
-            in_panel = False
+        in_panel = ((shape_x >= 0) & (shape_x <= self.crop['width']) &
+                    (shape_y >= 0) & (shape_y <= self.crop['height']))
         # Handle page offsets
-        x = self.panel['x'] - self.page['x']
-        y = self.panel['y'] - self.page['y']
+        x, y, width, height = self.panel.page_box(self.page)
         # scale and position on page within panel
         shape_x = (shape_x * self.scale) + x
         shape_y = (shape_y * self.scale) + y
         return {'x': shape_x, 'y': shape_y, 'inPanel': in_panel}
 
     def draw_rectangle(self, shape):
-        top_left = self.panel_to_page_coords(shape['x'], shape['y'])
+        top_left = self.panel_to_page_coords(shape.x, shape.y)
 
         # Don't draw if all corners are outside the panel
-        top_right = self.panel_to_page_coords(shape['x'] + shape['width'],
-                                              shape['y'])
-        bottom_left = self.panel_to_page_coords(shape['x'],
-                                                shape['y'] + shape['height'])
-        bottom_right = self.panel_to_page_coords(shape['x'] + shape['width'],
-                                                 shape['y'] + shape['height'])
-        if (top_left['inPanel'] is False) and (
-                top_right['inPanel'] is False) and (
-                bottom_left['inPanel'] is False) and (
-                bottom_right['inPanel'] is False):
+        top_right = self.panel_to_page_coords(shape.x + shape.width,
+                                              shape.y)
+        bottom_left = self.panel_to_page_coords(shape.x,
+                                                shape.y + shape.height)
+        bottom_right = self.panel_to_page_coords(shape.x + shape.width,
+                                                 shape.y + shape.height)
+        if not (top_left['inPanel'] or top_right['inPanel'] or
+                bottom_left['inPanel'] or bottom_right['inPanel']):
             return
 
-        width = shape['width'] * self.scale
-        height = shape['height'] * self.scale
+        width = shape.width * self.scale
+        height = shape.height * self.scale
         x = top_left['x']
         y = self.page_height - top_left['y']    # - height
 
-        rgb = self.get_rgb(shape['strokeColor'])
-        r = float(rgb[0])/255
-        g = float(rgb[1])/255
-        b = float(rgb[2])/255
-        self.canvas.setStrokeColorRGB(r, g, b)
-        stroke_width = shape.get('strokeWidth', 2)
-        self.canvas.setLineWidth(stroke_width)
+        self.set_stroke_color(shape.rgb)
+        self.canvas.setLineWidth(shape.stroke_width)
 
-        rotation = self.panel['rotation'] * -1
+        rotation = self.panel.rotation * -1
         if rotation != 0:
             self.canvas.saveState()
             self.canvas.translate(x, y)
@@ -248,23 +1115,18 @@ class ShapeToPdfExport(object):
             self.canvas.restoreState()
 
     def draw_line(self, shape):
-        start = self.panel_to_page_coords(shape['x1'], shape['y1'])
-        end = self.panel_to_page_coords(shape['x2'], shape['y2'])
+        start = self.panel_to_page_coords(shape.x1, shape.y1)
+        end = self.panel_to_page_coords(shape.x2, shape.y2)
         x1 = start['x']
         y1 = self.page_height - start['y']
         x2 = end['x']
         y2 = self.page_height - end['y']
         # Don't draw if both points outside panel
-        if (start['inPanel'] is False) and (end['inPanel'] is False):
+        if not (start['inPanel'] or end['inPanel']):
             return
 
-        rgb = self.get_rgb(shape['strokeColor'])
-        r = float(rgb[0])/255
-        g = float(rgb[1])/255
-        b = float(rgb[2])/255
-        self.canvas.setStrokeColorRGB(r, g, b)
-        stroke_width = shape['strokeWidth']
-        self.canvas.setLineWidth(stroke_width)
+        self.set_stroke_color(shape.rgb)
+        self.canvas.setLineWidth(shape.stroke_width)
 
         p = self.canvas.beginPath()
         p.moveTo(x1, y1)
@@ -272,22 +1134,18 @@ class ShapeToPdfExport(object):
         self.canvas.drawPath(p, fill=1, stroke=1)
 
     def draw_arrow(self, shape):
-        start = self.panel_to_page_coords(shape['x1'], shape['y1'])
-        end = self.panel_to_page_coords(shape['x2'], shape['y2'])
+        start = self.panel_to_page_coords(shape.x1, shape.y1)
+        end = self.panel_to_page_coords(shape.x2, shape.y2)
         x1 = start['x']
         y1 = self.page_height - start['y']
         x2 = end['x']
         y2 = self.page_height - end['y']
-        stroke_width = shape['strokeWidth']
+        stroke_width = shape.stroke_width
         # Don't draw if both points outside panel
-        if (start['inPanel'] is False) and (end['inPanel'] is False):
+        if not (start['inPanel'] or end['inPanel']):
             return
 
-        rgb = self.get_rgb(shape['strokeColor'])
-        r = float(rgb[0])/255
-        g = float(rgb[1])/255
-        b = float(rgb[2])/255
-        self.canvas.setStrokeColorRGB(r, g, b)
+        r, g, b = self.set_stroke_color(shape.rgb)
         self.canvas.setFillColorRGB(r, g, b)
 
         head_size = (stroke_width * 4) + 5
@@ -329,28 +1187,17 @@ class ShapeToPdfExport(object):
         self.canvas.drawPath(p, fill=1, stroke=1)
 
     def draw_polygon(self, shape, closed=True):
-        polygon_in_viewport = False
-        points = []
-        for point in shape['points'].split(" "):
-            # Older polygons/polylines may be 'x,y,'
-            xy = point.split(",")
-            x = xy[0]
-            y = xy[1]
-            coords = self.panel_to_page_coords(float(x), float(y))
-            points.append([coords['x'], self.page_height - coords['y']])
-            polygon_in_viewport = polygon_in_viewport or coords['inPanel']
-
+        # All points at once
+        coords = self.panel_to_page_coords(shape.points[:, 0],
+                                           shape.points[:, 1])
         # Don't draw if all points outside panel viewport
-        if not polygon_in_viewport:
+        if not coords['inPanel'].any():
             return
+        points = zip(coords['x'].tolist(),
+                     (self.page_height - coords['y']).tolist())
 
-        stroke_width = shape['strokeWidth']
-        rgb = self.get_rgb(shape['strokeColor'])
-        r = float(rgb[0])/255
-        g = float(rgb[1])/255
-        b = float(rgb[2])/255
-        self.canvas.setStrokeColorRGB(r, g, b)
-        self.canvas.setLineWidth(stroke_width)
+        self.set_stroke_color(shape.rgb)
+        self.canvas.setLineWidth(shape.stroke_width)
 
         p = self.canvas.beginPath()
         # Go to start...
@@ -369,20 +1216,16 @@ class ShapeToPdfExport(object):
         self.draw_polygon(shape, False)
 
     def draw_ellipse(self, shape):
-        stroke_width = shape['strokeWidth']
-        c = self.panel_to_page_coords(shape['x'], shape['y'])
+        stroke_width = shape.stroke_width
+        c = self.panel_to_page_coords(shape.x, shape.y)
         cx = c['x']
         cy = self.page_height - c['y']
-        rx = shape['radiusX'] * self.scale
-        ry = shape['radiusY'] * self.scale
-        rotation = (shape['rotation'] + self.panel['rotation']) * -1
-        rgb = self.get_rgb(shape['strokeColor'])
-        r = float(rgb[0])/255
-        g = float(rgb[1])/255
-        b = float(rgb[2])/255
-        self.canvas.setStrokeColorRGB(r, g, b)
+        rx = shape.radius_x * self.scale
+        ry = shape.radius_y * self.scale
+        rotation = (shape.rotation + self.panel.rotation) * -1
+        self.set_stroke_color(shape.rgb)
         # Don't draw if centre outside panel
-        if c['inPanel'] is False:
+        if not c['inPanel']:
             return
 
         # For rotation, we reset our coordinates around cx, cy
@@ -411,32 +1254,32 @@ class ShapeToPdfExport(object):
 class ShapeToPilExport(object):
     """
     Class for drawing panel shapes onto a PIL image.
-    We get a PIL image, the panel dict, and crop coordinates
+    We get a PIL image and the Panel, and the dpi of the export
     """
 
-    def __init__(self, pil_img, panel, crop):
+    def __init__(self, pil_img, panel, dpi=EXPORT_DPI):
 
         self.pil_img = pil_img
         self.panel = panel
+        self.dpi = dpi
         # The crop region on the original image coordinates...
-        self.crop = crop
-        self.scale = pil_img.size[0] / crop['width']
+        self.crop = panel.crop
+        self.scale = pil_img.size[0] / panel.crop['width']
         self.draw = ImageDraw.Draw(pil_img)
 
-        if "shapes" in panel:
-            for shape in panel["shapes"]:
-                if shape['type'] == "Arrow":
-                    self.draw_arrow(shape)
-                elif shape['type'] == "Line":
-                    self.draw_line(shape)
-                elif shape['type'] == "Rectangle":
-                    self.draw_rectangle(shape)
-                elif shape['type'] == "Ellipse":
-                    self.draw_ellipse(shape)
-                elif shape['type'] == "Polygon":
-                    self.draw_polygon(shape)
-                elif shape['type'] == "Polyline":
-                    self.draw_polyline(shape)
+        for shape in panel.shapes:
+            if shape.type == "Arrow":
+                self.draw_arrow(shape)
+            elif shape.type == "Line":
+                self.draw_line(shape)
+            elif shape.type == "Rectangle":
+                self.draw_rectangle(shape)
+            elif shape.type == "Ellipse":
+                self.draw_ellipse(shape)
+            elif shape.type == "Polygon":
+                self.draw_polygon(shape)
+            elif shape.type == "Polyline":
+                self.draw_polyline(shape)
 
     def get_panel_coords(self, shape_x, shape_y):
         """
@@ -444,27 +1287,12 @@ class ShapeToPilExport(object):
         Handles zoom, offset & rotation of panel, rotating the
         x, y point around the centre of the cropped region
         and scaling appropriately
+        shape_x and shape_y may also be numpy arrays of points.
         """
-        rotation = self.panel['rotation']
+        rotation = self.panel.rotation
         if rotation != 0:
-            # img coords: centre of rotation
-            cx = self.crop['x'] + (self.crop['width']/2)
-            cy = self.crop['y'] + (self.crop['height']/2)
-            dx = cx - shape_x
-            dy = cy - shape_y
-            # distance of point from centre of rotation
-            h = sqrt(dx * dx + dy * dy)
-            # and the angle
-            angle1 = atan2(dx, dy)
-
-            # Add the rotation to the angle and calculate new
-            # opposite and adjacent lengths from centre of rotation
-            angle2 = angle1 - radians(rotation)
-            newo = sin(angle2) * h
-            newa = cos(angle2) * h
-            # to give correct x and y within cropped panel
-            shape_x = cx - newo
-            shape_y = cy - newa
+            shape_x, shape_y = rotate_points(shape_x, shape_y, self.crop,
+                                             rotation)
 
         # convert to coords within crop region
         shape_x = (shape_x - self.crop['x']) * self.scale
@@ -474,16 +1302,16 @@ class ShapeToPilExport(object):
 
     def draw_arrow(self, shape):
 
-        start = self.get_panel_coords(shape['x1'], shape['y1'])
-        end = self.get_panel_coords(shape['x2'], shape['y2'])
+        start = self.get_panel_coords(shape.x1, shape.y1)
+        end = self.get_panel_coords(shape.x2, shape.y2)
         x1 = start['x']
         y1 = start['y']
         x2 = end['x']
         y2 = end['y']
-        head_size = ((shape['strokeWidth'] * 4) + 5)
-        head_size = scale_to_export_dpi(head_size)
-        stroke_width = scale_to_export_dpi(shape.get('strokeWidth', 2))
-        rgb = ShapeToPdfExport.get_rgb(shape['strokeColor'])
+        head_size = ((shape.stroke_width * 4) + 5)
+        head_size = scale_to_export_dpi(head_size, self.dpi)
+        stroke_width = scale_to_export_dpi(shape.stroke_width, self.dpi)
+        rgb = shape.rgb
 
         # Do some trigonometry to get the line angle can calculate arrow points
         dx = x2 - x1
@@ -516,20 +1344,15 @@ class ShapeToPilExport(object):
         self.draw.polygon(points, fill=rgb, outline=rgb)
 
     def draw_polygon(self, shape, closed=True):
-        points = []
-        for point in shape['points'].split(" "):
-            # Older polygons/polylines may be 'x,y,'
-            xy = point.split(",")
-            x = xy[0]
-            y = xy[1]
-            coords = self.get_panel_coords(float(x), float(y))
-            points.append((coords['x'], coords['y']))
+        # All points at once
+        coords = self.get_panel_coords(shape.points[:, 0], shape.points[:, 1])
+        points = zip(coords['x'].tolist(), coords['y'].tolist())
 
         if closed:
             points.append(points[0])
 
-        stroke_width = scale_to_export_dpi(shape.get('strokeWidth', 2))
-        rgb = ShapeToPdfExport.get_rgb(shape['strokeColor'])
+        stroke_width = scale_to_export_dpi(shape.stroke_width, self.dpi)
+        rgb = shape.rgb
         # Draw all the lines (NB: polygon doesn't handle line width)
         self.draw.line(points, fill=rgb, width=int(round(stroke_width)))
         # Draw ellipse at each corner
@@ -547,34 +1370,34 @@ class ShapeToPilExport(object):
         self.draw_polygon(shape, False)
 
     def draw_line(self, shape):
-        start = self.get_panel_coords(shape['x1'], shape['y1'])
-        end = self.get_panel_coords(shape['x2'], shape['y2'])
+        start = self.get_panel_coords(shape.x1, shape.y1)
+        end = self.get_panel_coords(shape.x2, shape.y2)
         x1 = start['x']
         y1 = start['y']
         x2 = end['x']
         y2 = end['y']
-        stroke_width = scale_to_export_dpi(shape.get('strokeWidth', 2))
-        rgb = ShapeToPdfExport.get_rgb(shape['strokeColor'])
+        stroke_width = scale_to_export_dpi(shape.stroke_width, self.dpi)
+        rgb = shape.rgb
 
         self.draw.line([(x1, y1), (x2, y2)], fill=rgb, width=int(stroke_width))
 
     def draw_rectangle(self, shape):
         # clockwise list of corner points on the OUTSIDE of thick line
-        w = scale_to_export_dpi(shape.get('strokeWidth', 2))
-        cx = shape['x'] + (shape['width']/2)
-        cy = shape['y'] + (shape['height']/2)
-        rotation = self.panel['rotation'] * -1
+        w = scale_to_export_dpi(shape.stroke_width, self.dpi)
+        cx = shape.x + (shape.width/2)
+        cy = shape.y + (shape.height/2)
+        rotation = self.panel.rotation * -1
 
         # Centre of rect rotation in PIL image
         centre = self.get_panel_coords(cx, cy)
         cx = centre['x']
         cy = centre['y']
         scale_w = w
-        rgb = ShapeToPdfExport.get_rgb(shape['strokeColor'])
+        rgb = shape.rgb
 
         # To support rotation, draw rect on temp canvas, rotate and paste
-        width = int((shape['width'] * self.scale) + w)
-        height = int((shape['height'] * self.scale) + w)
+        width = int((shape.width * self.scale) + w)
+        height = int((shape.height * self.scale) + w)
         temp_rect = Image.new('RGBA', (width, height), (255, 255, 255, 0))
         rect_draw = ImageDraw.Draw(temp_rect)
 
@@ -593,14 +1416,14 @@ class ShapeToPilExport(object):
 
     def draw_ellipse(self, shape):
 
-        w = int(scale_to_export_dpi(shape.get('strokeWidth', 2)))
-        ctr = self.get_panel_coords(shape['x'], shape['y'])
+        w = int(scale_to_export_dpi(shape.stroke_width, self.dpi))
+        ctr = self.get_panel_coords(shape.x, shape.y)
         cx = ctr['x']
         cy = ctr['y']
-        rx = self.scale * shape['radiusX']
-        ry = self.scale * shape['radiusY']
-        rotation = (shape['rotation'] + self.panel['rotation']) * -1
-        rgb = ShapeToPdfExport.get_rgb(shape['strokeColor'])
+        rx = self.scale * shape.radius_x
+        ry = self.scale * shape.radius_y
+        rotation = (shape.rotation + self.panel.rotation) * -1
+        rgb = shape.rgb
 
         width = int((rx * 2) + w)
         height = int((ry * 2) + w)
@@ -625,20 +1448,35 @@ class FigureExport(object):
     Super class for exporting various figures, such as PDF or TIFF etc.
     """
 
-    def __init__(self, conn, script_params, export_images=False):
+    def __init__(self, conn, script_params, export_images=False,
+                 memory_budget=None, export_dpi=None):
 
         self.conn = conn
         self.script_params = script_params
         self.export_images = export_images
+        # Resolution of raster exports.  Panel images are requested
+        # from the server at no more resolution than needed for it.
+        # None for PDF, where images keep their resolution.
+        if export_dpi is not None and (int(export_dpi) != export_dpi
+                                       or export_dpi <= 0):
+            raise ValueError("export dpi must be a positive integer, not %s"
+                             % export_dpi)
+        self.export_dpi = export_dpi
+        # Maximum number of bytes for the images of a page (None is
+        # no limit).  Checked before allocating, so that a figure
+        # that is too large fails early instead of exhausting memory.
+        self.memory_budget = memory_budget
 
         self.ns = "omero.web.figure.pdf"
         self.mimetype = "application/pdf"
 
-        figure_json_string = script_params['Figure_JSON']
-        # Since unicode can't be wrapped by rstring
-        figure_json_string = figure_json_string.decode('utf8')
+        figure_json = script_params['Figure_JSON']
+        # Batch scripts may give the figure already parsed
+        if isinstance(figure_json, basestring):
+            # Since unicode can't be wrapped by rstring
+            figure_json = json.loads(figure_json.decode('utf8'))
         self.figure_json = self.version_transform_json(
-            self._fix_figure_json(json.loads(figure_json_string)))
+            self._fix_figure_json(figure_json))
 
         n = datetime.now()
         # time-stamp name by default: Figure_2013-10-29_22-43-53.pdf
@@ -650,6 +1488,18 @@ class FigureExport(object):
         # get Figure width & height...
         self.page_width = self.figure_json['paper_width']
         self.page_height = self.figure_json['paper_height']
+        # page_color may be null in the JSON
+        self.page_color = (self.figure_json.get('page_color')
+                           or 'ffffff').lower()
+        self.panels = parse_panels(self.figure_json)
+
+        # Figures repeat the same few label texts and styles, so
+        # converted text, styles and paragraphs are reused.
+        self._label_html = {}
+        self._label_styles = {}
+        self._label_paragraphs = {}
+        self.render_plan = None
+        self.thumbnail_cache = None
 
     def _fix_figure_json(self, figure_json):
         """Ensure that the figure JSON is proper.
@@ -675,7 +1525,7 @@ class FigureExport(object):
                 # update strokeWidth to page pixels/coords instead of
                 # image pixels. Scale according to size of panel and zoom
                 if p.get('shapes') and len(p['shapes']) > 0:
-                    image_pixels_width = self.get_crop_region(p)['width']
+                    image_pixels_width = get_crop_region(p)['width']
                     page_coords_width = float(p.get('width'))
                     stroke_width_scale = page_coords_width/image_pixels_width
                     for shape in p['shapes']:
@@ -733,23 +1583,42 @@ class FigureExport(object):
         # Remove commas: causes problems 'duplicate headers' in file download
         full_name = full_name.replace(",", ".")
 
-        index = page if page is not None else 1
+        first_index = page if page is not None else 1
         if fext == "tiff" and self.page_count > 1:
-            full_name = "%s_page_%02d.%s" % (name, index, fext)
-        if self.zip_folder_name is not None:
-            full_name = os.path.join(self.zip_folder_name, full_name)
-
-        while(os.path.exists(full_name)):
+            full_name = "%s_page_%02d.%s" % (name, first_index, fext)
+        first_name = full_name
+
+        def get_name(index):
+            if index == first_index:
+                return first_name
+            return "%s_page_%02d.%s" % (name, index, fext)
+
+        # Files are only written in our own temporary folder, or zip,
+        # so the names used are known without looking at the files.
+        index = first_index
+        while get_name(index) in self.file_names:
             index += 1
-            full_name = "%s_page_%02d.%s" % (name, index, fext)
-            if self.zip_folder_name is not None:
-                full_name = os.path.join(self.zip_folder_name, full_name)
+        full_name = get_name(index)
+        self.file_names.add(full_name)
+        # When zipping, the name is the name inside the zip
+        if self.figure_zip is None:
+            full_name = os.path.join(self.zip_folder_name, full_name)
 
         # Handy to know what the last created file is:
         self.figure_file_name = full_name
 
         return full_name
 
+    def should_create_zip(self):
+        """
+        Create a zip if we have multiple TIFF pages or we're exporting
+        Images.
+        """
+        if self.export_images:
+            return True
+        export_option = self.script_params['Export_Option']
+        return (self.page_count > 1) and (export_option.startswith("TIFF"))
+
     def __del__(self):
         if self.zip_folder_name is not None:
             shutil.rmtree(self.zip_folder_name)
@@ -774,61 +1643,72 @@ class FigureExport(object):
         page_col_count = ('page_col_count' in self.figure_json and
                           self.figure_json['page_col_count'] or 1)
 
-        # Create a zip if we have multiple TIFF pages or we're exporting Images
-        export_option = self.script_params['Export_Option']
-        create_zip = False
-        if self.export_images:
-            create_zip = True
-        if (self.page_count > 1) and (export_option.startswith("TIFF")):
-            create_zip = True
-
-        # somewhere to put PDF and images
+        # somewhere to put PDF and images.  When zipping, files are
+        # added to the zip as they are created, and only written here
+        # for as long as that takes.
         self.zip_folder_name = tempfile.mkdtemp()
-        if create_zip:
-            self.zip_folder_name = "figure"
-            if self.export_images:
-                for d in (ORIGINAL_DIR, RESAMPLED_DIR, FINAL_DIR):
-                    img_dir = os.path.join(self.zip_folder_name, d)
-                    os.mkdir(img_dir)
+        self.file_names = set()
+        self.figure_zip = None
+        if self.should_create_zip():
+            self.figure_zip = FigureZip(self.get_zip_name(),
+                                        self.zip_folder_name)
+
+        completed = False
+        try:
+            if self.figure_zip is not None and self.export_images:
                 self.add_read_me_file()
 
-        # Create the figure file(s)
-        self.create_figure()
+            panels = self.panels
+            image_ids = set()
 
-        panels_json = self.figure_json['panels']
-        image_ids = set()
+            # Find the panels of each page once, and which share a render
+            page_col_count = int(page_col_count)
+            page_panels = bucket_panels(panels, self.page_count,
+                                        page_col_count, self.page_width,
+                                        self.page_height, paper_spacing)
+            self.render_plan = RenderPlan(panels, page_panels,
+                                          self.get_render_cache_bytes(),
+                                          self.get_panel_target_size)
 
-        group_id = None
-        # We get our group from the first image
-        id1 = panels_json[0]['imageId']
-        group_id = self.conn.getObject("Image", id1).getDetails().group.id.val
+            # Create the figure file(s)
+            self.create_figure()
 
-        # For each page, add panels...
-        col = 0
-        row = 0
-        for p in range(self.page_count):
+            group_id = None
+            # We get our group from the first image
+            id1 = panels[0].image_id
+            group_id = self.conn.getObject("Image",
+                                           id1).getDetails().group.id.val
 
-            self.add_page_color()
+            # For each page, add panels...
+            for p in range(self.page_count):
 
-            px = col * (self.page_width + paper_spacing)
-            py = row * (self.page_height + paper_spacing)
-            page = {'x': px, 'y': py}
+                self.add_page_color()
 
-            self.add_panels_to_page(panels_json, image_ids, page)
+                col = p % page_col_count
+                row = p // page_col_count
+                px = col * (self.page_width + paper_spacing)
+                py = row * (self.page_height + paper_spacing)
+                page = {'x': px, 'y': py}
 
-            # complete page and save
-            self.save_page(p)
+                self.add_panels_to_page(page_panels[p], image_ids, page)
 
-            col = col + 1
-            if col >= page_col_count:
-                col = 0
-                row = row + 1
+                # complete page and save
+                self.save_page(p)
 
-        # Add thumbnails and links page
-#        self.add_info_page(panels_json)
+            self.render_plan = None
 
-        # Saves the completed figure file
-        self.save_figure()
+            # Add thumbnails and links page
+#            self.add_info_page(panels)
+
+            # Saves the completed figure file
+            self.save_figure()
+            self.flush_pages()
+            completed = True
+        finally:
+            if not completed:
+                self.discard_figure()
+        if self.figure_zip is not None:
+            self.figure_zip.close()
         return
 
 #        # PDF will get created in this group
@@ -838,17 +1718,32 @@ class FigureExport(object):
 
 #        return self.create_file_annotation(image_ids)
 
+    def discard_figure(self):
+        """
+        Cleans up after a failed export.  Waits for the pages still
+        being written, and removes the incomplete zip and the
+        temporary folder.
+        """
+        self.render_plan = None
+        try:
+            self.flush_pages()
+        except Exception:
+            # Already logged by the PageWriter
+            pass
+        if self.figure_zip is not None:
+            self.figure_zip.discard()
+            self.figure_zip = None
+        shutil.rmtree(self.zip_folder_name, ignore_errors=True)
+        self.zip_folder_name = None
+
     def create_file_annotation(self, image_ids):
         output_file = self.figure_file_name
         ns = self.ns
         mimetype = self.mimetype
 
-        if self.zip_folder_name is not None:
-            zip_name = self.get_zip_name()
-            # Recursively zip everything up
-            compress(zip_name, self.zip_folder_name)
-
-            output_file = zip_name
+        if self.figure_zip is not None:
+            # Everything was written to the zip as it was created
+            output_file = self.figure_zip.target
             ns = "omero.web.figure.zip"
             mimetype = "application/zip"
 
@@ -876,57 +1771,16 @@ class FigureExport(object):
 
     def apply_rdefs(self, image, channels):
         """ Apply the channel levels and colors to the image """
-        c_idxs = []
-        windows = []
-        colors = []
-        reverses = []
+        c_idxs = [c[0] for c in channels]
+        windows = [c[1] for c in channels]
+        colors = [c[2] for c in channels]
+        reverses = [c[3] for c in channels]
 
         # OMERO.figure doesn't support greyscale rendering
         image.setColorRenderingModel()
 
-        for i, c in enumerate(channels):
-            if c['active']:
-                c_idxs.append(i+1)
-                windows.append([c['window']['start'], c['window']['end']])
-                colors.append(c['color'])
-                reverses.append(c.get('reverseIntensity', False))
-
         image.setActiveChannels(c_idxs, windows, colors, reverses)
 
-    def get_crop_region(self, panel):
-        """
-        Gets the width and height in points/pixels for a panel in the
-        figure. This is at the 'original' figure / PDF coordinates
-        (E.g. before scaling for TIFF export)
-        """
-        zoom = float(panel['zoom'])
-        frame_w = panel['width']
-        frame_h = panel['height']
-        dx = panel['dx']
-        dy = panel['dy']
-        orig_w = panel['orig_width']
-        orig_h = panel['orig_height']
-
-        # need tile_x, tile_y, tile_w, tile_h
-
-        tile_w = orig_w / (zoom/100)
-        tile_h = orig_h / (zoom/100)
-
-        orig_ratio = float(orig_w) / orig_h
-        wh = float(frame_w) / frame_h
-
-        if abs(orig_ratio - wh) > 0.01:
-            # if viewport is wider than orig...
-            if (orig_ratio < wh):
-                tile_h = tile_w / wh
-            else:
-                tile_w = tile_h * wh
-
-        cropx = ((orig_w - tile_w)/2) - dx
-        cropy = ((orig_h - tile_h)/2) - dy
-
-        return {'x': cropx, 'y': cropy, 'width': tile_w, 'height': tile_h}
-
     def get_time_label_text(self, delta_t, format):
         """ Gets the text for 'live' time-stamp labels """
         # format of "secs" by default
@@ -948,177 +1802,122 @@ class FigureExport(object):
         """
         Add any Shapes
         """
-        if "shapes" not in panel:
+        if not panel.shapes:
             return
 
-        crop = self.get_crop_region(panel)
-        ShapeToPdfExport(self.figure_canvas, panel, page, crop,
-                         self.page_height)
-
-    def draw_labels(self, panel, page):
+        ShapeToPdfExport(self.figure_canvas, panel, page, self.page_height)
+
+    def get_label_text(self, panel, label):
+        """ Text of a label, or None for a time label without time """
+        if label.text is not None:
+            return label.text
+        the_t = panel.the_t
+        timestamps = panel.delta_t
+        if label.time == "index":
+            return str(the_t + 1)
+        elif timestamps and the_t < len(timestamps):
+            return self.get_time_label_text(timestamps[the_t], label.time)
+        return None
+
+    def layout_labels(self, panel, page):
         """
-        Add the panel labels to the page.
+        Returns the panel labels, as PlacedLabel, with their position
+        on the page.  The figure JSON is not modified.
         Here we calculate the position of labels but delegate
-        to self.draw_text() to actually place the labels on PDF/TIFF
+        to self.draw_text_batch() to actually place the labels on PDF/TIFF
         """
-        labels = panel['labels']
-        x = panel['x']
-        y = panel['y']
-        width = panel['width']
-        height = panel['height']
-
-        # Handle page offsets
-        x = x - page['x']
-        y = y - page['y']
-
+        x, y, width, height = panel.page_box(page)
         spacer = 5
 
-        # group by 'position':
-        positions = {'top': [], 'bottom': [], 'left': [],
-                     'leftvert': [], 'right': [],
-                     'topleft': [], 'topright': [],
-                     'bottomleft': [], 'bottomright': []}
-
-        for l in labels:
-            if 'text' not in l:
-                the_t = panel['theT']
-                timestamps = panel.get('deltaT')
-                if l.get('time') == "index":
-                    l['text'] = str(the_t + 1)
-                elif timestamps and panel['theT'] < len(timestamps):
-                    d_t = panel['deltaT'][the_t]
-                    l['text'] = self.get_time_label_text(d_t, l['time'])
-                else:
-                    continue
-
-            pos = l['position']
-            l['size'] = int(l['size'])   # make sure 'size' is number
+        # group by 'position', with the text, size and colour of
+        # each label resolved:
+        positions = {}
+        for l in panel.labels:
+            text = self.get_label_text(panel, l)
+            if text is None:
+                continue
+            pos = l.position
+            size = l.size
+            color = l.color
             # If page is black and label is black, make label white
-            page_color = self.figure_json.get('page_color', 'ffffff').lower()
-            label_color = l['color'].lower()
-            label_on_page = pos in ('left', 'right', 'top',
-                                    'bottom', 'leftvert')
-            if label_on_page:
-                if label_color == '000000' and page_color == '000000':
-                    l['color'] = 'ffffff'
-                if label_color == 'ffffff' and page_color == 'ffffff':
-                    l['color'] = '000000'
-            if pos in positions:
-                positions[pos].append(l)
-
-        def draw_lab(label, lx, ly, align='left'):
-            label_h = label['size']
-            color = label['color']
-            red = int(color[0:2], 16)
-            green = int(color[2:4], 16)
-            blue = int(color[4:6], 16)
-            fontsize = label['size']
-            rgb = (red, green, blue)
-            text = label['text']
-
-            self.draw_text(text, lx, ly, fontsize, rgb, align=align)
-            return label_h
-
-        # Render each position:
+            if pos in ('left', 'right', 'top', 'bottom', 'leftvert'):
+                if color == '000000' and self.page_color == '000000':
+                    color = 'ffffff'
+                if color == 'ffffff' and self.page_color == 'ffffff':
+                    color = '000000'
+            rgb = (int(color[0:2], 16), int(color[2:4], 16),
+                   int(color[4:6], 16))
+            positions.setdefault(pos, []).append((text, size, rgb))
+
+        placed = []
+
+        def stack_down(labels, lx, ly, align):
+            for text, size, rgb in labels:
+                placed.append(PlacedLabel(text, lx, ly, size, rgb, align))
+                ly += size + spacer
+
+        def stack_up(labels, lx, ly, align):
+            # last item goes bottom
+            for text, size, rgb in reversed(labels):
+                ly = ly - size - spacer
+                placed.append(PlacedLabel(text, lx, ly, size, rgb, align))
+
+        def centre_y(labels):
+            total_h = sum([l[1] for l in labels]) + spacer * (len(labels)-1)
+            return y + (height-total_h)/2
+
         for key, labels in positions.items():
             if key == 'topleft':
-                lx = x + spacer
-                ly = y + spacer
-                for l in labels:
-                    label_h = draw_lab(l, lx, ly)
-                    ly += label_h + spacer
+                stack_down(labels, x + spacer, y + spacer, 'left')
             elif key == 'topright':
-                lx = x + width - spacer
-                ly = y + spacer
-                for l in labels:
-                    label_h = draw_lab(l, lx, ly, align='right')
-                    ly += label_h + spacer
+                stack_down(labels, x + width - spacer, y + spacer, 'right')
             elif key == 'bottomleft':
-                lx = x + spacer
-                ly = y + height
-                labels.reverse()  # last item goes bottom
-                for l in labels:
-                    ly = ly - l['size'] - spacer
-                    draw_lab(l, lx, ly)
+                stack_up(labels, x + spacer, y + height, 'left')
             elif key == 'bottomright':
-                lx = x + width - spacer
-                ly = y + height
-                labels.reverse()  # last item goes bottom
-                for l in labels:
-                    ly = ly - l['size'] - spacer
-                    draw_lab(l, lx, ly, align='right')
+                stack_up(labels, x + width - spacer, y + height, 'right')
             elif key == 'top':
-                lx = x + (width/2)
-                ly = y
-                labels.reverse()
-                for l in labels:
-                    ly = ly - l['size'] - spacer
-                    draw_lab(l, lx, ly, align='center')
+                stack_up(labels, x + (width/2), y, 'center')
             elif key == 'bottom':
-                lx = x + (width/2)
-                ly = y + height + spacer
-                for l in labels:
-                    label_h = draw_lab(l, lx, ly, align='center')
-                    ly += label_h + spacer
+                stack_down(labels, x + (width/2), y + height + spacer,
+                           'center')
             elif key == 'left':
-                lx = x - spacer
-                sizes = [l['size'] for l in labels]
-                total_h = sum(sizes) + spacer * (len(labels)-1)
-                ly = y + (height-total_h)/2
-                for l in labels:
-                    label_h = draw_lab(l, lx, ly, align='right')
-                    ly += label_h + spacer
+                stack_down(labels, x - spacer, centre_y(labels), 'right')
             elif key == 'right':
-                lx = x + width + spacer
-                sizes = [l['size'] for l in labels]
-                total_h = sum(sizes) + spacer * (len(labels)-1)
-                ly = y + (height-total_h)/2
-                for l in labels:
-                    label_h = draw_lab(l, lx, ly)
-                    ly += label_h + spacer
+                stack_down(labels, x + width + spacer, centre_y(labels),
+                           'left')
             elif key == 'leftvert':
                 lx = x - spacer
                 ly = y + (height/2)
-                labels.reverse()
-                for l in labels:
-                    lx = lx - l['size'] - spacer
-                    draw_lab(l, lx, ly, align='vertical')
+                for text, size, rgb in reversed(labels):
+                    lx = lx - size - spacer
+                    placed.append(PlacedLabel(text, lx, ly, size, rgb,
+                                              'vertical'))
+        return placed
 
-    def draw_scalebar(self, panel, region_width, page):
+    def draw_scalebar(self, panel, page):
         """
         Add the scalebar to the page.
         Here we calculate the position of scalebar but delegate
         to self.draw_line() and self.draw_text() to actually place
         the scalebar and label on PDF/TIFF
         """
-        x = panel['x']
-        y = panel['y']
-        width = panel['width']
-        height = panel['height']
-
         # Handle page offsets
-        x = x - page['x']
-        y = y - page['y']
+        x, y, width, height = panel.page_box(page)
 
-        if not ('scalebar' in panel and 'show' in panel['scalebar'] and
-                panel['scalebar']['show']):
+        sb = panel.scalebar
+        if sb is None or not sb.show:
             return
 
-        if not ('pixel_size_x' in panel and panel['pixel_size_x'] > 0):
+        if not (panel.pixel_size_x is not None and panel.pixel_size_x > 0):
             v = "Can't show scalebar - pixel_size_x is not defined for panel"
             logger.error(v)
             return
 
-        sb = panel['scalebar']
-
         spacer = 0.05 * max(height, width)
 
-        color = sb['color']
-        red = int(color[0:2], 16)
-        green = int(color[2:4], 16)
-        blue = int(color[4:6], 16)
+        red, green, blue = sb.rgb
 
-        position = 'position' in sb and sb['position'] or 'bottomright'
+        position = sb.position
         align = 'left'
 
         if position == 'topleft':
@@ -1136,9 +1935,10 @@ class FigureExport(object):
             ly = y + height - spacer
             align = "right"
 
-        pixels_length = sb['length'] / panel['pixel_size_x']
-        scale_to_canvas = panel['width'] / float(region_width)
-        canvas_length = pixels_length * scale_to_canvas
+        # Scale from image pixels, not from the panel image which may
+        # already be resampled to the figure or a big image zoom level.
+        pixels_length = sb.length / panel.pixel_size_x
+        canvas_length = pixels_length * panel.scale
 
         if align == 'left':
             lx_end = lx + canvas_length
@@ -1147,16 +1947,9 @@ class FigureExport(object):
 
         self.draw_line(lx, ly, lx_end, ly, 3, (red, green, blue))
 
-        if 'show_label' in sb and sb['show_label']:
-            symbol = u"\u00B5m"
-            if 'pixel_size_x_symbol' in panel:
-                symbol = panel['pixel_size_x_symbol']
-            label = "%s %s" % (sb['length'], symbol)
-            font_size = 10
-            try:
-                font_size = int(sb.get('font_size'))
-            except Exception:
-                pass
+        if sb.show_label:
+            label = "%s %s" % (sb.length, panel.pixel_size_x_symbol)
+            font_size = sb.font_size
 
             # For 'bottom' scalebar, put label above
             if 'bottom' in position:
@@ -1173,10 +1966,15 @@ class FigureExport(object):
         max_w, max_h = self.conn.getMaxPlaneSize()
         return image.getSizeX() * image.getSizeY() > max_w * max_h
 
-    def render_big_image_region(self, image, z, t, region, max_width):
+    def render_big_image_region(self, image, z, t, region, max_width,
+                                min_width=None):
         """
         Render region of a big image at an appropriate zoom level
-        so width < max_width
+        so width < max_width.  If the region is only needed min_width
+        pixels wide, the JPEG is decoded at a reduced size that is
+        still at least that wide.  Returns the PIL image and its
+        origin (see PlaneRender).  If the region is outside the image,
+        the image is None but the origin still has the scale.
         """
 
         size_x = image.getSizeX()
@@ -1200,6 +1998,11 @@ class FigureExport(object):
                zm_levels[zm] * width > max_width or
                zm_levels[zm] * width * zm_levels[zm] * height > max_plane):
             zm = zm + 1
+        # and further, while still at least min_width, so that the
+        # server scales down instead of sending what is not needed
+        if min_width is not None:
+            while zm < max_level and zm_levels[zm + 1] * width >= min_width:
+                zm = zm + 1
 
         level = max_level - zm
 
@@ -1213,55 +2016,65 @@ class FigureExport(object):
         size_x = int(size_x * scale)
         size_y = int(size_y * scale)
 
-        canvas = None
-        # Coordinates below are all final jpeg coordinates & sizes
-        if x < 0 or y < 0 or (x + width) > size_x or (y + height) > size_y:
-            # If we're outside the bounds of the image...
-            # Need to render reduced region and paste on to full size image
-            canvas = Image.new("RGBA", (width, height), (221, 221, 221))
-            paste_x = 0
-            paste_y = 0
-            if x < 0:
-                paste_x = -x
-                width = width + x
-                x = 0
-            if y < 0:
-                paste_y = -y
-                height = height + y
-                y = 0
+        # Coordinates below are all final jpeg coordinates & sizes.
+        # Only render the part inside the image, what is outside is
+        # filled with background when the panel is transformed.
+        if x < 0:
+            width = width + x
+            x = 0
+        if y < 0:
+            height = height + y
+            y = 0
+        width = min(width, size_x - x)
+        height = min(height, size_y - y)
+        if width <= 0 or height <= 0:
+            return None, (0, 0, scale)
 
         # Render the region...
         jpeg_data = image.renderJpegRegion(z, t, x, y, width, height,
                                            level=level)
         if jpeg_data is None:
-            return
+            return None, None
 
         i = StringIO(jpeg_data)
         pil_img = Image.open(i)
 
-        # paste to canvas if needed
-        if canvas is not None:
-            canvas.paste(pil_img, (paste_x, paste_y))
-            pil_img = canvas
+        # Let the JPEG decoder scale down by 1/2, 1/4, or 1/8 if the
+        # region is rendered larger than needed.  Must be before load.
+        draft = 1.0
+        if min_width is not None and min_width < width:
+            min_height = int(ceil(min_width * float(height) / width))
+            pil_img.draft(pil_img.mode, (max(1, int(ceil(min_width))),
+                                         max(1, min_height)))
+            draft = float(pil_img.size[0]) / width
 
-        return pil_img
+        return pil_img, (x / scale, y / scale, scale * draft)
 
     def get_panel_big_image(self, image, panel):
-        """Render the viewport region for BIG images"""
+        """
+        Render the viewport region for BIG images.  Returns the PIL
+        image and its origin (see PlaneRender).
+        """
 
-        viewport_region = self.get_crop_region(panel)
-        rotation = int(panel.get('rotation', 0))
+        viewport_region = panel.crop
+        rotation = int(panel.rotation)
         vp_x = viewport_region['x']
         vp_y = viewport_region['y']
         vp_w = viewport_region['width']
         vp_h = viewport_region['height']
-        z = panel['theZ']
-        t = panel['theT']
+        z = panel.the_z
+        t = panel.the_t
 
         # E.g. target is 300 dpi and width & height is '72 dpi'
         # so we need image to be width * dpi/72 pixels
-        max_dpi = panel.get('max_export_dpi', 1000)
-        max_width = (panel['width'] * max_dpi) / 72
+        max_dpi = panel.max_export_dpi
+        max_width = (panel.width * max_dpi) / 72
+
+        # Width the viewport will be on the figure, if known
+        min_width = None
+        target_size = self.get_panel_target_size(panel)
+        if target_size is not None:
+            min_width = target_size[0]
 
         # Render a larger region than viewport, to allow for rotation...
         if rotation != 0:
@@ -1273,181 +2086,148 @@ class FigureExport(object):
                                'width': vp_w + extra_w,
                                'height': vp_h + extra_h}
             max_width = max_width * (viewport_region['width'] / vp_w)
+            if min_width is not None:
+                min_width = min_width * (viewport_region['width'] / vp_w)
 
-        pil_img = self.render_big_image_region(image, z, t, viewport_region,
-                                               max_width)
+        return self.render_big_image_region(image, z, t, viewport_region,
+                                            max_width, min_width)
 
-        # Optional rotation
-        if rotation != 0 and pil_img is not None:
-            w, h = pil_img.size
-            # How much smaller is the scaled image compared to viewport?
-            # This will be the same 'scale' used in render_big_image_region()
-            scale = float(w) / viewport_region['width']
-            # The size we want to crop to
-            crop_target_w = scale * vp_w
-            crop_target_h = scale * vp_h
+    def get_render_cache_bytes(self):
+        """ Bytes for renders shared between panels, None for no limit """
+        return self.memory_budget
 
-            # Now we can rotate...
-            pil_img = pil_img.rotate(-rotation, Image.BICUBIC, expand=1)
-            rot_w, rot_h = pil_img.size
+    def render_panel(self, panel):
+        """
+        Gets the rendered image from OMERO, as a PlaneRender, or None
+        if there's no such image.  The whole plane is rendered, except
+        for big images, and shared with the other panels of the same
+        plane (see RenderPlan).
+        """
+        key = render_key(panel)
+        plane = self.render_plan.take(key)
+        if plane is not None:
+            return plane
 
-            # ...and crop all round (keep same centre point)
-            crop_left = int((rot_w - crop_target_w) / 2)
-            crop_top = int((rot_h - crop_target_h) / 2)
-            crop_right = rot_w - crop_left
-            crop_bottom = rot_h - crop_top
+        image = self.conn.getObject("Image", panel.image_id)
+        if image is None:
+            return None
+        try:
+            self.apply_rdefs(image, panel.channels)
+            if panel.z_projection is not None:
+                image.setProjection('intmax')
+                image.setProjectionRange(*panel.z_projection)
+
+            # If big image, we don't want to render the whole plane
+            is_big = self.is_big_image(image)
+            if is_big:
+                pil_img, origin = self.get_panel_big_image(image, panel)
+            else:
+                pil_img = image.renderImage(panel.the_z, panel.the_t,
+                                            compression=1.0)
+                origin = (0, 0, 1.0)
+                # If no panel needs the full resolution, e.g. when
+                # previewing, let the JPEG decoder scale down the plane.
+                scale = self.render_plan.render_scale(key)
+                if pil_img is not None and scale is not None and scale < 1:
+                    size_x = image.getSizeX()
+                    size_y = image.getSizeY()
+                    pil_img.draft(pil_img.mode,
+                                  (max(1, int(ceil(size_x * scale))),
+                                   max(1, int(ceil(size_y * scale)))))
+                    origin = (0, 0, float(pil_img.size[0]) / size_x)
+            plane = PlaneRender(image.getName(), image.canAnnotate(),
+                                image.getSizeX(), image.getSizeY(), is_big,
+                                origin, pil_img)
+        finally:
+            if image._re is not None:
+                image._re.close()
 
-            pil_img = pil_img.crop((crop_left, crop_top,
-                                    crop_right, crop_bottom))
+        # Big images are rendered for the panel viewport only
+        if not is_big and pil_img is not None:
+            self.render_plan.keep(key, plane)
+        return plane
 
-        return pil_img
+    def get_panel_target_size(self, panel):
+        """
+        Size in pixels that the panel image will have on the figure,
+        or None to keep the resolution of the rendered image.  PDF
+        figures only resample with a minimum dpi, see paste_image().
+        """
+        return None
 
-    def get_panel_image(self, image, panel, orig_name=None):
+    def get_panel_image(self, plane, panel, orig_name=None):
         """
-        Gets the rendered image from OMERO, then crops & rotates as needed.
+        Crops, rotates, and scales the rendered image as needed.
         Optionally saving original and cropped images as TIFFs.
-        Returns image as PIL image.
+        Returns image as PIL image, or None if there's no image.
         """
-        z = panel['theZ']
-        t = panel['theT']
-        size_x = image.getSizeX()
-        size_y = image.getSizeY()
-
-        if 'z_projection' in panel and panel['z_projection']:
-            if 'z_start' in panel and 'z_end' in panel:
-                image.setProjection('intmax')
-                image.setProjectionRange(panel['z_start'], panel['z_end'])
-
-        # If big image, we don't want to render the whole plane
-        if self.is_big_image(image):
-            pil_img = self.get_panel_big_image(image, panel)
-        else:
-            pil_img = image.renderImage(z, t, compression=1.0)
-
+        pil_img = plane.pil_img
+        # A big image without pixels but with an origin is a viewport
+        # outside the image, see render_big_image_region()
+        if pil_img is None and (not plane.is_big or plane.origin is None):
+            return None
+
+        size = self.get_panel_target_size(panel)
+        if size is None:
+            scale = plane.origin[2]
+            size = (max(1, int(round(panel.crop['width'] * scale))),
+                    max(1, int(round(panel.crop['height'] * scale))))
+
+        # Grey outside big images, like the figure editor
+        background = (255, 255, 255)
+        if plane.is_big:
+            background = (221, 221, 221)
         if pil_img is None:
-            return
+            return Image.new('RGB', size, background)
 
         if orig_name is not None:
-            pil_img.save(orig_name)
-
-        # big image will already be cropped...
-        if self.is_big_image(image):
-            return pil_img
-
-        # Need to crop around centre before rotating...
-        cx = size_x/2
-        cy = size_y/2
-        dx = panel['dx']
-        dy = panel['dy']
-
-        cx += dx
-        cy += dy
-
-        crop_left = 0
-        crop_top = 0
-        crop_right = size_x
-        crop_bottom = size_y
-
-        # We 'inverse crop' to make the image bigger, centred by dx, dy.
-        # This is really only needed for rotation, but also gets us centered...
-        if dx > 0:
-            crop_left = int(dx * -2)
-        else:
-            crop_right = crop_right - int(dx * 2)
-        if dy > 0:
-            crop_top = int(dy * -2)
-        else:
-            crop_bottom = crop_bottom - int(dy * 2)
-
-        # convert to RGBA so we can control background after crop/rotate...
-        # See http://stackoverflow.com/questions/5252170/
-        mde = pil_img.mode
-        pil_img = pil_img.convert('RGBA')
-        pil_img = pil_img.crop((crop_left, crop_top, crop_right, crop_bottom))
-
-        # Optional rotation
-        if ('rotation' in panel and panel['rotation'] > 0):
-            rotation = -int(panel['rotation'])
-            pil_img = pil_img.rotate(rotation, Image.BICUBIC)
-
-        # Final crop to size
-        panel_size = self.get_crop_region(panel)
-
-        w, h = pil_img.size
-        tile_w = panel_size['width']
-        tile_h = panel_size['height']
-        crop_left = int((w - tile_w) / 2)
-        crop_top = int((h - tile_h) / 2)
-        crop_right = w - crop_left
-        crop_bottom = h - crop_top
+            self.save_export_image(pil_img, orig_name)
 
-        pil_img = pil_img.crop((crop_left, crop_top, crop_right, crop_bottom))
+        return transform_panel_image(pil_img, plane.origin, panel.crop,
+                                     panel.rotation, size, background)
 
-        # ...paste image with transparent blank areas onto white background
-        fff = Image.new('RGBA', pil_img.size, (255, 255, 255, 255))
-        out = Image.composite(pil_img, fff, pil_img)
-        # and convert back to original mode
-        out.convert(mde)
-
-        return out
+    def get_panel_image_name(self, plane, idx):
+        """ Name for the panel images, when exporting images """
+        return "%s_%s.tiff" % (idx, os.path.basename(plane.name))
 
     def draw_panel(self, panel, page, idx):
         """
         Gets the image from OMERO, processes (and saves) it then
         calls self.paste_image() to add it to PDF or TIFF figure.
         """
-        image_id = panel['imageId']
-        channels = panel['channels']
-        x = panel['x']
-        y = panel['y']
-
-        # Handle page offsets
-        x = x - page['x']
-        y = y - page['y']
-
-        image = self.conn.getObject("Image", image_id)
-        if image is None:
+        plane = self.render_panel(panel)
+        if plane is None:
             return None, None
 
-        try:
-            self.apply_rdefs(image, channels)
-
-            # create name to save image
-            original_name = image.getName()
-            img_name = os.path.basename(original_name)
-            img_name = "%s_%s.tiff" % (idx, img_name)
-
-            # get cropped image (saving original)
-            orig_name = None
-            if self.export_images:
-                orig_name = os.path.join(
-                    self.zip_folder_name, ORIGINAL_DIR, img_name)
-            pil_img = self.get_panel_image(image, panel, orig_name)
-        finally:
-            if image._re is not None:
-                image._re.close()
+        # create name to save image
+        img_name = self.get_panel_image_name(plane, idx)
+
+        # get cropped image (saving original)
+        orig_name = None
+        if self.export_images:
+            orig_name = os.path.join(ORIGINAL_DIR, img_name)
+        pil_img = self.get_panel_image(plane, panel, orig_name)
+        if pil_img is None:
+            return plane, None
 
         # for PDF export, we might have a target dpi
-        dpi = panel.get('min_export_dpi', None)
+        dpi = panel.min_export_dpi
 
         # Paste the panel to PDF or TIFF image
         self.paste_image(pil_img, img_name, panel, page, dpi)
 
-        return image, pil_img
+        return plane, pil_img
 
-    def get_thumbnail(self, image_id):
-        """ Saves thumb as local jpg and returns name """
-
-        conn = self.conn
-        image = conn.getObject("Image", image_id)
-        if image is None:
-            return
-        thumb_data = image.getThumbnail(size=(96, 96))
-        i = StringIO(thumb_data)
-        pil_img = Image.open(i)
-        temp_name = str(image_id) + "thumb.jpg"
-        pil_img.save(temp_name)
-        return temp_name
+    def get_thumbnails(self, image_ids):
+        """
+        Returns dict of image id to thumbnail, as ImageReader for
+        drawing in the PDF without a temporary file.
+        """
+        if self.thumbnail_cache is None:
+            self.thumbnail_cache = ThumbnailCache()
+        thumbs = self.thumbnail_cache.get_thumbnails(self.conn, image_ids)
+        return dict([(image_id, ImageReader(StringIO(thumb_data)))
+                     for image_id, thumb_data in thumbs.items()])
 
     def add_para_with_thumb(self, text, page_y, style, thumb_src=None):
         """ Adds paragraph text to point on PDF info page """
@@ -1483,11 +2263,35 @@ class FigureExport(object):
 
     def add_read_me_file(self):
         """ Add a simple text file into the zip to explain what's there """
-        read_me_path = os.path.join(self.zip_folder_name, "README.txt")
-        with open(read_me_path, 'w') as f:
-            f.write(README_TXT)
+        self.figure_zip.write_str(README_TXT, "README.txt")
+
+    def save_export_image(self, pil_img, archive_name):
+        """
+        Saves one of the images used to create the figure (see
+        README_TXT) into the zip.  Only used when exporting images.
+        """
+        self.figure_zip.write_image(pil_img, archive_name)
+
+    def open_canvas(self, name):
+        """
+        Starts a new PDF canvas for the file name.  When zipping, the
+        PDF is written to a temporary file until close_canvas() adds
+        it to the zip.
+        """
+        self.canvas_name = name
+        self.canvas_fpath = name
+        if self.figure_zip is not None:
+            self.canvas_fpath = self.figure_zip.get_temp_file_name(name)
+        self.figure_canvas = canvas.Canvas(
+            self.canvas_fpath, pagesize=(self.page_width, self.page_height))
+
+    def close_canvas(self):
+        """ Completes the PDF canvas started with open_canvas() """
+        self.figure_canvas.save()
+        if self.figure_zip is not None:
+            self.figure_zip.write_file(self.canvas_fpath, self.canvas_name)
 
-    def add_info_page(self, panels_json):
+    def add_info_page(self, panels):
         """Generates a PDF info page with figure title, links to images etc"""
         script_params = self.script_params
         figure_name = self.figure_name
@@ -1497,7 +2301,7 @@ class FigureExport(object):
         page_height = self.page_height
 
         # Need to sort panels from top (left) -> bottom of Figure
-        panels_json.sort(key=lambda x: int(x['y']) + x['y'] * 0.01)
+        panels = sorted(panels, key=lambda x: int(x.y) + x.y * 0.01)
 
         img_ids = set()
         styles = getSampleStyleSheet()
@@ -1542,24 +2346,24 @@ class FigureExport(object):
         page_y = self.add_para_with_thumb(
             "Figure contains the following images:", page_y, style=style_h3)
 
+        # Thumbnails of all images at once
+        thumbs = self.get_thumbnails(set([p.image_id for p in panels]))
+
         # Go through sorted panels, adding paragraph for each unique image
-        for p in panels_json:
-            iid = p['imageId']
+        for p in panels:
+            iid = p.image_id
             # list unique scalebar lengths
-            if 'scalebar' in p:
-                sb_length = p['scalebar']['length']
-                symbol = u"\u00B5m"
-                if 'pixel_size_x_symbol' in p:
-                    symbol = p['pixel_size_x_symbol']
-                scalebars.append("%s %s" % (sb_length, symbol))
+            if p.scalebar is not None:
+                scalebars.append("%s %s" % (p.scalebar.length,
+                                            p.pixel_size_x_symbol))
             if iid in img_ids:
                 continue    # ignore images we've already handled
             img_ids.add(iid)
-            thumb_src = self.get_thumbnail(iid)
+            thumb_src = thumbs.get(iid)
             # thumb = "<img src='%s' width='%s' height='%s' " \
             #         "valign='middle' />" % (thumbSrc, thumbSize, thumbSize)
             lines = []
-            lines.append(p['name'])
+            lines.append(p.name)
             img_url = "%s?show=image-%s" % (base_url, iid)
             lines.append(
                 "<a href='%s' color='blue'>%s</a>" % (img_url, img_url))
@@ -1576,41 +2380,29 @@ class FigureExport(object):
                 "Scalebar Lengths: %s" % ", ".join(scalebars),
                 page_y, style=style_n)
 
-    def panel_is_on_page(self, panel, page):
-        """ Return true if panel overlaps with this page """
-        px = panel['x']
-        px2 = px + panel['width']
-        py = panel['y']
-        py2 = py + panel['height']
-        cx = page['x']
-        cx2 = cx + self.page_width
-        cy = page['y']
-        cy2 = cy + self.page_height
-        # overlap needs overlap on x-axis...
-        return px < cx2 and cx < px2 and py < cy2 and cy < py2
-
-    def add_panels_to_page(self, panels_json, image_ids, page):
-        """ Add panels that are within the bounds of this page """
-        for i, panel in enumerate(panels_json):
-
-            if not self.panel_is_on_page(panel, page):
-                continue
+    def add_panels_to_page(self, panel_idxs, image_ids, page):
+        """ Add panels, by index, that are within the bounds of this page """
+        for i in panel_idxs:
+            panel = self.panels[i]
 
-            image_id = panel['imageId']
+            image_id = panel.image_id
             # draw_panel() creates PIL image then applies it to the page.
             # For TIFF export, draw_panel() also adds shapes to the
             # PIL image before pasting onto the page...
-            image, pil_img = self.draw_panel(panel, page, i)
-            if image is None:
+            plane, pil_img = self.draw_panel(panel, page, i)
+            if plane is None:
                 continue
-            if image.canAnnotate():
+            # The panel is already on the page so release its buffer
+            # before rendering the next one.
+            del pil_img
+            if plane.can_annotate:
                 image_ids.add(image_id)
             # ... but for PDF we have to add shapes to the whole PDF page
             self.add_rois(panel, page)  # This does nothing for TIFF export
 
             # Finally, add scale bar and labels to the page
-            self.draw_scalebar(panel, pil_img.size[0], page)
-            self.draw_labels(panel, page)
+            self.draw_scalebar(panel, page)
+            self.draw_text_batch(self.layout_labels(panel, page))
 
     def get_figure_file_ext(self):
         return "pdf"
@@ -1623,8 +2415,7 @@ class FigureExport(object):
             raise ImportError(
                 "Need to install https://bitbucket.org/rptlab/reportlab")
         name = self.get_figure_file_name()
-        self.figure_canvas = canvas.Canvas(
-            name, pagesize=(self.page_width, self.page_height))
+        self.open_canvas(name)
 
     def add_page_color(self):
         """ Simply draw colored rectangle over whole current page."""
@@ -1646,24 +2437,58 @@ class FigureExport(object):
 
     def save_figure(self):
         """ Completes PDF figure (or info-page PDF for TIFF export) """
-        self.figure_canvas.save()
+        self.close_canvas()
 
-    def draw_text(self, text, x, y, fontsize, rgb, align="center"):
-        """ Adds text to PDF. Overwritten for TIFF below """
-        if markdown_imported:
-            # convert markdown to html
-            text = markdown.markdown(text)
+    def flush_pages(self):
+        """ Waits for pages still being written. Nothing to do for PDF """
+        pass
 
+    def get_label_html(self, text):
+        """ Label text converted from markdown to html, if possible """
+        html = self._label_html.get(text)
+        if html is None:
+            html = text
+            if markdown_imported:
+                # convert markdown to html
+                html = markdown.markdown(text)
+            self._label_html[text] = html
+        return html
+
+    def get_label_style(self, fontsize, rgb, alignment):
+        """ ParagraphStyle for labels, one per font size, colour and
+        alignment """
+        key = (fontsize, rgb, alignment)
+        style = self._label_styles.get(key)
+        if style is None:
+            red, green, blue = rgb
+            style = ParagraphStyle(
+                'label',
+                parent=getSampleStyleSheet()['Normal'],
+                alignment=alignment,
+                textColor=(float(red)/255, float(green)/255, float(blue)/255),
+                fontSize=fontsize)
+            self._label_styles[key] = style
+        return style
+
+    def get_label_paragraph(self, text, fontsize, rgb, alignment, width):
+        """ Returns wrapped Paragraph for a label and its height """
+        key = (text, fontsize, rgb, alignment, width)
+        para_h = self._label_paragraphs.get(key)
+        if para_h is None:
+            style = self.get_label_style(fontsize, rgb, alignment)
+            para = Paragraph(self.get_label_html(text), style)
+            w, h = para.wrap(width, self.page_height)   # find required space
+            para_h = (para, h)
+            self._label_paragraphs[key] = para_h
+        return para_h
+
+    def draw_label_paragraph(self, text, x, y, fontsize, rgb, align):
+        """ Draws a label at page coordinates x, y (from the top).
+        Vertical labels expect the canvas to be rotated by 90. """
         y = self.page_height - y
-        c = self.figure_canvas
         # Needs to be wide enough to avoid wrapping
         para_width = self.page_width
 
-        red, green, blue = rgb
-        red = float(red)/255
-        green = float(green)/255
-        blue = float(blue)/255
-
         alignment = TA_LEFT
         if (align == "center"):
             alignment = TA_CENTER
@@ -1675,7 +2500,6 @@ class FigureExport(object):
             pass
         elif align == 'vertical':
             # Switch axes
-            c.rotate(90)
             px = x
             x = y
             y = -px
@@ -1683,21 +2507,31 @@ class FigureExport(object):
             alignment = TA_CENTER
             x = x - (para_width/2)
 
-        style_n = getSampleStyleSheet()['Normal']
-        style = ParagraphStyle(
-            'label',
-            parent=style_n,
-            alignment=alignment,
-            textColor=(red, green, blue),
-            fontSize=fontsize)
-
-        para = Paragraph(text, style)
-        w, h = para.wrap(para_width, y)   # find required space
-        para.drawOn(c, x, y - h + int(fontsize * 0.25))
+        para, h = self.get_label_paragraph(text, fontsize, rgb, alignment,
+                                           para_width)
+        para.drawOn(self.figure_canvas, x, y - h + int(fontsize * 0.25))
+
+    def draw_text_batch(self, labels):
+        """ Draws a list of PlacedLabel on the current page.
+        Overwritten for TIFF below """
+        vertical = []
+        for label in labels:
+            if label.align == 'vertical':
+                vertical.append(label)
+            else:
+                self.draw_label_paragraph(*label)
+        # All vertical labels with a single rotation of the canvas
+        if vertical:
+            c = self.figure_canvas
+            c.saveState()
+            c.rotate(90)
+            for label in vertical:
+                self.draw_label_paragraph(*label)
+            c.restoreState()
 
-        # Rotate back again
-        if align == 'vertical':
-            c.rotate(-90)
+    def draw_text(self, text, x, y, fontsize, rgb, align="center"):
+        """ Adds text to PDF. Overwritten for TIFF below """
+        self.draw_text_batch([PlacedLabel(text, x, y, fontsize, rgb, align)])
 
     def draw_line(self, x, y, x2, y2, width, rgb):
         """ Adds line to PDF. Overwritten for TIFF below """
@@ -1716,13 +2550,8 @@ class FigureExport(object):
     def paste_image(self, pil_img, img_name, panel, page, dpi):
         """ Adds the PIL image to the PDF figure. Overwritten for TIFFs """
 
-        x = panel['x']
-        y = panel['y']
-        width = panel['width']
-        height = panel['height']
         # Handle page offsets
-        x = x - page['x']
-        y = y - page['y']
+        x, y, width, height = panel.page_box(page)
 
         if dpi is not None:
             # E.g. target is 300 dpi and width & height is '72 dpi'
@@ -1736,20 +2565,19 @@ class FigureExport(object):
             if target_w > curr_w:
                 if self.export_images:
                     # Save image BEFORE resampling
-                    rs_name = os.path.join(
-                        self.zip_folder_name, RESAMPLED_DIR, img_name)
-                    pil_img.save(rs_name)
+                    self.save_export_image(
+                        pil_img, os.path.join(RESAMPLED_DIR, img_name))
                 pil_img = pil_img.resize((target_w, target_h), Image.BICUBIC)
 
-        # in the folder to zip
-        if self.zip_folder_name is not None:
-            img_name = os.path.join(self.zip_folder_name, FINAL_DIR, img_name)
+        if self.export_images:
+            self.save_export_image(pil_img, os.path.join(FINAL_DIR, img_name))
 
-        # Save Image to file, then bring into PDF
-        pil_img.save(img_name)
         # Since coordinate system is 'bottom-up', convert from 'top-down'
         y = self.page_height - height - y
-        self.figure_canvas.drawImage(img_name, x, y, width, height)
+        # Drawn from memory, without saving to a file.  reportlab
+        # already stores identical images only once in the PDF.
+        self.figure_canvas.drawImage(ImageReader(pil_img), x, y,
+                                     width, height)
 
 
 class TiffExport(FigureExport):
@@ -1759,9 +2587,39 @@ class TiffExport(FigureExport):
     the TIFF instead of PDF.
     """
 
-    def __init__(self, conn, script_params, export_images=None):
-
-        super(TiffExport, self).__init__(conn, script_params, export_images)
+    # Pages that don't fit in the memory budget can be drawn and
+    # written in strips.  Only for uncompressed TIFF files, subclasses
+    # that save pages otherwise must set this to False.
+    can_write_strips = True
+
+    def __init__(self, conn, script_params, export_images=None,
+                 memory_budget=None, page_writer=None,
+                 tiff_compression=None, export_dpi=EXPORT_DPI):
+
+        super(TiffExport, self).__init__(conn, script_params, export_images,
+                                         memory_budget, export_dpi)
+
+        # With a compression (see TIFF_COMPRESSIONS) TIFF pages are
+        # saved tiled and pyramidal instead of flat and uncompressed.
+        if (tiff_compression is not None
+                and tiff_compression not in TIFF_COMPRESSIONS):
+            raise ValueError("unknown TIFF compression '%s'"
+                             % tiff_compression)
+        if tiff_compression is not None and not tifffile_installed:
+            logger.error("tifffile not installed, TIFFs will not be"
+                         " pyramidal.  See https://pypi.org/project/tifffile")
+            tiff_compression = None
+        self.tiff_compression = tiff_compression
+
+        # When the page is drawn in strips, what to draw on it as
+        # (top row, bottom row, draw function, release function).
+        self.page_ops = None
+
+        # Pages are encoded and saved in the background by a
+        # PageWriter.  If one is given, it is shared with other
+        # exporters and it's up to the caller to close it.
+        self.page_writer = page_writer
+        self.own_page_writer = page_writer is None
 
         from omero.gateway import THISPATH
         self.GATEWAYPATH = THISPATH
@@ -1793,18 +2651,168 @@ class TiffExport(FigureExport):
     def get_figure_file_ext(self):
         return "tiff"
 
+    def scale_to_export_dpi(self, pixels):
+        return scale_to_export_dpi(pixels, self.export_dpi)
+
+    def get_panel_target_size(self, panel):
+        """
+        Panels are scaled to the figure dpi when they are cropped and
+        rotated.  Except when exporting the images, to keep one image
+        for each step.
+        """
+        if self.export_images:
+            return None
+        return (int(round(self.scale_to_export_dpi(panel.width))),
+                int(round(self.scale_to_export_dpi(panel.height))))
+
+    def get_strip_rows(self):
+        """
+        Number of page rows to draw at a time, or None to draw the
+        whole page at once.  Pages are drawn in strips if they would
+        take more than half of the memory budget and they are saved
+        to a TIFF file (not uploaded).
+        """
+        if self.memory_budget is None or not self.can_write_strips:
+            return None
+        tiff_width = int(self.scale_to_export_dpi(self.page_width))
+        tiff_height = int(self.scale_to_export_dpi(self.page_height))
+        if tiff_width * tiff_height * 4 <= self.memory_budget // 2:
+            return None
+        rows = (self.memory_budget // 8) // (tiff_width * 3)
+        if self.tiff_compression is not None:
+            # Pyramidal TIFFs are written in rows of whole tiles
+            rows = max(1, rows // TIFF_TILE_SIZE) * TIFF_TILE_SIZE
+        return max(1, min(tiff_height, rows))
+
+    def get_page_bytes(self):
+        """ Bytes of the page, or of one strip, being drawn """
+        tiff_width = int(self.scale_to_export_dpi(self.page_width))
+        strip_rows = self.get_strip_rows()
+        if strip_rows is not None:
+            return tiff_width * strip_rows * 3
+        tiff_height = int(self.scale_to_export_dpi(self.page_height))
+        return tiff_width * tiff_height * 4
+
+    def get_render_cache_bytes(self):
+        """ Renders shared between panels can use what the page doesn't """
+        if self.memory_budget is None:
+            return None
+        return max(0, self.memory_budget - self.get_page_bytes())
+
+    def check_memory_budget(self, width, height):
+        """
+        Raise error if a page plus a RGBA image of width x height
+        pixels would not fit in the memory budget.  Pages still being
+        written count too, so this waits for them to be written if
+        needed.  Renders kept to share between panels are dropped
+        first to make room.
+        """
+        if self.memory_budget is None:
+            return
+        needed = self.get_page_bytes() + (width * height * 4)
+        if self.page_writer is not None:
+            cached_bytes = 0
+            if self.render_plan is not None:
+                cached_bytes = self.render_plan.cached_bytes
+            self.page_writer.wait_pending_bytes(self.memory_budget - needed
+                                                - cached_bytes)
+            needed += self.page_writer.pending_bytes
+        if self.render_plan is not None:
+            self.render_plan.evict(needed + self.render_plan.cached_bytes
+                                   - self.memory_budget)
+            needed += self.render_plan.cached_bytes
+        if needed > self.memory_budget:
+            raise RuntimeError("figure '%s' needs %d bytes which is over"
+                               " the memory budget of %d bytes"
+                               % (self.figure_name, needed,
+                                  self.memory_budget))
+
     def create_figure(self):
         """
         Creates a new PIL image ready to receive panels, labels etc.
         This is created for each page in the figure.
         """
-        tiff_width = int(scale_to_export_dpi(self.page_width))
-        tiff_height = int(scale_to_export_dpi(self.page_height))
+        tiff_width = int(self.scale_to_export_dpi(self.page_width))
+        tiff_height = int(self.scale_to_export_dpi(self.page_height))
+        self.check_memory_budget(0, 0)
+        if self.get_strip_rows() is not None:
+            # Drawn, one strip at a time, by save_page()
+            self.tiff_figure = None
+            self.page_ops = []
+            return
+        self.tiff_figure = Image.new("RGBA", (tiff_width, tiff_height),
+                                     self.get_page_rgb())
+
+    def get_page_rgb(self):
         rgb = (255, 255, 255)
         page_color = self.figure_json.get('page_color')
         if page_color is not None:
             rgb = ShapeToPdfExport.get_rgb('#' + page_color)
-        self.tiff_figure = Image.new("RGBA", (tiff_width, tiff_height), rgb)
+        return rgb
+
+    def draw_on_page(self, top, bottom, draw, release=None):
+        """
+        Calls draw(img, y0) to draw on the page image img, whose first
+        row is row y0 of the page.  If the page is drawn in strips,
+        this is kept to call for each strip between rows top and
+        bottom, and then release() if given.
+        """
+        if self.page_ops is None:
+            draw(self.tiff_figure, 0)
+            if release is not None:
+                release()
+        else:
+            self.page_ops.append((top, bottom, draw, release))
+
+    def add_panels_to_page(self, panel_idxs, image_ids, page):
+        """
+        When drawing the page in strips, the panel images are only
+        made when the first strip with them is drawn, and released
+        after the last.  So only panels on the current strip are in
+        memory.
+        """
+        if self.page_ops is None:
+            super(TiffExport, self).add_panels_to_page(panel_idxs,
+                                                       image_ids, page)
+            return
+        for i in panel_idxs:
+            panel = self.panels[i]
+            y = panel.page_box(page)[1]
+            top = int(round(self.scale_to_export_dpi(y)))
+            bottom = top + int(round(self.scale_to_export_dpi(panel.height)))
+            panel_image = {}
+
+            def draw(img, y0, panel=panel, i=i, panel_image=panel_image):
+                if not panel_image:
+                    panel_image['args'] = self.get_page_panel_image(
+                        panel, page, i, image_ids)
+                if panel_image['args'] is not None:
+                    pil_img, x, y = panel_image['args']
+                    img.paste(pil_img, (x, y - y0))
+
+            self.draw_on_page(top, bottom, draw, panel_image.clear)
+            self.draw_scalebar(panel, page)
+            self.draw_text_batch(self.layout_labels(panel, page))
+
+    def get_page_panel_image(self, panel, page, idx, image_ids):
+        """
+        Returns the panel image, ready to paste on the page, and its
+        position on the page.  Or None if there's no such image.
+        """
+        plane = self.render_panel(panel)
+        if plane is None:
+            return None
+        if plane.can_annotate:
+            image_ids.add(panel.image_id)
+        # Same images saved as draw_panel() does
+        img_name = self.get_panel_image_name(plane, idx)
+        orig_name = None
+        if self.export_images:
+            orig_name = os.path.join(ORIGINAL_DIR, img_name)
+        pil_img = self.get_panel_image(plane, panel, orig_name)
+        if pil_img is None:
+            return None
+        return self.prepare_panel_image(pil_img, img_name, panel, page)
 
     def add_page_color(self):
         """ Don't need to do anything for TIFF. Image is already colored."""
@@ -1812,20 +2820,24 @@ class TiffExport(FigureExport):
 
     def paste_image(self, pil_img, img_name, panel, page, dpi=None):
         """ Add the PIL image to the current figure page """
+        pil_img, x, y = self.prepare_panel_image(pil_img, img_name, panel,
+                                                 page)
+        height = pil_img.size[1]
+        self.draw_on_page(y, y + height,
+                          lambda img, y0: img.paste(pil_img, (x, y - y0)))
 
-        x = panel['x']
-        y = panel['y']
-        width = panel['width']
-        height = panel['height']
-
+    def prepare_panel_image(self, pil_img, img_name, panel, page):
+        """
+        Resizes the panel image to the figure dpi, and draws the
+        shapes.  Returns it with its position on the page.
+        """
         # Handle page offsets
-        x = x - page['x']
-        y = y - page['y']
+        x, y, width, height = panel.page_box(page)
 
-        x = scale_to_export_dpi(x)
-        y = scale_to_export_dpi(y)
-        width = scale_to_export_dpi(width)
-        height = scale_to_export_dpi(height)
+        x = self.scale_to_export_dpi(x)
+        y = self.scale_to_export_dpi(y)
+        width = self.scale_to_export_dpi(width)
+        height = self.scale_to_export_dpi(height)
 
         x = int(round(x))
         y = int(round(y))
@@ -1834,39 +2846,37 @@ class TiffExport(FigureExport):
 
         # Save image BEFORE resampling
         if self.export_images:
-            rs_name = os.path.join(self.zip_folder_name, RESAMPLED_DIR,
-                                   img_name)
-            pil_img.save(rs_name)
+            self.save_export_image(pil_img,
+                                   os.path.join(RESAMPLED_DIR, img_name))
 
-        # Resize to our target size to match DPI of figure
-        pil_img = pil_img.resize((width, height), Image.BICUBIC)
+        # Resize to our target size to match DPI of figure, unless
+        # it was already scaled by get_panel_image()
+        self.check_memory_budget(width, height)
+        if pil_img.size != (width, height):
+            pil_img = pil_img.resize((width, height), Image.BICUBIC)
 
         if self.export_images:
-            img_name = os.path.join(self.zip_folder_name, FINAL_DIR, img_name)
-            pil_img.save(img_name)
+            self.save_export_image(pil_img, os.path.join(FINAL_DIR, img_name))
 
         # Now at full figure resolution - Good time to add shapes...
-        crop = self.get_crop_region(panel)
-        ShapeToPilExport(pil_img, panel, crop)
-
-        width, height = pil_img.size
-        box = (x, y, x + width, y + height)
-        self.tiff_figure.paste(pil_img, box)
+        ShapeToPilExport(pil_img, panel, self.export_dpi)
+        return pil_img, x, y
 
     def draw_line(self, x, y, x2, y2, width, rgb):
         """ Draw line on the current figure page """
-        draw = ImageDraw.Draw(self.tiff_figure)
+        x = self.scale_to_export_dpi(x)
+        y = self.scale_to_export_dpi(y)
+        x2 = self.scale_to_export_dpi(x2)
+        y2 = self.scale_to_export_dpi(y2)
+        width = self.scale_to_export_dpi(width)
 
-        x = scale_to_export_dpi(x)
-        y = scale_to_export_dpi(y)
-        x2 = scale_to_export_dpi(x2)
-        y2 = scale_to_export_dpi(y2)
-        width = scale_to_export_dpi(width)
+        def draw_on(img, y0):
+            draw = ImageDraw.Draw(img)
+            for l in range(width):
+                draw.line([(x, y + l - y0), (x2, y2 + l - y0)], fill=rgb)
 
-        for l in range(width):
-            draw.line([(x, y), (x2, y2)], fill=rgb)
-            y += 1
-            y2 += 1
+        top = int(floor(min(y, y2)))
+        self.draw_on_page(top, int(ceil(max(y, y2))) + width, draw_on)
 
     def draw_temp_label(self, text, fontsize, rgb):
         """Returns a new PIL image with text. Handles html."""
@@ -1942,16 +2952,20 @@ class TiffExport(FigureExport):
         tokens.append({'text': token, 'bold': in_bold, 'italics': in_italics})
         return tokens
 
+    def draw_text_batch(self, labels):
+        """ Draws a list of PlacedLabel on the current figure page """
+        for label in labels:
+            self.draw_text(label.text, label.x, label.y, label.fontsize,
+                           label.rgb, align=label.align)
+
     def draw_text(self, text, x, y, fontsize, rgb, align="center"):
         """ Add text to the current figure page """
-        x = scale_to_export_dpi(x)
+        x = self.scale_to_export_dpi(x)
         y = y - 5       # seems to help, but would be nice to fix this!
-        y = scale_to_export_dpi(y)
-        fontsize = scale_to_export_dpi(fontsize)
+        y = self.scale_to_export_dpi(y)
+        fontsize = self.scale_to_export_dpi(fontsize)
 
-        if markdown_imported:
-            # convert markdown to html
-            text = markdown.markdown(text)
+        text = self.get_label_html(text)
 
         temp_label = self.draw_temp_label(text, fontsize, rgb)
 
@@ -1965,21 +2979,137 @@ class TiffExport(FigureExport):
         x = int(round(x))
         y = int(round(y))
         # Use label as mask, so transparent part is not pasted
-        self.tiff_figure.paste(temp_label, (x, y), mask=temp_label)
+        self.draw_on_page(
+            y, y + temp_label.size[1],
+            lambda img, y0: img.paste(temp_label, (x, y - y0),
+                                      mask=temp_label))
 
     def save_page(self, page=None):
         """
         Save the current PIL image page as a TIFF and start a new
         PIL image for the next page
         """
-        self.figure_file_name = self.get_figure_file_name()
+        if page is not None:
+            page = page + 1
+        self.figure_file_name = self.get_figure_file_name(page)
 
-        self.tiff_figure.save(self.figure_file_name)
+        if self.page_ops is not None:
+            self.write_page_strips(self.figure_file_name)
+        else:
+            if self.page_writer is None:
+                self.page_writer = PageWriter()
+            self.page_writer.submit(self, image_bytes(self.tiff_figure),
+                                    self.write_page, self.tiff_figure,
+                                    self.figure_file_name)
+
+        # Release this page before allocating the next one, so that
+        # only the page being rendered and the pages queued for
+        # writing are in memory.
+        self.tiff_figure = None
+        self.page_ops = None
+        if page is None or page < self.page_count:
+            self.create_figure()
+
+    def iter_page_strips(self, strip_rows):
+        """
+        Draws the page, one strip at a time.  Panels are only rendered
+        here, when the first strip with them is drawn.
+        """
+        tiff_width = int(self.scale_to_export_dpi(self.page_width))
+        tiff_height = int(self.scale_to_export_dpi(self.page_height))
+        rgb = self.get_page_rgb()
+        ops = self.page_ops
+        for y0 in range(0, tiff_height, strip_rows):
+            y1 = min(y0 + strip_rows, tiff_height)
+            strip = Image.new("RGB", (tiff_width, y1 - y0), rgb)
+            for top, bottom, draw, release in ops:
+                if top < y1 and y0 < bottom:
+                    draw(strip, y0)
+            yield strip
+            del strip
+            # Release what is above the next strip
+            remaining = []
+            for op in ops:
+                if op[1] > y1:
+                    remaining.append(op)
+                elif op[3] is not None:
+                    op[3]()
+            ops = remaining
+
+    def write_page_strips(self, file_name):
+        """ Draws the page in strips, writing each to the TIFF file """
+        self.write_page_file(file_name, self.write_page_strips_to)
+
+    def write_page_strips_to(self, fpath):
+        tiff_width = int(self.scale_to_export_dpi(self.page_width))
+        tiff_height = int(self.scale_to_export_dpi(self.page_height))
+        strip_rows = self.get_strip_rows()
+        strips = self.iter_page_strips(strip_rows)
+        dpi = self.export_dpi
+        if self.tiff_compression is not None:
+            write_pyramid_tiff(fpath, strips, tiff_width, tiff_height,
+                               self.tiff_compression, dpi)
+            return
+        writer = StripTiffWriter(fpath, tiff_width, tiff_height,
+                                 strip_rows, dpi=dpi)
+        try:
+            for strip in strips:
+                writer.write_strip(strip)
+        finally:
+            writer.close()
 
-        # Create a new blank tiffFigure for subsequent pages
-        self.create_figure()
+    def write_page_file(self, file_name, write):
+        """
+        Calls write(fpath) to write the page file_name.  When zipping,
+        fpath is a temporary file that is then moved into the zip.
+        """
+        if self.figure_zip is None:
+            try:
+                write(file_name)
+            except:
+                # Don't leave an incomplete page behind
+                if os.path.exists(file_name):
+                    os.remove(file_name)
+                raise
+            return
+        fpath = self.figure_zip.get_temp_file_name(file_name)
+        try:
+            write(fpath)
+        except:
+            os.remove(fpath)
+            raise
+        self.figure_zip.write_file(fpath, file_name)
+
+    def is_pyramid_file(self, file_name):
+        """ Returns True if the page is to be saved as pyramidal TIFF """
+        ext = os.path.splitext(file_name)[1].lower()
+        return self.tiff_compression is not None and ext in ('.tif', '.tiff')
+
+    def write_page(self, pil_img, file_name):
+        """ Encodes and saves a page. Called from the PageWriter """
+        if self.is_pyramid_file(file_name):
+            width, height = pil_img.size
+
+            def write(fpath):
+                write_pyramid_tiff(fpath, [pil_img], width, height,
+                                   self.tiff_compression, self.export_dpi)
+        else:
+            def write(fpath):
+                pil_img.save(fpath)
+        self.write_page_file(file_name, write)
 
-    def add_info_page(self, panels_json):
+    def flush_pages(self):
+        """ Waits for the pages of this figure to be written """
+        if self.page_writer is None:
+            return
+        if self.own_page_writer:
+            self.page_writer.close()
+            self.page_writer = None
+        elif self.figure_zip is not None:
+            # Need all pages in the zip before closing it
+            self.page_writer.join(self)
+
+    def add_info_page(self, panels):
         """
         Since we need a PDF for the info page, we create one first,
         then call superclass add_info_page
@@ -1989,53 +3119,72 @@ class TiffExport(FigureExport):
             return
 
         full_name = "info_page.pdf"
-        if self.zip_folder_name is not None:
+        if self.figure_zip is None:
             full_name = os.path.join(self.zip_folder_name, full_name)
-        self.figure_canvas = canvas.Canvas(
-            full_name, pagesize=(self.page_width, self.page_height))
+        self.open_canvas(full_name)
 
         # Superclass method will call add_para_with_thumb(),
         # to add lines to self.infoLines
-        super(TiffExport, self).add_info_page(panels_json)
+        super(TiffExport, self).add_info_page(panels)
 
     def save_figure(self):
         """ Completes PDF figure (or info-page PDF for TIFF export) """
         # We allow TIFF figure export without reportlab (no Info page)
         if not reportlab_installed:
             return
-        self.figure_canvas.save()
+        self.close_canvas()
 
 
 class OmeroExport(TiffExport):
 
-    def __init__(self, conn, script_params):
+    # Pages are uploaded as images, they need to be whole
+    can_write_strips = False
 
-        super(OmeroExport, self).__init__(conn, script_params)
+    # Most pixels copied at a time to upload a page.  Images that need
+    # a pyramid take 256x256 tiles.  Others take bands of rows, of
+    # about this many pixels.
+    upload_chunk_pixels = 1024 * 1024
+
+    def __init__(self, conn, script_params, memory_budget=None,
+                 upload_workers=2):
+
+        # Uploads run on the PageWriter threads, one page each
+        page_writer = PageWriter(workers=upload_workers)
+        super(OmeroExport, self).__init__(conn, script_params,
+                                          memory_budget=memory_budget,
+                                          page_writer=page_writer)
+        self.own_page_writer = True
+        # See upload_page()
+        self.upload_lock = threading.Lock()
 
         self.new_image = None
+        self.new_images = {}
+        self.dataset = None
+        self.dataset_resolved = False
 
-    def save_page(self, page=None):
+    def get_dataset(self):
         """
-        Save the current PIL image page as a new OMERO image and start a new
-        PIL image for the next page
+        Returns the first Dataset, that we can link to, of the images
+        in the figure.  This is only looked up once per export.
         """
-        self.figure_file_name = self.get_figure_file_name(page + 1)
-
-        # Try to get a Dataset
-        dataset = None
-        for panel in self.figure_json['panels']:
-            parent = self.conn.getObject('Image', panel['imageId']).getParent()
+        if self.dataset_resolved:
+            return self.dataset
+        image_ids = set(p.image_id for p in self.panels)
+        for image in self.conn.getObjects('Image', list(image_ids)):
+            parent = image.getParent()
             if parent is not None and parent.OMERO_CLASS == 'Dataset':
                 if parent.canLink():
-                    dataset = parent
+                    self.dataset = parent
                     break
+        self.dataset_resolved = True
+        return self.dataset
 
-        # Need to specify group for new image
-        group_id = self.conn.getEventContext().groupId
-        if dataset is not None:
-            group_id = dataset.getDetails().group.id.val
-            dataset = dataset._obj      # get the omero.model.DatasetI
-        self.conn.SERVICE_OPTS.setOmeroGroup(group_id)
+    def save_page(self, page=None):
+        """
+        Save the current PIL image page as a new OMERO image and start a new
+        PIL image for the next page
+        """
+        self.figure_file_name = self.get_figure_file_name(page + 1)
 
         description = "Created from OMERO.figure: "
         url = self.script_params.get("Figure_URI")
@@ -2045,20 +3194,120 @@ class OmeroExport(TiffExport):
         if legend is not None:
             description = "%s\n\n%s" % (description, legend)
 
-        np_array = numpy.asarray(self.tiff_figure)
-        red = np_array[::, ::, 0]
-        green = np_array[::, ::, 1]
-        blue = np_array[::, ::, 2]
-        plane_gen = iter([red, green, blue])
-        self.new_image = self.conn.createImageFromNumpySeq(
-            plane_gen,
-            self.figure_file_name,
-            sizeC=3,
-            description=description, dataset=dataset)
-        # Reset group context
-        self.conn.SERVICE_OPTS.setOmeroGroup(-1)
+        # The upload happens in the background while we render the
+        # next page.
+        self.page_writer.submit(self, self.get_upload_bytes(),
+                                self.upload_page, self.tiff_figure, page,
+                                self.figure_file_name, description,
+                                self.get_dataset())
+
         # Create a new blank tiffFigure for subsequent pages
-        self.create_figure()
+        self.tiff_figure = None
+        if page + 1 < self.page_count:
+            self.create_figure()
+
+    def get_upload_bytes(self):
+        """
+        Memory to upload the current page, the page itself and the
+        copies of one chunk.  Each chunk is copied from the RGBA page,
+        split into its bands, and each band converted to bytes.
+        """
+        return image_bytes(self.tiff_figure) + (9 * self.upload_chunk_pixels)
+
+    def upload_page(self, pil_img, page, name, description, dataset):
+        """
+        Creates a new OMERO image from a page.  The page is sent in
+        tiles, or bands of rows, copied from the page one at a time,
+        so there's never a copy of the whole page or of a whole
+        channel.  Called from the PageWriter.
+
+        The uploads share the gateway with each other and with the
+        rendering of the next pages.  Its services are Ice proxies,
+        which are safe to use from several threads, but BlitzGateway
+        creates them lazily, so uploads take upload_lock to use it.
+        The pixels are sent with a RawPixelsStore of their own, which
+        is stateful and only used by this thread, without the lock.
+        """
+        conn = self.conn
+
+        with self.upload_lock:
+            # Need to specify group for new image.  Use our own
+            # context instead of changing the connection group since
+            # other pages may be uploading at the same time.
+            group_id = conn.getEventContext().groupId
+            if dataset is not None:
+                group_id = dataset.getDetails().group.id.val
+            ctx = conn.SERVICE_OPTS.copy()
+            ctx.setOmeroGroup(group_id)
+
+            size_x, size_y = pil_img.size
+            pixels_type = conn.getQueryService().findByQuery(
+                "from PixelsType as p where p.value = 'uint8'", None, ctx)
+            image_id = conn.getPixelsService().createImage(
+                size_x, size_y, 1, 1, [0, 1, 2], pixels_type, name,
+                description, ctx).getValue()
+
+            image = conn.getObject('Image', image_id, opts=ctx)
+            pixels_id = image.getPrimaryPixels().getId()
+            store = conn.c.sf.createRawPixelsStore()
+
+        try:
+            store.setPixelsId(pixels_id, True, ctx)
+            if store.requiresPixelsPyramid(ctx):
+                # The pyramid is written one plane at a time, so each
+                # tile is copied once per channel
+                tile_w, tile_h = store.getTileSize(ctx)
+                for c in range(3):
+                    self.upload_tiles(store, ctx, pil_img, tile_w, tile_h,
+                                      [c])
+            else:
+                # Any region can be set, so send bands of whole rows
+                tile_w = size_x
+                tile_h = max(1, self.upload_chunk_pixels // size_x)
+                self.upload_tiles(store, ctx, pil_img, tile_w, tile_h,
+                                  [0, 1, 2])
+            store.save(ctx)
+        finally:
+            store.close()
+
+        with self.upload_lock:
+            pixels_service = conn.getPixelsService()
+            for c in range(3):
+                pixels_service.setChannelGlobalMinMax(pixels_id, c, 0.0,
+                                                      255.0, ctx)
+            conn.getRenderingSettingsService().resetDefaultsInSet(
+                'Image', [image_id], ctx)
+
+            if dataset is not None:
+                link = DatasetImageLinkI()
+                link.parent = DatasetI(dataset.getId(), False)
+                link.child = ImageI(image_id, False)
+                conn.getUpdateService().saveObject(link, ctx)
+
+            self.new_images[page] = conn.getObject('Image', image_id,
+                                                   opts=ctx)
+
+    def upload_tiles(self, store, ctx, pil_img, tile_w, tile_h, channels):
+        """
+        Sends the channels of the page to store, tile by tile.  Each
+        tile is copied from the page, and split in bands, only once.
+        """
+        size_x, size_y = pil_img.size
+        for y in range(0, size_y, tile_h):
+            h = min(tile_h, size_y - y)
+            for x in range(0, size_x, tile_w):
+                w = min(tile_w, size_x - x)
+                bands = pil_img.crop((x, y, x + w, y + h)).split()
+                for c in channels:
+                    store.setTile(bands[c].tobytes(), 0, c, 0, x, y, w, h,
+                                  ctx)
+                del bands
+
+    def flush_pages(self):
+        """ Waits for uploads, new_image is the image of the last page """
+        super(OmeroExport, self).flush_pages()
+        if self.new_images:
+            self.new_image = self.new_images[max(self.new_images)]
 
     def create_file_annotation(self, image_ids):
         """Return result of script."""
@@ -2075,14 +3324,20 @@ def export_figure(conn, script_params):
 
     export_option = script_params['Export_Option']
 
+    tiff_compression = script_params.get('TIFF_Compression', 'none')
+    if tiff_compression == 'none':
+        tiff_compression = None
+
     if export_option == 'PDF':
         fig_export = FigureExport(conn, script_params)
     elif export_option == 'PDF_IMAGES':
         fig_export = FigureExport(conn, script_params, export_images=True)
     elif export_option == 'TIFF':
-        fig_export = TiffExport(conn, script_params)
+        fig_export = TiffExport(conn, script_params,
+                                tiff_compression=tiff_compression)
     elif export_option == 'TIFF_IMAGES':
-        fig_export = TiffExport(conn, script_params, export_images=True)
+        fig_export = TiffExport(conn, script_params, export_images=True,
+                                tiff_compression=tiff_compression)
     elif export_option == 'OMERO':
         fig_export = OmeroExport(conn, script_params)
     return fig_export.build_figure()
@@ -2097,6 +3352,8 @@ def run_script():
     export_options = [rstring('PDF'), rstring('PDF_IMAGES'),
                       rstring('TIFF'), rstring('TIFF_IMAGES'),
                       rstring('OMERO')]
+    tiff_compressions = [rstring('none')] + [
+        rstring(c) for c in sorted(TIFF_COMPRESSIONS.keys())]
 
     client = scripts.client(
         'Figure_To_Pdf.py',
@@ -2108,6 +3365,11 @@ def run_script():
         scripts.String("Export_Option", values=export_options,
                        default="PDF"),
 
+        scripts.String("TIFF_Compression", values=tiff_compressions,
+                       default="none",
+                       description="Compression for tiled, pyramidal"
+                       " TIFFs, or 'none' for flat TIFFs"),
+
         scripts.String("Webclient_URI", optional=False, grouping="4",
                        description="webclient URL for adding links to images"),
 
@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## Answers from the questionnaire are kept in one file per scorer,
+## SCORER.jsonl, in the answers directory.  Each line is the JSON of
+## one image answers:
+##
+##     {"image": "1234", "scorer": "jdoe", "time": "2020-...",
+##      "answers": [["question", "answer"], ...],
+##      "multi": ["question", ...]}
+##
+## The "multi" list has the questions that allow selecting multiple
+## answers (CheckQuestion).  Their answer is the selected options
+## joined by tabs.
+##
+## The file is only ever appended to, one line per image, and synced
+## to disk after each line, so a crash loses at most the line being
+## written.  A partial last line is ignored when reading and removed
+## when the file is opened again for appending.
+##
+## Older versions of the questionnaire saved one IMAGE.pickle file per
+## image instead, with a list of (question, answer) tuples and no
+## scorer name.  import_pickles() appends those to a scorer answers
+## file.
+
+import datetime
+import fcntl
+import json
+import os
+import os.path
+import pickle
+import typing
+
+
+ANSWERS_EXT = '.jsonl'
+PICKLE_EXT = '.pickle'
+
+Answers = typing.List[typing.Tuple[str, str]]
+
+
+def image_id_from_fpath(fpath: str) -> str:
+    """Image id is the image file name without extension."""
+    return os.path.splitext(os.path.basename(fpath))[0]
+
+
+def store_fpath(save_dir: str, scorer: str) -> str:
+    return os.path.join(save_dir, scorer + ANSWERS_EXT)
+
+
+def list_stores(save_dir: str) -> typing.List[str]:
+    """File paths for the answers of all scorers in a directory."""
+    return sorted([os.path.join(save_dir, fname)
+                   for fname in os.listdir(save_dir)
+                   if fname.endswith(ANSWERS_EXT)])
+
+
+def list_pickles(save_dir: str) -> typing.List[str]:
+    """File paths for answers in the old one pickle per image format."""
+    return sorted([os.path.join(save_dir, fname)
+                   for fname in os.listdir(save_dir)
+                   if fname.endswith(PICKLE_EXT)])
+
+
+def read_records(fpath: str, offset: int = 0
+                 ) -> typing.Iterator[typing.Tuple[int, int, dict]]:
+    """Records in an answers file, starting at byte offset.
+
+    Yields tuples of the record start offset, end offset, and the
+    record.  A last line without newline is a write that did not
+    complete and is skipped.
+    """
+    with open(fpath, 'rb') as fh:
+        fh.seek(offset)
+        for line in fh:
+            if not line.endswith(b'\n'):
+                break
+            end = offset + len(line)
+            yield offset, end, json.loads(line.decode('utf-8'))
+            offset = end
+
+
+def complete_size(fpath: str) -> int:
+    """Size of the file up to its last complete line."""
+    size = 0
+    with open(fpath, 'rb') as fh:
+        for line in fh:
+            if not line.endswith(b'\n'):
+                break
+            size += len(line)
+    return size
+
+
+class AnswerStore:
+    """Append-only answers of one scorer, indexed by image id."""
+    def __init__(self, save_dir: str, scorer: str) -> None:
+        if not scorer or os.sep in scorer or scorer.startswith('.'):
+            raise ValueError('invalid scorer name \'%s\'' % scorer)
+        self.scorer = scorer
+        self.fpath = store_fpath(save_dir, scorer)
+
+        ## Image id to offset of its record in the file.
+        self._index: typing.Dict[str, int] = {}
+        if os.path.exists(self.fpath):
+            for offset, end, record in read_records(self.fpath):
+                self._index[record['image']] = offset
+            ## Remove partial line from a crash, otherwise the next
+            ## record would be appended to it.
+            size = complete_size(self.fpath)
+            if size != os.path.getsize(self.fpath):
+                os.truncate(self.fpath, size)
+
+        self._fh = open(self.fpath, 'ab')
+
+    def __contains__(self, image_id: str) -> bool:
+        return image_id in self._index
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def image_ids(self) -> typing.KeysView[str]:
+        return self._index.keys()
+
+    def get(self, image_id: str) -> Answers:
+        with open(self.fpath, 'rb') as fh:
+            fh.seek(self._index[image_id])
+            record = json.loads(fh.readline().decode('utf-8'))
+        return [tuple(qa) for qa in record['answers']]
+
+    def append(self, image_id: str, answers: Answers,
+               multi: typing.Sequence[str] = (),
+               time: typing.Optional[datetime.datetime] = None) -> None:
+        if image_id in self._index:
+            raise KeyError('answers for image \'%s\' already saved' % image_id)
+        if time is None:
+            time = datetime.datetime.now()
+        record = {
+            'image': image_id,
+            'scorer': self.scorer,
+            'time': time.isoformat(),
+            'answers': [list(qa) for qa in answers],
+            'multi': list(multi),
+        }
+        line = (json.dumps(record) + '\n').encode('utf-8')
+        offset = self._fh.tell()
+        self._fh.write(line)
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        self._index[image_id] = offset
+
+    def close(self) -> None:
+        self._fh.close()
+
+
+class _AnswersUnpickler(pickle.Unpickler):
+    """Unpickler for the old answers, which are only lists and tuples
+    of str.  Those need no classes, so any class is refused, and a
+    file made to run code when loaded fails instead.
+    """
+    def find_class(self, module: str, name: str) -> typing.Any:
+        raise pickle.UnpicklingError('class \'%s.%s\' not allowed in'
+                                     ' answers' % (module, name))
+
+
+def read_pickle(fpath: str) -> Answers:
+    """Answers in an old pickle file."""
+    with open(fpath, 'rb') as fh:
+        answers = _AnswersUnpickler(fh).load()
+    if (not isinstance(answers, list)
+        or not all([isinstance(qa, (list, tuple)) and len(qa) == 2
+                    and all([isinstance(x, str) for x in qa])
+                    for qa in answers])):
+        raise ValueError('\'%s\' does not have questionnaire answers'
+                         % fpath)
+    return [tuple(qa) for qa in answers]
+
+
+def import_pickles(store: AnswerStore, save_dir: str,
+                   multi: typing.Sequence[str] = ()) -> int:
+    """Appends the answers in old pickle files to store.
+
+    The time of the answers is the pickle file modification time.
+    Each pickle file is renamed to IMAGE.pickle.imported after its
+    answers are saved, or if the store already has answers for that
+    image, so that importing again does not repeat them.  A file
+    with anything other than answers is an error, see read_pickle().
+    Returns number of answers imported.
+    """
+    n_imported = 0
+    for fpath in list_pickles(save_dir):
+        image_id = image_id_from_fpath(fpath)
+        if image_id not in store:
+            answers = read_pickle(fpath)
+            time = datetime.datetime.fromtimestamp(os.path.getmtime(fpath))
+            store.append(image_id, answers, multi, time)
+            n_imported += 1
+        os.rename(fpath, fpath + '.imported')
+    return n_imported
+
+
+class WorkQueue:
+    """Images shared by several scorers, each image given to only one.
+
+    Scorers claim images from a shared list before answering them.
+    Claims are appended to a file in the answers directory, locked
+    while claiming, so scorers in different processes or machines
+    (with a shared file system that supports locks) never get the
+    same image.  Images claimed but not answered can be released
+    so that others can claim them.
+    """
+    def __init__(self, save_dir: str) -> None:
+        self.fpath = os.path.join(save_dir, 'queue.claims')
+        ## Image id to scorer, from the claims file read so far.
+        self._claimed: typing.Dict[str, str] = {}
+        self._offset = 0
+
+    def _update(self, fh: typing.BinaryIO) -> None:
+        """Read claims added since last time.  Needs lock."""
+        for offset, end, record in read_records(self.fpath, self._offset):
+            image_id = record['image']
+            if record.get('release'):
+                if self._claimed.get(image_id) == record['scorer']:
+                    del self._claimed[image_id]
+            elif image_id not in self._claimed:
+                self._claimed[image_id] = record['scorer']
+            self._offset = end
+        ## Partial line from a crash while writing a claim.
+        if os.path.getsize(self.fpath) != self._offset:
+            fh.truncate(self._offset)
+
+    def _append(self, fh: typing.BinaryIO,
+                records: typing.Sequence[dict]) -> None:
+        """Append claim records.  Needs lock and claims up to date."""
+        if not records:
+            return
+        fh.seek(0, os.SEEK_END)
+        data = b''.join([(json.dumps(r) + '\n').encode('utf-8')
+                         for r in records])
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+        self._update(fh)
+
+    def claim(self, scorer: str, image_ids: typing.Sequence[str], n: int,
+              exclude: typing.Container[str] = ()) -> typing.List[str]:
+        """Claims up to n images, in the order of image_ids.
+
+        Images already claimed by this scorer come first, so that
+        claims left from a previous session are finished first.
+        Images in exclude, e.g. those already answered, are skipped.
+        """
+        with open(self.fpath, 'a+b') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                self._update(fh)
+                candidates = [i for i in image_ids if i not in exclude]
+                mine = [i for i in candidates
+                        if self._claimed.get(i) == scorer]
+                free = [i for i in candidates if i not in self._claimed]
+                chosen = (mine + free)[:n]
+                self._append(fh, [{'image': i, 'scorer': scorer}
+                                  for i in chosen if i not in self._claimed])
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+        return chosen
+
+    def release(self, scorer: str, image_ids: typing.Iterable[str]) -> None:
+        """Releases claims of scorer so that others can claim them."""
+        with open(self.fpath, 'a+b') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                self._update(fh)
+                self._append(fh, [{'image': i, 'scorer': scorer,
+                                   'release': True} for i in image_ids
+                                  if self._claimed.get(i) == scorer])
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## Rules to blind OMERO.figure JSONs, i.e., remove from the figure
+## what identifies the gene so that scoring is done blindly.
+##
+## Each rule is a function that takes the figure JSON (modified in
+## place) and the figure metadata, and returns a list of what it
+## removed so that it can be recorded for unblinding.  Rules are
+## registered by name in RULES.
+##
+## This works with both python 2 and 3 because it is used by the
+## scripts that need OMERO (python 2) and by those that don't.  The
+## examples in the docstrings are tests, run them with:
+##
+##     python -m doctest lib-python/blinding.py
+
+from __future__ import unicode_literals
+
+import collections
+
+
+## OMERO image ID with a blank image.  It is used to place text in
+## arbitrary figure locations.
+BLANK_IMAGE_ID = 283965
+
+
+FigureMetadata = collections.namedtuple('FigureMetadata',
+                                        ['fig_id', 'gene_name'])
+
+
+def blind_gene_label(fig_json, metadata):
+    """Remove labels with the gene name.
+
+    The gene name is in the 'title' of the figure.  The 'title' is
+    the label of a panel with a blank image.  We want to remove this
+    panel.  However, the same image is used in other places in the
+    figure to introduce text and we want to keep those.  So only
+    remove panels if the gene name is used in the label.  In panels
+    with real images, only the labels with the gene name are removed.
+
+    Labels without text, such as the time labels, are kept.
+
+    >>> fig_json = {'panels': [
+    ...     {'imageId': BLANK_IMAGE_ID, 'labels': [{'text': 'ACTB'}]},
+    ...     {'imageId': 1, 'labels': [{'text': 'ACTB'}, {'time': 'secs'},
+    ...                               {'text': None}]},
+    ... ]}
+    >>> removed = blind_gene_label(fig_json, FigureMetadata(1, 'ACTB'))
+    >>> removed == ['ACTB', 'ACTB']
+    True
+    >>> fig_json['panels'] == [
+    ...     {'imageId': 1, 'labels': [{'time': 'secs'}, {'text': None}]}]
+    True
+    """
+    if not metadata.gene_name:
+        return []
+    removed = []
+    kept_panels = []
+    for panel in fig_json['panels']:
+        labels = panel.get('labels', [])
+        with_name = [l for l in labels
+                     if metadata.gene_name in (l.get('text') or '')]
+        if not with_name:
+            kept_panels.append(panel)
+            continue
+        removed.extend([l['text'] for l in with_name])
+        if panel['imageId'] != BLANK_IMAGE_ID:
+            panel['labels'] = [l for l in labels
+                               if (metadata.gene_name
+                                   not in (l.get('text') or ''))]
+            kept_panels.append(panel)
+    fig_json['panels'] = kept_panels
+    return removed
+
+
+def blind_figure_name(fig_json, metadata):
+    """Replace the figure name, usually the gene name, with its id."""
+    name = fig_json.get('figureName')
+    if not name:
+        return []
+    fig_json['figureName'] = '%d' % metadata.fig_id
+    return [name]
+
+
+def blind_legend(fig_json, metadata):
+    """Remove the figure legend."""
+    legend = fig_json.pop('legend', None)
+    fig_json.pop('legend_collapsed', None)
+    if not legend:
+        return []
+    return [legend]
+
+
+RULES = collections.OrderedDict([
+    ('gene-label', blind_gene_label),
+    ('figure-name', blind_figure_name),
+    ('legend', blind_legend),
+])
+
+DEFAULT_RULES = ('gene-label',)
+
+
+def blind_figure(fig_json, metadata, rules=DEFAULT_RULES):
+    """Apply the named blinding rules to the figure JSON, in place.
+
+    Returns a dict, to be saved for unblinding, with the figure
+    metadata and what each rule removed.
+    """
+    record = collections.OrderedDict([
+        ('id', metadata.fig_id),
+        ('gene', metadata.gene_name),
+    ])
+    for name in rules:
+        if name not in RULES:
+            raise ValueError('unknown blinding rule \'%s\'' % name)
+        record[name] = RULES[name](fig_json, metadata)
+    return record
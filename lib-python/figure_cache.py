@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## Cache of the parsed figure JSONs from a figures directory, so that
+## scripts don't need to read and parse thousands of text files.
+##
+## The cache is a single file with all figures, each pickled, and an
+## index by figure id at the end:
+##
+##     MAGIC | index offset | index length | figures ... | index
+##
+## The file is memory-mapped and each figure is only unpickled when
+## requested.  Each index entry has the mtime, size, and SHA-1 of the
+## JSON file it was parsed from.  A figure whose JSON changed is parsed
+## again when the cache is updated, while one that was only touched
+## (same SHA-1) is not.
+##
+## This works with both python 2 and 3, the pickles use protocol 2
+## which both can read.
+
+import hashlib
+import json
+import mmap
+import os
+import os.path
+import pickle
+import struct
+import tempfile
+
+
+MAGIC = b'FIGCACH1'
+HEADER = struct.Struct('<8sQQ')
+PROTOCOL = 2
+
+
+def json_fpath(figures_dir, fig_id):
+    return os.path.join(figures_dir, '%d.json' % fig_id)
+
+
+def stat_key(fpath):
+    stat = os.stat(fpath)
+    return (int(stat.st_mtime * 1e6), stat.st_size)
+
+
+class FigureCache(object):
+    """Parsed figure JSONs by figure id.
+
+    Use update() first to add figures, or refresh those that changed,
+    and then get() to read them.
+    """
+    def __init__(self, cache_fpath, figures_dir):
+        self.cache_fpath = cache_fpath
+        self.figures_dir = figures_dir
+        self._fh = None
+        self._mm = None
+        ## Figure id to (offset, length, stat key, sha1)
+        self._index = {}
+        self._open()
+
+    def _open(self):
+        self.close()
+        try:
+            fh = open(self.cache_fpath, 'rb')
+        except IOError:
+            return
+        try:
+            mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            fh.close()  # empty file
+            return
+        magic, index_offset, index_length = HEADER.unpack_from(mm, 0)
+        if magic != MAGIC:
+            mm.close()
+            fh.close()
+            return  # not a cache or older format, will be rebuilt
+        self._fh = fh
+        self._mm = mm
+        self._index = pickle.loads(mm[index_offset:index_offset+index_length])
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._fh.close()
+        self._fh = None
+        self._mm = None
+        self._index = {}
+
+    def __contains__(self, fig_id):
+        return fig_id in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def fig_ids(self):
+        return sorted(self._index.keys())
+
+    def _blob(self, fig_id):
+        offset, length, key, digest = self._index[fig_id]
+        return self._mm[offset:offset+length]
+
+    def get(self, fig_id):
+        """Figure JSON, as parsed by json.load."""
+        return pickle.loads(self._blob(fig_id))
+
+    def update(self, fig_ids):
+        """Adds figures not in the cache and those whose file changed.
+
+        The cache only keeps the figures in fig_ids.  Returns the
+        number of figures that had to be parsed.
+        """
+        blobs = {}
+        n_parsed = 0
+        changed = set(self._index.keys()) != set(fig_ids)
+        for fig_id in fig_ids:
+            fpath = json_fpath(self.figures_dir, fig_id)
+            key = stat_key(fpath)
+            entry = self._index.get(fig_id)
+            if entry is not None and entry[2] == key:
+                continue
+            with open(fpath, 'rb') as fh:
+                text = fh.read()
+            digest = hashlib.sha1(text).hexdigest()
+            if entry is not None and entry[3] == digest:
+                blob = self._blob(fig_id)
+            else:
+                figure_json = json.loads(text.decode('utf-8'))
+                blob = pickle.dumps(figure_json, PROTOCOL)
+                n_parsed += 1
+            blobs[fig_id] = (blob, key, digest)
+            changed = True
+        if changed:
+            self._write(fig_ids, blobs)
+        return n_parsed
+
+    def _write(self, fig_ids, blobs):
+        ## Write a new file and replace the old one, so that other
+        ## processes with the old one mapped can keep reading it.
+        cache_dir = os.path.dirname(os.path.abspath(self.cache_fpath))
+        fd, temp_fpath = tempfile.mkstemp(dir=cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                fh.write(HEADER.pack(MAGIC, 0, 0))
+                index = {}
+                for fig_id in fig_ids:
+                    if fig_id in blobs:
+                        blob, key, digest = blobs[fig_id]
+                    else:
+                        offset, length, key, digest = self._index[fig_id]
+                        blob = self._blob(fig_id)
+                    index[fig_id] = (fh.tell(), len(blob), key, digest)
+                    fh.write(blob)
+                index_blob = pickle.dumps(index, PROTOCOL)
+                index_offset = fh.tell()
+                fh.write(index_blob)
+                fh.seek(0)
+                fh.write(HEADER.pack(MAGIC, index_offset, len(index_blob)))
+            os.rename(temp_fpath, self.cache_fpath)
+        except:
+            os.remove(temp_fpath)
+            raise
+        self._open()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## Order in which to render figures with several workers.
+##
+## A few figures take much longer than the others (big tiled images,
+## many panels, Z projections).  If those are left to the end, one
+## worker is still rendering them after all others have finished.  So
+## figures are rendered longest first, each to the next free worker,
+## which keeps the total time close to the minimum.
+##
+## How long a figure takes is its time from previous runs, if any.
+## Otherwise, it is estimated from the figure JSON, in arbitrary cost
+## units, converted to seconds with the median seconds per cost unit
+## of previous runs.
+##
+## This works with both python 2 and 3.
+
+import heapq
+import os.path
+
+
+## Cost units are about one megapixel rendered.  Each panel also has
+## the overhead of the requests to the server.
+PANEL_COST = 0.5
+
+## Images larger than this many pixels are 'big' tiled images, only
+## the region in the panel is rendered (OMERO default maximum plane
+## size).
+BIG_IMAGE_PIXELS = 3192 * 3192
+
+## Pages are rendered at this dpi, by default, from 72 dpi figure
+## coordinates.
+DPI = 300
+
+
+def panel_cost(panel_json, dpi=DPI):
+    width = panel_json['orig_width']
+    height = panel_json['orig_height']
+    pixels = float(width) * height
+    if pixels > BIG_IMAGE_PIXELS:
+        ## Only the viewport is rendered, at about the page dpi (at
+        ## most max_export_dpi).
+        max_dpi = min(dpi, panel_json.get('max_export_dpi', 1000))
+        max_width = (panel_json['width'] * max_dpi) / 72.0
+        region_width = min(max_width, width)
+        pixels = region_width * region_width * (float(height) / width)
+    depth = 1
+    if (panel_json.get('z_projection') and 'z_start' in panel_json
+            and 'z_end' in panel_json):
+        depth = abs(panel_json['z_end'] - panel_json['z_start']) + 1
+    return PANEL_COST + (pixels * depth) / 1e6
+
+
+def estimate_cost(figure_json, dpi=DPI):
+    """Cost to render a figure at dpi, in arbitrary units."""
+    cost = sum([panel_cost(p, dpi) for p in figure_json['panels']])
+    page_count = int(figure_json.get('page_count') or 1)
+    page_scale = dpi / 72.0
+    page_pixels = (figure_json['paper_width'] * page_scale
+                   * figure_json['paper_height'] * page_scale)
+    return cost + (page_count * page_pixels) / 1e6
+
+
+def read_timings(fpath):
+    """Seconds to render each figure id in previous runs.
+
+    The file has one line per render with figure id, seconds, and
+    estimated cost, separated by tabs.  The last time for each figure
+    is used.
+    """
+    timings = {}
+    if not os.path.exists(fpath):
+        return timings
+    with open(fpath, 'r') as fh:
+        for line in fh:
+            fields = line.split('\t')
+            if len(fields) < 3:
+                continue  # partial line from an interrupted run
+            timings[int(fields[0])] = (float(fields[1]), float(fields[2]))
+    return timings
+
+
+def append_timing(fpath, fig_id, seconds, cost):
+    with open(fpath, 'a') as fh:
+        fh.write('%d\t%f\t%f\n' % (fig_id, seconds, cost))
+
+
+def predict_seconds(costs, timings):
+    """Seconds to render each figure in costs (dict of id to cost)."""
+    rates = sorted([seconds / cost for seconds, cost in timings.values()
+                    if cost > 0])
+    rate = 1.0
+    if rates:
+        rate = rates[len(rates) // 2]
+    predicted = {}
+    for fig_id, cost in costs.items():
+        if fig_id in timings:
+            predicted[fig_id] = timings[fig_id][0]
+        else:
+            predicted[fig_id] = cost * rate
+    return predicted
+
+
+def longest_first(predicted):
+    """Figure ids from longest to shortest to render."""
+    return sorted(predicted.keys(), key=lambda i: (-predicted[i], i))
+
+
+def makespan(predicted, order, n_workers):
+    """Total time if figures in order go to the next free worker."""
+    workers = [0.0] * n_workers
+    for fig_id in order:
+        heapq.heapreplace(workers, workers[0] + predicted[fig_id])
+    return max(workers)
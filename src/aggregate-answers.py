@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## SYNOPSIS
+##   aggregate-answers [--incremental] [--jobs N] TABLE-DIR ANSWERS-DIR ...
+##
+## Combines the answers of all scorers, from the questionnaire
+## answers files in ANSWERS-DIR, into a table with columns image,
+## scorer, question, answer, and time.  Answers of questions with
+## multiple selections (CheckQuestion) have one row per selected
+## option.
+##
+## The table is saved in TABLE-DIR as zstd compressed parquet files,
+## one per run, which can be read together as a single table, e.g.
+## with pyarrow.parquet.read_table(TABLE-DIR) or pandas.read_parquet.
+##
+## With --incremental, only answers added since the last run are
+## read and saved as a new part.  Without it, the table is rebuilt.
+##
+## Answers in the old one pickle file per image format are not read.
+## If there are any, this fails until they are imported with
+## questionnaire --import-pickles.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import os.path
+import sys
+import typing
+
+import pyarrow
+import pyarrow.parquet
+
+import answer_store
+
+
+COLUMNS = ('image', 'scorer', 'question', 'answer', 'time')
+
+## Byte offset already read of each answers file, so that an
+## incremental run knows where to start, and the parts that make the
+## table.  Starts with '_' so that parquet readers ignore it when
+## reading the whole directory.
+STATE_FNAME = '_state.json'
+
+
+def read_store(fpath: str, offset: int
+               ) -> typing.Tuple[str, int, typing.Dict[str, typing.List[str]]]:
+    """Columns for the records of an answers file after offset.
+
+    Returns the file path, the offset up to where it was read, and
+    the columns.
+    """
+    columns: typing.Dict[str, list] = {name: [] for name in COLUMNS}
+    for start, offset, record in answer_store.read_records(fpath, offset):
+        multi = set(record.get('multi', []))
+        for question, answer in record['answers']:
+            if question in multi and answer:
+                options = answer.split('\t')
+            else:
+                options = [answer]
+            for option in options:
+                columns['image'].append(record['image'])
+                columns['scorer'].append(record['scorer'])
+                columns['question'].append(question)
+                columns['answer'].append(option)
+                columns['time'].append(record['time'])
+    return fpath, offset, columns
+
+
+def read_state(table_dir: str) -> dict:
+    try:
+        with open(os.path.join(table_dir, STATE_FNAME), 'r') as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {'offsets': {}, 'parts': []}
+
+
+def write_state(table_dir: str, state: dict) -> None:
+    fpath = os.path.join(table_dir, STATE_FNAME)
+    with open(fpath + '.tmp', 'w') as fh:
+        json.dump(state, fh, indent=1, sort_keys=True)
+    os.replace(fpath + '.tmp', fpath)
+
+
+def list_parts(table_dir: str) -> typing.List[str]:
+    return sorted([fname for fname in os.listdir(table_dir)
+                   if fname.startswith('part-') and fname.endswith('.parquet')])
+
+
+def remove_stale_parts(table_dir: str, parts: typing.Sequence[str]) -> None:
+    """Removes parts not in the table.
+
+    Those are left by a run that failed before saving its state, or
+    the parts replaced by a run without --incremental.
+    """
+    for fname in list_parts(table_dir):
+        if fname not in parts:
+            os.remove(os.path.join(table_dir, fname))
+
+
+def next_part_fname(table_dir: str) -> str:
+    indices = [int(fname[len('part-'):-len('.parquet')])
+               for fname in list_parts(table_dir)]
+    return 'part-%05d.parquet' % (max(indices, default=-1) + 1)
+
+
+def aggregate(table_dir: str, answers_dirs: typing.Sequence[str],
+              incremental: bool, jobs: typing.Optional[int]) -> int:
+    """Returns number of new rows in the table."""
+    for answers_dir in answers_dirs:
+        n_pickles = len(answer_store.list_pickles(answers_dir))
+        if n_pickles:
+            raise RuntimeError('\'%s\' has %d answers in old pickle files,'
+                               ' import them with questionnaire'
+                               ' --import-pickles' % (answers_dir, n_pickles))
+
+    os.makedirs(table_dir, exist_ok=True)
+    state = read_state(table_dir)
+    remove_stale_parts(table_dir, state['parts'])
+    if incremental:
+        offsets = state['offsets']
+        parts = list(state['parts'])
+    else:
+        offsets = {}
+        parts = []
+
+    fpaths = []
+    for answers_dir in answers_dirs:
+        fpaths.extend([os.path.abspath(fpath) for fpath
+                       in answer_store.list_stores(answers_dir)])
+    for fpath in fpaths:
+        if os.path.getsize(fpath) < offsets.get(fpath, 0):
+            raise RuntimeError('answers file \'%s\' is smaller than when last'
+                               ' read, run without --incremental' % fpath)
+
+    table: typing.Dict[str, list] = {name: [] for name in COLUMNS}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(read_store, fpath, offsets.get(fpath, 0))
+                   for fpath in fpaths]
+        for future in futures:
+            fpath, offset, columns = future.result()
+            offsets[fpath] = offset
+            for name in COLUMNS:
+                table[name].extend(columns[name])
+
+    n_rows = len(table['image'])
+    if n_rows > 0:
+        ## Written with a name that parquet readers ignore, and only
+        ## renamed once complete.
+        part_fname = next_part_fname(table_dir)
+        tmp_fpath = os.path.join(table_dir, '_' + part_fname + '.tmp')
+        pyarrow.parquet.write_table(pyarrow.table(table), tmp_fpath,
+                                    compression='zstd')
+        os.replace(tmp_fpath, os.path.join(table_dir, part_fname))
+        parts.append(part_fname)
+    ## Saving the state is what adds the new part to the table.  Only
+    ## after that are the parts it replaces removed, so that a failed
+    ## run leaves the previous table.
+    write_state(table_dir, {'offsets': offsets, 'parts': parts})
+    remove_stale_parts(table_dir, parts)
+    return n_rows
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog='aggregate-answers')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Only add answers saved since the last run')
+    parser.add_argument('--jobs', action='store', type=int, default=None,
+                        help='Number of answers files read in parallel')
+    parser.add_argument('table_dir', action='store', type=str,
+                        help='Directory for the table files')
+    parser.add_argument('answers_dirs', action='store', type=str, nargs='+',
+                        help='Directories with questionnaire answers')
+    args = parser.parse_args(arguments[1:])
+    for answers_dir in args.answers_dirs:
+        if not os.path.isdir(answers_dir):
+            raise ValueError('no dir \'%s\' with answers' % answers_dir)
+    return args
+
+
+def main(argv):
+    args = parse_arguments(argv)
+    n_rows = aggregate(args.table_dir, args.answers_dirs, args.incremental,
+                       args.jobs)
+    print('%d new rows' % n_rows)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
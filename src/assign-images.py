@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## SYNOPSIS
+##   assign-images [--replicates N] [--seed SEED] [--by-compartment]
+##                 METADATA-FPATH FIGURES-DIR OUT-DIR SCORER ...
+##
+## Writes, for each scorer, the list of figure images they should
+## answer to OUT-DIR/SCORER.txt, one file path per line.  This is the
+## file for the questionnaire --img-list option.
+##
+## Each figure is given to N different scorers (default 1), to
+## measure agreement between scorers.  Figures are spread so that all
+## scorers get about the same number, and so that each pair of
+## scorers shares about the same number of figures.  The order of
+## each list is random and the lists have no gene names so scoring
+## is blind.
+##
+## With --by-compartment, figures are assigned separately for each
+## compartment (third column of the metadata) and the lists saved in
+## OUT-DIR/COMPARTMENT/SCORER.txt.
+##
+## Multi-page figures, saved as ID_page_NN.jpg, are assigned as a
+## whole: all of their pages go to the same scorers.
+
+import argparse
+import collections
+import csv
+import glob
+import itertools
+import os
+import os.path
+import random
+import sys
+import typing
+
+
+def figure_fpaths(figures_dir: str, fig_id: str) -> typing.List[str]:
+    """Image files of a figure, one per page."""
+    fpath = os.path.join(figures_dir, '%s.jpg' % fig_id)
+    if os.path.isfile(fpath):
+        return [fpath]
+    return sorted(glob.glob(os.path.join(figures_dir,
+                                         '%s_page_*.jpg' % fig_id)))
+
+
+def assign(fig_ids: typing.Sequence[str], scorers: typing.Sequence[str],
+           replicates: int, rng: random.Random
+           ) -> typing.Dict[str, typing.List[str]]:
+    """Figure ids for each scorer.
+
+    Each figure goes to the scorer with fewest figures so far, and
+    then to those who have shared fewest figures with the scorers
+    already chosen for it.  Ties are broken at random.
+    """
+    if replicates > len(scorers):
+        raise ValueError('can\'t give each figure to %d scorers when there'
+                         ' are only %d' % (replicates, len(scorers)))
+    load = collections.Counter({s: 0 for s in scorers})
+    shared: typing.Counter[typing.FrozenSet[str]] = collections.Counter()
+    assignments: typing.Dict[str, typing.List[str]] = {s: [] for s in scorers}
+
+    fig_ids = list(fig_ids)
+    rng.shuffle(fig_ids)
+    for fig_id in fig_ids:
+        chosen: typing.List[str] = []
+        for i in range(replicates):
+            candidates = [s for s in scorers if s not in chosen]
+            rng.shuffle(candidates)
+            candidates.sort(key=lambda s: (load[s],
+                                           sum([shared[frozenset((s, c))]
+                                                for c in chosen])))
+            chosen.append(candidates[0])
+        for scorer in chosen:
+            load[scorer] += 1
+            assignments[scorer].append(fig_id)
+        for pair in itertools.combinations(chosen, 2):
+            shared[frozenset(pair)] += 1
+
+    for scorer_fig_ids in assignments.values():
+        rng.shuffle(scorer_fig_ids)
+    return assignments
+
+
+def write_lists(out_dir: str, figures_dir: str,
+                assignments: typing.Dict[str, typing.List[str]]) -> None:
+    os.makedirs(out_dir, exist_ok=True)
+    for scorer, fig_ids in assignments.items():
+        with open(os.path.join(out_dir, scorer + '.txt'), 'w') as fh:
+            for fig_id in fig_ids:
+                for fpath in figure_fpaths(figures_dir, fig_id):
+                    fh.write(fpath + '\n')
+
+
+def read_metadata(fpath: str) -> typing.Dict[str, typing.List[str]]:
+    """Figure ids by compartment."""
+    by_compartment = collections.OrderedDict()
+    with open(fpath, 'r', newline='') as fh:
+        for row in csv.reader(fh):
+            fig_id, gene_name, compartment = row[:3]
+            by_compartment.setdefault(compartment, []).append(fig_id)
+    return by_compartment
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog='assign-images')
+    parser.add_argument('--replicates', action='store', type=int, default=1,
+                        help='Number of scorers for each figure')
+    parser.add_argument('--seed', action='store', type=int, default=None,
+                        help='Seed for the random assignment')
+    parser.add_argument('--by-compartment', action='store_true',
+                        help='Separate lists for each compartment')
+    parser.add_argument('metadata_fpath', action='store', type=str,
+                        help='Filepath for figures metadata csv file')
+    parser.add_argument('figures_dir', action='store', type=str,
+                        help='Directory with the figure images')
+    parser.add_argument('out_dir', action='store', type=str,
+                        help='Directory where to save the image lists')
+    parser.add_argument('scorers', action='store', type=str, nargs='+',
+                        help='Names of the scorers')
+    args = parser.parse_args(arguments[1:])
+    if not os.path.isfile(args.metadata_fpath):
+        raise ValueError('no metadata file \'%s\'' % args.metadata_fpath)
+    if not os.path.isdir(args.figures_dir):
+        raise ValueError('no dir \'%s\' with figures' % args.figures_dir)
+    if len(set(args.scorers)) != len(args.scorers):
+        raise ValueError('repeated scorer names')
+    if args.replicates < 1:
+        raise ValueError('number of replicates must be positive')
+    return args
+
+
+def main(argv):
+    args = parse_arguments(argv)
+    rng = random.Random(args.seed)
+    by_compartment = read_metadata(args.metadata_fpath)
+    if args.by_compartment:
+        for compartment, fig_ids in by_compartment.items():
+            out_dir = os.path.join(args.out_dir,
+                                   compartment.replace(os.sep, '_'))
+            assignments = assign(fig_ids, args.scorers, args.replicates, rng)
+            write_lists(out_dir, args.figures_dir, assignments)
+    else:
+        fig_ids = list(itertools.chain(*by_compartment.values()))
+        assignments = assign(fig_ids, args.scorers, args.replicates, rng)
+        write_lists(args.out_dir, args.figures_dir, assignments)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
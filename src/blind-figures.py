@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+## Copyright (C) 2020 David Pinto <david.pinto@bioch.ox.ac.uk>
+##
+## This program is free software: you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation, either version 3 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+## SYNOPSIS
+##   blind-figures [--jobs N] [--rule RULE ...]
+##                 RAW-DIR OUT-DIR METADATA-FPATH MAPPING-FPATH
+##
+## Blinds the figure JSONs in RAW-DIR, as saved by download-figures,
+## and saves them in OUT-DIR with the same file name.  No connection
+## to the OMERO server is needed so the blinding can be changed
+## without downloading the figures again.
+##
+## RULE is the name of a blinding rule in blinding.py: 'gene-label'
+## (the default), 'figure-name', and 'legend'.  Use --rule multiple
+## times to apply more than one.
+##
+## What was removed from each figure is saved in MAPPING-FPATH, one
+## JSON object per line, with the figure id, gene name, and what each
+## rule removed.  This is needed to unblind the figures.
+
+import argparse
+import json
+import multiprocessing
+import os
+import os.path
+import sys
+
+import blinding
+
+
+def blind_file(job):
+    raw_dir, out_dir, metadata, rules = job
+    fname = '%d.json' % metadata.fig_id
+    with open(os.path.join(raw_dir, fname), 'r') as fh:
+        fig_json = json.load(fh)
+    record = blinding.blind_figure(fig_json, metadata, rules)
+
+    ## Write to a temporary file first, so that an interrupted run
+    ## never leaves a partial JSON that make would consider done.
+    out_fpath = os.path.join(out_dir, fname)
+    with open(out_fpath + '.tmp', 'w') as fh:
+        json.dump(fig_json, fh)
+    os.rename(out_fpath + '.tmp', out_fpath)
+    return record
+
+
+def read_metadata(fpath):
+    with open(fpath, 'r') as fh:
+        for line in fh:
+            fields = line.rstrip('\n').split(',')
+            yield blinding.FigureMetadata(int(fields[0]), fields[1])
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog='blind-figures')
+    parser.add_argument('--jobs', action='store', type=int, default=None,
+                        help='Number of figures blinded in parallel')
+    parser.add_argument('--rule', action='append', dest='rules',
+                        choices=list(blinding.RULES.keys()),
+                        help='Blinding rule to apply (repeat for more)')
+    parser.add_argument('raw_dir', action='store', type=str,
+                        help='Directory with the figure JSONs')
+    parser.add_argument('out_dir', action='store', type=str,
+                        help='Directory where to save the blinded JSONs')
+    parser.add_argument('metadata_fpath', action='store', type=str,
+                        help='Filepath for figures metadata csv file')
+    parser.add_argument('mapping_fpath', action='store', type=str,
+                        help='Filepath where to save the unblinding mapping')
+    args = parser.parse_args(arguments[1:])
+    if not os.path.isdir(args.raw_dir):
+        raise ValueError('no dir \'%s\' with figures' % args.raw_dir)
+    if not os.path.isdir(args.out_dir):
+        raise ValueError('no dir \'%s\' to save figures' % args.out_dir)
+    if not os.path.isfile(args.metadata_fpath):
+        raise ValueError('no metadata file \'%s\'' % args.metadata_fpath)
+    if args.rules is None:
+        args.rules = list(blinding.DEFAULT_RULES)
+    return args
+
+
+def main(argv):
+    args = parse_arguments(argv)
+    jobs = ((args.raw_dir, args.out_dir, metadata, args.rules)
+            for metadata in read_metadata(args.metadata_fpath))
+    pool = multiprocessing.Pool(args.jobs)
+    try:
+        with open(args.mapping_fpath + '.tmp', 'w') as fh:
+            for record in pool.imap_unordered(blind_file, jobs, chunksize=8):
+                fh.write(json.dumps(record) + '\n')
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+    os.rename(args.mapping_fpath + '.tmp', args.mapping_fpath)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -16,17 +16,15 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
 import os.path
 import sys
 
 import omero_tools
 
 
-## OMERO image ID with a blank image.  It is used to place text in
-## arbitrary figure locations.
-BLANK_IMAGE_ID = 283965
-
+## Figures are saved as they are in OMERO, without blinding, so that
+## the blinding can be changed without downloading them again.  See
+## blind-figures.py.
 
 def main(dir_path, metadata_fpath):
     metadata = [line.split(',') for line in open(metadata_fpath, 'r')]
@@ -35,27 +33,13 @@ def main(dir_path, metadata_fpath):
     conn.SERVICE_OPTS.setOmeroGroup(-1)
     for fig_metadata in metadata:
         fig_id = int(fig_metadata[0])
-        gene_name = fig_metadata[1]
 
         fig = conn.getObject('FileAnnotation', fig_id)
         if fig is None:
             print("no object with id '%d'" % fig_id)
-        fig_json = json.loads("".join(fig.getFileInChunks()))
-
-        ## The gene name is in the 'title' of the figure.  The 'title'
-        ## is the label of a panel with a blank image.  We want to
-        ## remove this panel so that the scoring is done blindly.
-        ## However, the same image is used in other places in the
-        ## figure to introduce text and we want to keep those.  So
-        ## only remove panels if the gene name is used in the label.
-        panels = fig_json['panels']
-        for i, panel in enumerate(panels):
-            if panel['imageId'] == BLANK_IMAGE_ID:
-                if any([gene_name in l['text'] for l in panel['labels']]):
-                    panels.pop(i)
-                    break
         with open(os.path.join(dir_path, '%d.json' % fig_id), 'w') as fh:
-            json.dump(fig_json, fh)
+            for chunk in fig.getFileInChunks():
+                fh.write(chunk)
 
 
 if __name__ == '__main__':
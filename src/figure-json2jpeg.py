@@ -16,42 +16,266 @@
 ## You should have received a copy of the GNU General Public License
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
-import json
+## SYNOPSIS
+##   figure-json2jpeg [--memory-budget MIB] [--jobs N] [--dpi DPI]
+##                    [--preview] [--out-dir OUT-DIR]
+##                    FIGURES-DIR METADATA-FPATH
+##
+## Renders the figure JSONs in FIGURES-DIR as JPEGs, in OUT-DIR
+## (FIGURES-DIR by default).  With N jobs, figures are rendered in N
+## processes, longest figures first (see render_schedule.py).  The
+## time to render each figure is saved in OUT-DIR/render-times.tsv to
+## plan the next runs.
+##
+## Once all pages of a figure are written, an empty OUT-DIR/ID.stamp
+## file is saved.  Multi-page figures have one JPEG per page, so this
+## is what the Makefile uses to know which figures are done.
+##
+## Figures are rendered at 300 dpi, or DPI.  Images are requested
+## from the server at no more resolution than that needs.  --preview
+## is for a quick look at the figures: it renders at 72 dpi, in
+## FIGURES-DIR/preview unless OUT-DIR is given.
+##
+## The memory budget, in MiB, bounds the memory to render each page.
+
+import argparse
+import multiprocessing
+import os
 import os.path
 import sys
+import time
 
+import figure_cache
 import omero_tools
-from Figure_To_Pdf import TiffExport
+import render_schedule
+from Figure_To_Pdf import EXPORT_DPI, PREVIEW_DPI, PageWriter, TiffExport
+
+
+class JpegExport(TiffExport):
+    """TiffExport that saves each page as a JPEG in a directory.
+
+    Single page figures keep the plain <id>.jpg name which is what the
+    Makefile expects.  Pages of multi-page figures are saved as
+    separate files, never zipped.
+    """
+    ## JPEG can't be written in strips, pages are always drawn whole.
+    can_write_strips = False
+
+    def __init__(self, dir_path, fig_id, *args, **kwargs):
+        super(JpegExport, self).__init__(*args, **kwargs)
+        self.dir_path = dir_path
+        self.fig_id = fig_id
 
+    def should_create_zip(self):
+        return False
 
-def main(dir_path, metadata_fpath):
+    def get_figure_file_name(self, page=None):
+        if self.page_count > 1:
+            return os.path.join(self.dir_path, '%d_page_%02d.jpg'
+                                % (self.fig_id, page or 1))
+        return os.path.join(self.dir_path, '%d.jpg' % self.fig_id)
+
+
+## State of each render process, set by init_worker.
+_worker = {}
+
+
+def cache_fpath(dir_path):
+    return os.path.join(dir_path, 'figures.cache')
+
+
+def init_worker(dir_path, out_dir, memory_budget, export_dpi,
+                flush_each_figure):
     conn = omero_tools.get_connection()
     conn.SERVICE_OPTS.setOmeroGroup(-1)
+    _worker['conn'] = conn
+    _worker['out_dir'] = out_dir
+    _worker['memory_budget'] = memory_budget
+    _worker['export_dpi'] = export_dpi
+    _worker['cache'] = figure_cache.FigureCache(cache_fpath(dir_path),
+                                                dir_path)
+    ## Pages are written in the background while the next figure is
+    ## being rendered.  In a pool of processes there's no hook to
+    ## wait for the writes when a process exits so wait after each
+    ## figure instead.
+    _worker['page_writer'] = PageWriter()
+    _worker['flush_each_figure'] = flush_each_figure
+    ## Exporters of figures whose pages may still be being written.
+    _worker['exports'] = {}
+
+
+def close_worker():
+    _worker['page_writer'].close()
+    _worker['cache'].close()
+
+
+def render_figure(fig_id):
+    """Returns figure id and seconds to render it.
+
+    Unless flushing each figure, its pages may still be being written
+    when this returns, use wait_figure to wait for them.
+    """
+    start = time.time()
+    export_params = {
+        'Figure_JSON' : _worker['cache'].get(fig_id),
+        'Webclient_URI': 'https://omero1.bioch.ox.ac.uk',
+        'Export_Option' : 'TIFF', # change to jpeg
+    }
+    fig_export = JpegExport(_worker['out_dir'], fig_id, _worker['conn'],
+                            export_params, export_images=False,
+                            memory_budget=_worker['memory_budget'],
+                            page_writer=_worker['page_writer'],
+                            export_dpi=_worker['export_dpi'])
+    fig_export.build_figure()
+    seconds = time.time() - start
+    _worker['exports'][fig_id] = fig_export
+    if _worker['flush_each_figure']:
+        wait_figure(fig_id)
+    return fig_id, seconds
+
+
+def wait_figure(fig_id):
+    """Waits for the pages of a figure, raising error if any failed."""
+    fig_export = _worker['exports'].pop(fig_id)
+    try:
+        _worker['page_writer'].join(fig_export)
+    except RuntimeError as e:
+        raise RuntimeError('figure %d: %s' % (fig_id, e))
+
+
+def timings_fpath(out_dir):
+    ## Next to the JPEGs, so that previews don't change the timings of
+    ## full renders.
+    return os.path.join(out_dir, 'render-times.tsv')
+
+
+def touch_stamp(out_dir, fig_id):
+    fpath = os.path.join(out_dir, '%d.stamp' % fig_id)
+    open(fpath, 'a').close()
+    os.utime(fpath, None)
+
+
+def plan_renders(out_dir, fig_ids, cache, jobs, export_dpi):
+    """Returns figure ids in render order, and their estimated cost."""
+    costs = dict([(fig_id, render_schedule.estimate_cost(cache.get(fig_id),
+                                                         export_dpi))
+                  for fig_id in fig_ids])
+    timings = render_schedule.read_timings(timings_fpath(out_dir))
+    predicted = render_schedule.predict_seconds(costs, timings)
+    order = render_schedule.longest_first(predicted)
+    print('rendering %d figures with %d jobs, expected to take %.0f seconds'
+          % (len(order), jobs,
+             render_schedule.makespan(predicted, order, jobs)))
+    return order, costs
+
+
+def render_figures(order, jobs, worker_args):
+    """Yields figure id and seconds to render, as each is done.
+
+    A figure is only done once its pages are written.  worker_args
+    are the arguments for init_worker, except the last.
+    """
+    if jobs == 1:
+        init_worker(*(worker_args + (False,)))
+        try:
+            ## The pages of each figure are written while the next
+            ## one is rendered.
+            previous = None
+            for fig_id in order:
+                result = render_figure(fig_id)
+                if previous is not None:
+                    wait_figure(previous[0])
+                    yield previous
+                previous = result
+            if previous is not None:
+                wait_figure(previous[0])
+                yield previous
+        finally:
+            close_worker()
+    else:
+        pool = multiprocessing.Pool(jobs, init_worker, worker_args + (True,))
+        try:
+            for result in pool.imap_unordered(render_figure, order, 1):
+                yield result
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+
+def parse_arguments(arguments):
+    parser = argparse.ArgumentParser(prog='figure-json2jpeg')
+    parser.add_argument('--memory-budget', action='store', type=int,
+                        default=None,
+                        help='Memory budget, in MiB, to render each page')
+    parser.add_argument('--jobs', action='store', type=int, default=1,
+                        help='Number of figures rendered in parallel')
+    parser.add_argument('--dpi', action='store', type=int, default=None,
+                        help='Resolution of the JPEGs (default %d)'
+                        % EXPORT_DPI)
+    parser.add_argument('--preview', action='store_true',
+                        help='Quick low resolution render (%d dpi)'
+                        % PREVIEW_DPI)
+    parser.add_argument('--out-dir', action='store', type=str, default=None,
+                        help='Directory where to save the JPEGs')
+    parser.add_argument('dir_path', action='store', type=str,
+                        help='Directory with the figure JSONs')
+    parser.add_argument('metadata_fpath', action='store', type=str,
+                        help='Filepath for figures metadata csv file')
+    args = parser.parse_args(arguments[1:])
+    if not os.path.isdir(args.dir_path):
+        raise ValueError('no dir \'%s\' with figures' % args.dir_path)
+    if not os.path.isfile(args.metadata_fpath):
+        raise ValueError('no metadata file \'%s\'' % args.metadata_fpath)
+    if args.jobs < 1:
+        raise ValueError('number of jobs must be positive')
+    if args.dpi is None:
+        args.dpi = PREVIEW_DPI if args.preview else EXPORT_DPI
+    if args.dpi < 1:
+        raise ValueError('dpi must be positive')
+    if args.out_dir is None:
+        if args.preview:
+            args.out_dir = os.path.join(args.dir_path, 'preview')
+            if not os.path.isdir(args.out_dir):
+                os.mkdir(args.out_dir)
+        else:
+            args.out_dir = args.dir_path
+    elif not os.path.isdir(args.out_dir):
+        raise ValueError('no dir \'%s\' to save figures' % args.out_dir)
+    return args
+
 
-    metadata = [line.split(',') for line in open(metadata_fpath, 'r')]
-    for fig_metadata in metadata:
-        fig_id = int(fig_metadata[0])
+def main(argv):
+    args = parse_arguments(argv)
+    ## Memory budget is given in MiB.  Pages are rendered one at a
+    ## time so this bounds the memory per page, not per figure.
+    memory_budget = None
+    if args.memory_budget is not None:
+        memory_budget = args.memory_budget * 1024 * 1024
 
-        json_path = os.path.join(dir_path, '%d.json' % fig_id)
-        with open(json_path, 'r') as fh:
-            fig_text = fh.read()
+    metadata = [line.split(',') for line in open(args.metadata_fpath, 'r')]
+    fig_ids = [int(fig_metadata[0]) for fig_metadata in metadata]
 
-        fig_json = json.loads(fig_text)
-        if int(fig_json['page_count']) > 1:
-            raise RuntimeError("more than one page for figure id '%d'" % fig_id)
+    ## Figures are read from a cache of the parsed JSONs in the same
+    ## directory, only figures whose JSON changed are parsed again.
+    ## Updated here, before the render processes open it.
+    cache = figure_cache.FigureCache(cache_fpath(args.dir_path),
+                                     args.dir_path)
+    try:
+        cache.update(fig_ids)
+        order, costs = plan_renders(args.out_dir, fig_ids, cache, args.jobs,
+                                    args.dpi)
+    finally:
+        cache.close()
 
-        export_params = {
-            'Figure_JSON' : fig_text,
-            'Webclient_URI': 'https://omero1.bioch.ox.ac.uk',
-            'Export_Option' : 'TIFF', # change to jpeg
-        }
-        fig_export = TiffExport(conn, export_params,
-                                export_images=False)
-        def get_figure_file_name(page=None):
-            return os.path.join(dir_path, '%d.jpg' % fig_id)
-        fig_export.get_figure_file_name = get_figure_file_name
-        fig_export.build_figure()
+    worker_args = (args.dir_path, args.out_dir, memory_budget, args.dpi)
+    for fig_id, seconds in render_figures(order, args.jobs, worker_args):
+        render_schedule.append_timing(timings_fpath(args.out_dir), fig_id,
+                                      seconds, costs[fig_id])
+        touch_stamp(args.out_dir, fig_id)
 
 
 if __name__ == '__main__':
-    main(*sys.argv[1:])
+    main(sys.argv)
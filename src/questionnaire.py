@@ -17,13 +17,35 @@
 ## along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 ## SYNOPSIS
-##   questionnaire QUESTIONS-FPATH SAVE-DIR [IMG-FPATHS ...]
+##   questionnaire [--scorer NAME] [--queue] [--img-list LIST-FPATH]
+##                 QUESTIONS-FPATH SAVE-DIR [IMG-FPATHS ...]
+##   questionnaire --import-pickles [--scorer NAME] QUESTIONS-FPATH SAVE-DIR
+##
+##   Images are IMG-FPATHS followed by the images listed in LIST-FPATH,
+##   one file path per line (see assign-images.py).
+##
+## ANSWERS
+##
+##   Answers are appended to SAVE-DIR/NAME.jsonl, one line per image,
+##   where NAME defaults to the login name (see answer_store.py).
+##   Images already answered by NAME are skipped, so quitting and
+##   starting again resumes at the first image not answered.
+##
+##   With --queue, the images are shared with all other scorers
+##   using the same SAVE-DIR and --queue.  Each image is only given
+##   to one scorer.
+##
+##   Older versions saved the answers as SAVE-DIR/IMAGE.pickle, one
+##   file per image.  With --import-pickles, those are appended to
+##   the answers of NAME, and renamed to IMAGE.pickle.imported.  Use
+##   the same QUESTIONS-FPATH they were answered with, so that the
+##   CheckQuestion answers are recognised.
 ##
 ## FORMAT OF QUESTIONS FILE
 ##
 ##   The questions file is a python file with a QUESTIONS variable.
 ##   This QUESTIONS variable must be a list of objects subclassing
-##   QuestionWidget (see source code).  There are CheckQuestion,
+##   Question (see source code).  There are CheckQuestion,
 ##   RadioQuestion, and TextQuestion:
 ##
 ##       CheckQuestion provides a question with multiple answers with
@@ -47,43 +69,182 @@
 ##       ]
 
 import argparse
+import collections
 import collections.abc
+import concurrent.futures
+import getpass
+import json
+import math
 import os.path
-import pickle
+import shutil
 import subprocess
 import sys
+import tempfile
 import typing
 
-from PyQt5 import QtCore, QtWidgets
+from PyQt5 import QtCore, QtGui, QtWidgets
 
+import answer_store
 
-class QuestionWidget(QtWidgets.QWidget):
-    def __init__(self, question: str, *args, **kwargs) -> None:
-        super().__init__(*args, **kwargs)
-        self._question = QtWidgets.QLabel(text=question, parent=self)
 
-    def to_serializable(self) -> typing.Tuple[str, str]:
-        """Two element tuple with question and answer text"""
+class Question:
+    """A question and how to answer it, without any widget.
+
+    The answer state is kept in a QuestionnaireModel, as a compact
+    value whose type depends on the question: the index of the
+    selected option, the indices of the checked options, or the text.
+    Widgets are only created when the questionnaire is shown.
+    """
+    def __init__(self, question: str) -> None:
+        self.question = question
+
+    def default(self) -> typing.Any:
         raise NotImplementedError()
 
-    def reset(self) -> None:
+    def answer_text(self, value: typing.Any) -> str:
         raise NotImplementedError()
 
-class RadioQuestion(QuestionWidget):
-    """QuestionWidget for group of radio buttons."""
-    def __init__(self, question: str, options: typing.Sequence[str],
+    def create_widget(self, model: 'QuestionnaireModel', index: int,
+                      parent: QtWidgets.QWidget) -> 'QuestionView':
+        raise NotImplementedError()
+
+
+class RadioQuestion(Question):
+    """Question with options, only one can be selected."""
+    def __init__(self, question: str, options: typing.Sequence[str]) -> None:
+        super().__init__(question)
+        self.options = tuple(options)
+
+    def default(self) -> int:
+        # By default, select first option.  We need to start with one
+        # select otherwise we may end in a state where none is
+        # selected.
+        return 0
+
+    def answer_text(self, value: int) -> str:
+        return self.options[value]
+
+    def create_widget(self, model, index, parent):
+        return RadioQuestionView(self, model, index, parent=parent)
+
+
+class CheckQuestion(Question):
+    """Question with options, any number can be selected."""
+    def __init__(self, question: str, options: typing.Sequence[str]) -> None:
+        super().__init__(question)
+        self.options = tuple(options)
+
+    def default(self) -> typing.FrozenSet[int]:
+        return frozenset()
+
+    def answer_text(self, value: typing.FrozenSet[int]) -> str:
+        return '\t'.join([self.options[i] for i in sorted(value)])
+
+    def create_widget(self, model, index, parent):
+        return CheckQuestionView(self, model, index, parent=parent)
+
+
+class TextQuestion(Question):
+    """Question answered with any text."""
+    def __init__(self, question: str, start_text: str = '') -> None:
+        super().__init__(question)
+        self.start_text = start_text
+
+    def default(self) -> str:
+        return self.start_text
+
+    def answer_text(self, value: str) -> str:
+        return value
+
+    def create_widget(self, model, index, parent):
+        return TextQuestionView(self, model, index, parent=parent)
+
+
+class QuestionnaireModel(QtCore.QObject):
+    """Answers to all questions of the questionnaire.
+
+    Only the answers that differ from the default are tracked, so
+    that reset and serialization after each image do work in
+    proportion to the number of answers changed and not to the size
+    of the questionnaire.
+    """
+    answer_changed = QtCore.pyqtSignal(int)
+
+    def __init__(self, questions: typing.Sequence[Question],
                  *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.questions = list(questions)
+        self._defaults = [q.default() for q in self.questions]
+        self._default_texts = [(q.question, q.answer_text(d))
+                               for q, d in zip(self.questions, self._defaults)]
+        ## Index of question to its answer value, only for those
+        ## with an answer different from the default.
+        self._changed: typing.Dict[int, typing.Any] = {}
+        self._multi = [q.question for q in self.questions
+                       if isinstance(q, CheckQuestion)]
+
+    def __len__(self) -> int:
+        return len(self.questions)
+
+    def answer(self, index: int) -> typing.Any:
+        return self._changed.get(index, self._defaults[index])
+
+    def set_answer(self, index: int, value: typing.Any) -> None:
+        if value == self.answer(index):
+            return
+        if value == self._defaults[index]:
+            del self._changed[index]
+        else:
+            self._changed[index] = value
+        self.answer_changed.emit(index)
+
+    def to_serializable(self) -> typing.List[typing.Tuple[str, str]]:
+        """List of question and answer text for all questions."""
+        answers = list(self._default_texts)
+        for index, value in self._changed.items():
+            question = self.questions[index]
+            answers[index] = (question.question, question.answer_text(value))
+        return answers
+
+    def multi_answer_questions(self) -> typing.List[str]:
+        """Questions whose answer is multiple options joined by tabs."""
+        return self._multi
+
+    def reset(self) -> None:
+        changed = list(self._changed.keys())
+        self._changed.clear()
+        for index in changed:
+            self.answer_changed.emit(index)
+
+
+class QuestionView(QtWidgets.QWidget):
+    """Widget for one question, bound to its answer in the model."""
+    def __init__(self, question: Question, model: QuestionnaireModel,
+                 index: int, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._model = model
+        self._index = index
+        self._question = QtWidgets.QLabel(text=question.question, parent=self)
+        model.answer_changed.connect(self._on_answer_changed)
+
+    def _on_answer_changed(self, index: int) -> None:
+        if index == self._index:
+            self.show_answer(self._model.answer(index))
+
+    def show_answer(self, value: typing.Any) -> None:
+        raise NotImplementedError()
+
+
+class RadioQuestionView(QuestionView):
+    """QuestionView for group of radio buttons."""
+    def __init__(self, question: RadioQuestion, *args, **kwargs) -> None:
         super().__init__(question, *args, **kwargs)
         self._answer = QtWidgets.QButtonGroup(parent=self)
-
-        for i, option in enumerate(options):
+        for i, option in enumerate(question.options):
             button = QtWidgets.QRadioButton(text=option, parent=self)
-            # By default, select first option.  We need to
-            # start with one select otherwise we may end in a
-            # state where none is selected.
-            if i == 0:
-                button.setChecked(True)
-            self._answer.addButton(button)
+            self._answer.addButton(button, i)
+        self.show_answer(self._model.answer(self._index))
+        self._answer.buttonToggled[int, bool].connect(self._on_toggled)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self._question)
@@ -94,25 +255,27 @@ class RadioQuestion(QuestionWidget):
         layout.addLayout(button_box)
         self.setLayout(layout)
 
-    def to_serializable(self) -> typing.Tuple[str, str]:
-        return (self._question.text(),
-                self._answer.checkedButton().text())
+    def _on_toggled(self, button_id: int, checked: bool) -> None:
+        if checked:
+            self._model.set_answer(self._index, button_id)
 
-    def reset(self) -> None:
-        self._answer.buttons()[0].setChecked(True)
+    def show_answer(self, value: int) -> None:
+        self._answer.blockSignals(True)
+        self._answer.button(value).setChecked(True)
+        self._answer.blockSignals(False)
 
 
-class CheckQuestion(QuestionWidget):
-    """QuestionWidget for group of check boxes."""
-    def __init__(self, question: str, options: typing.Sequence[str],
-                 *args, **kwargs) -> None:
+class CheckQuestionView(QuestionView):
+    """QuestionView for group of check boxes."""
+    def __init__(self, question: CheckQuestion, *args, **kwargs) -> None:
         super().__init__(question, *args, **kwargs)
         self._answer = QtWidgets.QButtonGroup(parent=self)
         self._answer.setExclusive(False)
-
-        for i, option in enumerate(options):
+        for i, option in enumerate(question.options):
             button = QtWidgets.QCheckBox(text=option, parent=self)
-            self._answer.addButton(button)
+            self._answer.addButton(button, i)
+        self.show_answer(self._model.answer(self._index))
+        self._answer.buttonToggled[int, bool].connect(self._on_toggled)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self._question)
@@ -123,71 +286,385 @@ class CheckQuestion(QuestionWidget):
         layout.addLayout(button_box)
         self.setLayout(layout)
 
-    def to_serializable(self) -> typing.Tuple[str, str]:
-        answers = [b.text() for b in self._answer.buttons() if b.isChecked()]
-        return (self._question.text(), '\t'.join(answers))
-
-    def reset(self) -> None:
+    def _on_toggled(self, button_id: int, checked: bool) -> None:
+        value = set(self._model.answer(self._index))
+        if checked:
+            value.add(button_id)
+        else:
+            value.discard(button_id)
+        self._model.set_answer(self._index, frozenset(value))
+
+    def show_answer(self, value: typing.FrozenSet[int]) -> None:
+        ## Only the boxes whose state differs, usually few.
+        self._answer.blockSignals(True)
         for button in self._answer.buttons():
-            button.setChecked(False)
+            checked = self._answer.id(button) in value
+            if button.isChecked() != checked:
+                button.setChecked(checked)
+        self._answer.blockSignals(False)
 
 
-class TextQuestion(QuestionWidget):
-    """QuestionWidget for text box."""
-    def __init__(self, question: str, start_text: str = '',
-                 *args, **kwargs) -> None:
+class TextQuestionView(QuestionView):
+    """QuestionView for text box."""
+    def __init__(self, question: TextQuestion, *args, **kwargs) -> None:
         super().__init__(question, *args, **kwargs)
-        self._answer = QtWidgets.QPlainTextEdit(start_text, parent=self)
-        self._start_text = start_text
+        self._answer = QtWidgets.QPlainTextEdit(parent=self)
+        self.show_answer(self._model.answer(self._index))
+        self._answer.textChanged.connect(self._on_text_changed)
 
         layout = QtWidgets.QVBoxLayout()
         layout.addWidget(self._question)
         layout.addWidget(self._answer)
         self.setLayout(layout)
 
-    def to_serializable(self) -> typing.Tuple[str, str]:
-        return (self._question.text(),
-                self._answer.toPlainText())
+    def _on_text_changed(self) -> None:
+        self._model.set_answer(self._index, self._answer.toPlainText())
 
-    def reset(self) -> None:
-        self._answer.setPlainText(self._start_text)
+    def show_answer(self, value: str) -> None:
+        self._answer.blockSignals(True)
+        self._answer.setPlainText(value)
+        self._answer.blockSignals(False)
 
 
 class Questionnaire(QtWidgets.QWidget):
-    def __init__(self, questions, *args, **kwargs):
+    """Widgets for all questions of a QuestionnaireModel."""
+    def __init__(self, model: QuestionnaireModel, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
-        self._questions = questions
+        self.model = model
 
         layout = QtWidgets.QVBoxLayout()
-        for question in self._questions:
-            layout.addWidget(question)
+        for index, question in enumerate(self.model.questions):
+            layout.addWidget(question.create_widget(self.model, index, self))
         self.setLayout(layout)
 
-    def to_serializable(self):
-        return [q.to_serializable() for q in self._questions]
 
-    def reset(self):
-        for question in self._questions:
-            question.reset()
+class TilePyramid:
+    """Multi-resolution tiles of an image, cached on disk.
+
+    Level 0 is the image at full resolution and each following level
+    is half the size of the previous one, down to a level that fits in
+    a single tile.  Tiles are saved in a ``FIGURE.tiles`` directory
+    next to the image, together with an ``info.json`` file, and are
+    only rebuilt if the image changes.  Building needs the whole image
+    in memory once but viewing only ever reads the tiles shown.
+    """
+    TILE_SIZE = 256
+
+    def __init__(self, fpath: str) -> None:
+        self.fpath = fpath
+        self.tiles_dir = fpath + '.tiles'
+        self.width = 0
+        self.height = 0
+        self.n_levels = 0
+        if not self._read_info():
+            self._build()
+
+    def _source_stat(self) -> typing.Dict[str, int]:
+        stat = os.stat(self.fpath)
+        return {'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size}
+
+    def _read_info(self) -> bool:
+        try:
+            with open(os.path.join(self.tiles_dir, 'info.json'), 'r') as fh:
+                info = json.load(fh)
+        except (OSError, ValueError):
+            return False
+        if (info.get('source') != self._source_stat()
+                or info.get('tile_size') != self.TILE_SIZE):
+            return False
+        self.width = info['width']
+        self.height = info['height']
+        self.n_levels = info['n_levels']
+        return True
+
+    def _build(self) -> None:
+        reader = QtGui.QImageReader(self.fpath)
+        reader.setAutoTransform(True)
+        image = reader.read()
+        if image.isNull():
+            raise RuntimeError('failed to read image \'%s\': %s'
+                               % (self.fpath, reader.errorString()))
+        self.width = image.width()
+        self.height = image.height()
+
+        # Build in a temporary directory and rename at the end so
+        # that an interrupted build is never mistaken for a good one.
+        # The directory is unique so that other scorers building the
+        # same pyramid, with a shared cache, don't touch it.
+        tmp_dir = tempfile.mkdtemp(
+            prefix=os.path.basename(self.tiles_dir) + '.tmp-',
+            dir=os.path.dirname(os.path.abspath(self.tiles_dir)))
+        try:
+            os.chmod(tmp_dir, 0o755) # mkdtemp makes it private
+            self._build_levels(image, tmp_dir)
+        except:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+        self._move_into_place(tmp_dir)
+
+    def _build_levels(self, image: QtGui.QImage, tmp_dir: str) -> None:
+        level = 0
+        while True:
+            level_dir = os.path.join(tmp_dir, str(level))
+            os.makedirs(level_dir)
+            for row in range(math.ceil(image.height() / self.TILE_SIZE)):
+                for col in range(math.ceil(image.width() / self.TILE_SIZE)):
+                    # Tiles on the right and bottom edges are smaller.
+                    tile = image.copy(QtCore.QRect(
+                        col * self.TILE_SIZE, row * self.TILE_SIZE,
+                        self.TILE_SIZE, self.TILE_SIZE).intersected(image.rect()))
+                    tile.save(os.path.join(level_dir, '%d_%d.jpg' % (col, row)),
+                              'JPEG', 90)
+            level += 1
+            if max(image.width(), image.height()) <= self.TILE_SIZE:
+                break
+            image = image.scaled(max(1, image.width() // 2),
+                                 max(1, image.height() // 2),
+                                 QtCore.Qt.IgnoreAspectRatio,
+                                 QtCore.Qt.SmoothTransformation)
+        self.n_levels = level
+
+        info = {
+            'source': self._source_stat(),
+            'tile_size': self.TILE_SIZE,
+            'width': self.width,
+            'height': self.height,
+            'n_levels': self.n_levels,
+        }
+        with open(os.path.join(tmp_dir, 'info.json'), 'w') as fh:
+            json.dump(info, fh)
+
+    def _move_into_place(self, tmp_dir: str) -> None:
+        """Renames the built pyramid to tiles_dir.
+
+        If another process already put a pyramid of the same image
+        there, that one is used and ours dropped.  A pyramid of an
+        older version of the image is moved aside and removed, nobody
+        can be reading it since its info no longer matches the image.
+        """
+        for attempt in range(3):
+            try:
+                os.rename(tmp_dir, self.tiles_dir)
+                return
+            except OSError:
+                pass # there's a pyramid there already
+            if self._read_info():
+                shutil.rmtree(tmp_dir, ignore_errors=True)
+                return
+            old_dir = tempfile.mkdtemp(
+                prefix=os.path.basename(self.tiles_dir) + '.old-',
+                dir=os.path.dirname(os.path.abspath(self.tiles_dir)))
+            try:
+                os.rename(self.tiles_dir, os.path.join(old_dir, 'tiles'))
+            except OSError:
+                pass # someone else moved it first
+            shutil.rmtree(old_dir, ignore_errors=True)
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise RuntimeError('failed to save tiles in \'%s\'' % self.tiles_dir)
+
+    def tile_fpath(self, level: int, col: int, row: int) -> str:
+        return os.path.join(self.tiles_dir, str(level), '%d_%d.jpg' % (col, row))
+
+
+class ImagePrefetcher:
+    """Prepares images in a background thread before they are needed.
+
+    While one image is being scored, the tile pyramids of the next
+    ``ahead`` images are built (or found in the disk cache) so that
+    moving to the next one doesn't wait on it.
+    """
+    def __init__(self, img_fpaths: typing.Sequence[str],
+                 ahead: int = 3) -> None:
+        self._img_fpaths = img_fpaths
+        self._ahead = ahead
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._images: typing.Dict[int, concurrent.futures.Future] = {}
+
+    def _schedule(self, index: int) -> None:
+        if index not in self._images and index < len(self._img_fpaths):
+            self._images[index] = self._executor.submit(TilePyramid,
+                                                        self._img_fpaths[index])
+
+    def get(self, index: int) -> TilePyramid:
+        """Pyramid for index, waits for it if not ready yet."""
+        # Drop images already seen, we never go back.
+        for old_index in [i for i in self._images if i < index]:
+            self._images.pop(old_index).cancel()
+        for i in range(index, index + self._ahead + 1):
+            self._schedule(i)
+        return self._images[index].result()
+
+    def shutdown(self) -> None:
+        """Cancels images not started, so that exit doesn't wait on them."""
+        for future in self._images.values():
+            future.cancel()
+        self._images.clear()
+        self._executor.shutdown(wait=False)
+
+
+class TiledImageItem(QtWidgets.QGraphicsItem):
+    """Graphics item that only paints the tiles that are visible.
+
+    The pyramid level is picked from the current zoom so the number of
+    tiles painted stays about the same at any zoom.  Recently used
+    tiles are kept in a bounded cache.
+    """
+    MAX_CACHED_TILES = 256
+
+    def __init__(self, pyramid: TilePyramid, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._pyramid = pyramid
+        self._tiles = collections.OrderedDict() # (level, col, row) -> QPixmap
+        self.setFlag(QtWidgets.QGraphicsItem.ItemUsesExtendedStyleOption)
+
+    def boundingRect(self) -> QtCore.QRectF:
+        return QtCore.QRectF(0, 0, self._pyramid.width, self._pyramid.height)
+
+    def _get_tile(self, level: int, col: int, row: int) -> QtGui.QPixmap:
+        key = (level, col, row)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+        else:
+            self._tiles[key] = QtGui.QPixmap(
+                self._pyramid.tile_fpath(level, col, row))
+            if len(self._tiles) > self.MAX_CACHED_TILES:
+                self._tiles.popitem(last=False)
+        return self._tiles[key]
+
+    def paint(self, painter: QtGui.QPainter,
+              option: QtWidgets.QStyleOptionGraphicsItem,
+              widget: typing.Optional[QtWidgets.QWidget] = None) -> None:
+        zoom = option.levelOfDetailFromTransform(painter.worldTransform())
+        level = 0
+        if 0 < zoom < 1:
+            level = int(math.log2(1.0 / zoom))
+        level = max(0, min(level, self._pyramid.n_levels - 1))
+
+        # Size of a tile of this level in full resolution coordinates.
+        scale = 2 ** level
+        tile_size = TilePyramid.TILE_SIZE * scale
+        exposed = option.exposedRect.intersected(self.boundingRect())
+        first_col = int(exposed.left() // tile_size)
+        last_col = int(math.ceil(exposed.right() / tile_size))
+        first_row = int(exposed.top() // tile_size)
+        last_row = int(math.ceil(exposed.bottom() / tile_size))
+
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        for row in range(first_row, last_row):
+            for col in range(first_col, last_col):
+                tile = self._get_tile(level, col, row)
+                if tile.isNull():
+                    continue
+                target = QtCore.QRectF(col * tile_size, row * tile_size,
+                                       tile.width() * scale,
+                                       tile.height() * scale)
+                painter.drawPixmap(target, tile, QtCore.QRectF(tile.rect()))
+
+
+class ImageView(QtWidgets.QGraphicsView):
+    """Shows the image being scored, with zoom and pan.
+
+    Starts with the whole image in view.  The mouse wheel zooms around
+    the cursor, dragging pans, and double click goes back to the whole
+    image.
+    """
+    ZOOM_STEP = 1.25
+
+    def __init__(self, img_fpaths: typing.Sequence[str],
+                 *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.setScene(QtWidgets.QGraphicsScene(self))
+        self.setMinimumSize(200, 200)
+        self.setDragMode(QtWidgets.QGraphicsView.ScrollHandDrag)
+        self.setTransformationAnchor(QtWidgets.QGraphicsView.AnchorUnderMouse)
+        self._img_fpaths = img_fpaths
+        self._prefetcher = ImagePrefetcher(img_fpaths)
+        self._item: typing.Optional[TiledImageItem] = None
+
+    def show_image(self, index: int) -> None:
+        self.scene().clear()
+        self._item = None
+        try:
+            pyramid = self._prefetcher.get(index)
+        except Exception as ex:
+            # Called from a signal, an exception here would abort the
+            # whole session.  The image can still be opened in the
+            # viewer and the questions answered.
+            self.scene().addText('Failed to show image')
+            self.scene().setSceneRect(self.scene().itemsBoundingRect())
+            error_dialog = QtWidgets.QErrorMessage(parent=self)
+            error_dialog.setModal(True)
+            error_dialog.showMessage('Failed to show image \'%s\': %s'
+                                     % (self._img_fpaths[index], ex))
+            return
+        self._item = TiledImageItem(pyramid)
+        self.scene().addItem(self._item)
+        self.scene().setSceneRect(self._item.boundingRect())
+        self.fit_image()
+
+    def fit_image(self) -> None:
+        if self._item is not None:
+            self.fitInView(self._item, QtCore.Qt.KeepAspectRatio)
+
+    def wheelEvent(self, event: QtGui.QWheelEvent) -> None:
+        if event.angleDelta().y() > 0:
+            self.scale(self.ZOOM_STEP, self.ZOOM_STEP)
+        else:
+            self.scale(1 / self.ZOOM_STEP, 1 / self.ZOOM_STEP)
+
+    def mouseDoubleClickEvent(self, event: QtGui.QMouseEvent) -> None:
+        self.fit_image()
+
+    def shutdown(self) -> None:
+        self._prefetcher.shutdown()
+
+    def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        self.shutdown()
+        super().closeEvent(event)
+
+
+class NoImagesError(RuntimeError):
+    """No images left to question, e.g. all claimed by other scorers."""
 
 
 class QuestionWidget(QtWidgets.QWidget):
-    def __init__(self, questions, save_dir, img_fpaths,
+    current_image_changed = QtCore.pyqtSignal(int)
+
+    ## With a work queue, number of images claimed ahead of the
+    ## current one, so that they can be prefetched.
+    QUEUE_AHEAD = 3
+
+    def __init__(self, questions, store, img_fpaths, queue=None,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.setWindowTitle('Blind Questions')
 
-        self.save_dir = save_dir
-        self.img_fpaths = img_fpaths
+        self.store = store
+        self.queue = queue
         self.current_img = 0
-
-        if len(img_fpaths) < 1:
-            raise RuntimeError('no images to question')
+        self.viewer = None
+
+        # Only images not answered yet.  With a queue, images are
+        # added to img_fpaths as they are claimed.
+        self._fpaths_by_id = {}
+        for fpath in img_fpaths:
+            image_id = answer_store.image_id_from_fpath(fpath)
+            if image_id not in self.store:
+                self._fpaths_by_id[image_id] = fpath
+        if self.queue is None:
+            self.img_fpaths = list(self._fpaths_by_id.values())
+        else:
+            self.img_fpaths = []
+            self.claim_images()
+
+        if len(self.img_fpaths) < 1:
+            raise NoImagesError('no images to question')
 
         open_button = QtWidgets.QPushButton('Open in Viewer', parent=self)
         open_button.clicked.connect(self.open_image)
 
-        self.questionnaire = Questionnaire(questions, parent=self)
+        self.model = QuestionnaireModel(questions, parent=self)
+        self.questionnaire = Questionnaire(self.model, parent=self)
 
         save_button = QtWidgets.QPushButton('save and next', parent=self)
         save_button.clicked.connect(self.save_and_next)
@@ -209,58 +686,107 @@ class QuestionWidget(QtWidgets.QWidget):
 
     def save_and_next(self):
         fig_file = self.img_fpaths[self.current_img]
-        fname = os.path.splitext(os.path.basename(fig_file))[0]
-        fpath = os.path.join(self.save_dir, fname + '.pickle')
-        if os.path.exists(fpath):
+        image_id = answer_store.image_id_from_fpath(fig_file)
+        if image_id in self.store:
             error_dialog = QtWidgets.QErrorMessage(parent=self)
             error_dialog.setModal(True)
-            error_dialog.showMessage('A file named \'%s\' for this image'
-                                     ' answers already exists.  Doing nothing'
-                                     ' until that is resolved' % fpath)
+            error_dialog.showMessage('Answers for image \'%s\' already exist'
+                                     ' in \'%s\'.  Doing nothing until that'
+                                     ' is resolved'
+                                     % (image_id, self.store.fpath))
             error_dialog.exec_();
             return
 
-        with open(fpath, 'wb') as fh:
-            pickle.dump(self.questionnaire.to_serializable(), fh)
+        self.store.append(image_id, self.model.to_serializable(),
+                          self.model.multi_answer_questions())
 
         # Close the image viewer to prevent situation where the users
         # ends up with more than one image to score open and
         # accidentally scores the wrong one.
-        self.viewer.terminate()
+        if self.viewer is not None:
+            self.viewer.terminate()
+            self.viewer = None
         self.next_image()
 
+    def claim_images(self):
+        """Claims images from the queue to have QUEUE_AHEAD pending."""
+        n_pending = len(self.img_fpaths) - self.current_img
+        n_wanted = self.QUEUE_AHEAD + 1 - n_pending
+        if self.queue is None or n_wanted < 1:
+            return
+        exclude = set(self.store.image_ids())
+        exclude.update([answer_store.image_id_from_fpath(f)
+                        for f in self.img_fpaths])
+        image_ids = self.queue.claim(self.store.scorer,
+                                     list(self._fpaths_by_id.keys()),
+                                     n_wanted, exclude)
+        self.img_fpaths.extend([self._fpaths_by_id[i] for i in image_ids])
+
+    def release_images(self):
+        """Releases claimed images that were not answered."""
+        if self.queue is None:
+            return
+        self.queue.release(self.store.scorer,
+                           [answer_store.image_id_from_fpath(f)
+                            for f in self.img_fpaths[self.current_img:]])
+
     def next_image(self):
-        self.questionnaire.reset()
+        self.model.reset()
         self.current_img +=1
+        self.claim_images()
         if not self.current_img < len(self.img_fpaths):
             error_dialog = QtWidgets.QErrorMessage(parent=self)
             error_dialog.setModal(True)
             error_dialog.showMessage("This is the end.")
             error_dialog.exec_()
             QtWidgets.qApp.quit()
+        else:
+            self.current_image_changed.emit(self.current_img)
 
 
 class QuestionWindow(QtWidgets.QMainWindow):
-    def __init__(self, questions, save_dir, img_fpaths,
+    def __init__(self, questions, store, img_fpaths, queue=None,
                  *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.widget = QuestionWidget(questions, save_dir, img_fpaths,
+        self.widget = QuestionWidget(questions, store, img_fpaths, queue,
                                      parent=self)
 
         self.scroll_area = QtWidgets.QScrollArea(self)
         self.scroll_area.setWidget(self.widget)
         self.scroll_area.setAlignment(QtCore.Qt.AlignHCenter)
-        self.setCentralWidget(self.scroll_area)
+
+        self.image_view = ImageView(self.widget.img_fpaths, parent=self)
+        self.widget.current_image_changed.connect(self.image_view.show_image)
+        self.image_view.show_image(self.widget.current_img)
+
+        splitter = QtWidgets.QSplitter(self)
+        splitter.addWidget(self.image_view)
+        splitter.addWidget(self.scroll_area)
+        splitter.setStretchFactor(0, 1)
+        self.setCentralWidget(splitter)
+
+    def shutdown(self) -> None:
+        """Releases claimed images and stops loading images.
+
+        Called when the window closes and when the application quits,
+        which does not close the window.  Safe to call more than once.
+        """
+        self.widget.release_images()
+        self.image_view.shutdown()
+
+    def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        self.shutdown()
+        super().closeEvent(event)
 
 
 def validate_questions(questions) -> None:
     if not isinstance(questions, collections.abc.Sequence):
         raise ValueError('QUESTIONS must be a sequence')
-    if any([isinstance(q, QuestionWidget) for q in questions]):
-        raise ValueError('Questions must be a sequence of QuestionWidgets')
+    if not all([isinstance(q, Question) for q in questions]):
+        raise ValueError('Questions must be a sequence of Questions')
 
 
-def read_questions(filepath: str) -> typing.Sequence[QuestionWidget]:
+def read_questions(filepath: str) -> typing.Sequence[Question]:
     contents = {
         'CheckQuestion' : CheckQuestion,
         'RadioQuestion' : RadioQuestion,
@@ -279,13 +805,29 @@ def read_questions(filepath: str) -> typing.Sequence[QuestionWidget]:
 
 def parse_arguments(arguments):
     parser = argparse.ArgumentParser(prog='mRNA loc questionnaire')
+    parser.add_argument('--scorer', action='store', type=str,
+                        default=getpass.getuser(),
+                        help='Name of who is answering, names answers file')
+    parser.add_argument('--queue', action='store_true',
+                        help='Share images with other scorers in SAVE-DIR')
+    parser.add_argument('--import-pickles', action='store_true',
+                        help='Import answers in old pickle files and exit')
+    parser.add_argument('--img-list', action='store', type=str, default=None,
+                        help='File with image files, one per line')
     parser.add_argument('questions_fpath', action='store', type=str,
                         help='Filepath for python file with questions')
     parser.add_argument('save_dir', action='store', type=str,
                         help='Directory where to save the answers')
-    parser.add_argument('img_fpaths', action='store', type=str, nargs='+',
+    parser.add_argument('img_fpaths', action='store', type=str, nargs='*',
                         help='Image files to make questions about')
     args = parser.parse_args(arguments[1:])
+    if args.img_list is not None:
+        if not os.path.isfile(args.img_list):
+            raise ValueError('no file \'%s\' with images' % args.img_list)
+        with open(args.img_list, 'r') as fh:
+            args.img_fpaths.extend([l.strip() for l in fh if l.strip()])
+    if len(args.img_fpaths) < 1 and not args.import_pickles:
+        raise ValueError('no images to make questions about')
     if not os.path.isfile(args.questions_fpath):
         raise ValueError('no file \'%s\' for questions' % args.questions_fpath)
     if not os.path.isdir(args.save_dir):
@@ -302,9 +844,36 @@ def main(argv):
     args = parse_arguments(app.arguments())
     questions = read_questions(args.questions_fpath)
 
-    window = QuestionWindow(questions, args.save_dir, args.img_fpaths)
+    store = answer_store.AnswerStore(args.save_dir, args.scorer)
+    if args.import_pickles:
+        multi = [q.question for q in questions if isinstance(q, CheckQuestion)]
+        n_imported = answer_store.import_pickles(store, args.save_dir, multi)
+        print('Imported answers for %d images into \'%s\''
+              % (n_imported, store.fpath))
+        store.close()
+        sys.exit(0)
+
+    queue = None
+    if args.queue:
+        queue = answer_store.WorkQueue(args.save_dir)
+
+    if all([answer_store.image_id_from_fpath(f) in store
+            for f in args.img_fpaths]):
+        print('All images already answered by \'%s\'' % args.scorer)
+        sys.exit(0)
+
+    try:
+        window = QuestionWindow(questions, store, args.img_fpaths, queue)
+    except NoImagesError:
+        print('No images left for \'%s\', all answered or claimed by'
+              ' other scorers' % args.scorer)
+        store.close()
+        sys.exit(0)
+    app.aboutToQuit.connect(window.shutdown)
     window.show()
-    sys.exit(app.exec_())
+    status = app.exec_()
+    store.close()
+    sys.exit(status)
 
 if __name__ == '__main__':
     main(sys.argv)